@@ -23,12 +23,15 @@ class zulip::app_frontend_base {
     source => "puppet:///modules/zulip/nginx/zulip-include-frontend/app",
     notify => Service["nginx"],
   }
+  # One port per Tornado shard; Django reads the same setting (see
+  # TORNADO_SHARD_PORTS in zproject/settings.py).
+  $tornado_ports = split(zulipconf("application_server", "tornado_ports", "9993"), ",")
   file { "/etc/nginx/zulip-include/upstreams":
     require => Package["nginx-full"],
     owner  => "root",
     group  => "root",
     mode => 644,
-    source => "puppet:///modules/zulip/nginx/zulip-include-frontend/upstreams",
+    content => template("zulip/nginx-upstreams.template.erb"),
     notify => Service["nginx"],
   }
   file { "/etc/nginx/zulip-include/uploads.types":
@@ -20,6 +20,7 @@ from zerver.lib.cache import (
     to_dict_cache_key_id,
 )
 from zerver.lib.context_managers import lockfile
+from zerver.lib.local_cache import clear_local_message_dicts, invalidate_local_message_dicts
 from zerver.lib.hotspots import get_next_hotspots
 from zerver.lib.message import (
     access_message,
@@ -28,11 +29,13 @@ from zerver.lib.message import (
     render_markdown,
 )
 from zerver.lib.realm_icon import realm_icon_url
+from zerver.lib.render_pool import render_markdown_batch
 from zerver.models import Realm, RealmEmoji, Stream, UserProfile, UserActivity, RealmDomain, \
     Subscription, Recipient, Message, Attachment, UserMessage, RealmAuditLog, UserHotspot, \
     Client, DefaultStream, UserPresence, Referral, PushDeviceToken, MAX_SUBJECT_LENGTH, \
     MAX_MESSAGE_LENGTH, get_client, get_stream, get_recipient, get_huddle, \
     get_user_profile_by_id, PreregistrationUser, get_display_recipient, \
+    bulk_get_active_subscriber_ids, bulk_get_stream_subscribers, \
     get_realm, bulk_get_recipients, \
     email_allowed_for_realm, email_to_username, display_recipient_cache_key, \
     get_user_profile_by_email, get_stream_cache_key, \
@@ -41,7 +44,7 @@ from zerver.models import Realm, RealmEmoji, Stream, UserProfile, UserActivity,
     ScheduledJob, get_owned_bot_dicts, \
     get_old_unclaimed_attachments, get_cross_realm_emails, \
     Reaction, EmailChangeStatus, CustomProfileField, custom_profile_fields_for_realm, \
-    CustomProfileFieldValue, validate_attachment_request
+    CustomProfileFieldValue, validate_attachment_request, parse_usermessage_flags
 
 from zerver.lib.alert_words import alert_words_in_realm
 from zerver.lib.avatar import avatar_url
@@ -64,10 +67,17 @@ from zerver.lib.create_user import random_api_key
 from zerver.lib.timestamp import timestamp_to_datetime, datetime_to_timestamp
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.create_user import create_user
+from zerver.lib.topic_index import add_messages_to_topic_index, get_stream_topics, \
+    refresh_topic_index
+from zerver.lib.unread_counts import add_sent_messages_to_unread_counts, \
+    move_unread_counts_to_topic, update_flags_returning_changed, \
+    update_unread_counts_for_messages
 from zerver.lib import bugdown
-from zerver.lib.cache import cache_with_key, cache_set, \
-    user_profile_by_email_cache_key, cache_set_many, \
-    cache_delete, cache_delete_many
+from zerver.lib.cache import cache_with_key, cache_add, cache_set, \
+    presence_refresh_cache_key, user_profile_by_email_cache_key, cache_set_many, \
+    cache_delete, cache_delete_many, stream_subscribers_cache_key, \
+    pack_stream_subscribers, delete_stream_subscribers_caches, \
+    search_generation_cache_key, with_batched_cache_deletes
 from zerver.decorator import statsd_increment
 from zerver.lib.utils import log_statsd_event, statsd
 from zerver.lib.html_diff import highlight_html_differences
@@ -76,7 +86,7 @@ from zerver.lib.alert_words import user_alert_words, add_user_alert_words, \
 from zerver.lib.notifications import clear_followup_emails_queue
 from zerver.lib.narrow import check_supported_events_narrow_filter
 from zerver.lib.request import JsonableError
-from zerver.lib.sessions import delete_user_sessions
+from zerver.lib.sessions import delete_user_sessions, delete_users_sessions
 from zerver.lib.upload import attachment_url_re, attachment_url_to_path_id, \
     claim_attachment, delete_message_image
 from zerver.lib.str_utils import NonBinaryStr, force_str
@@ -88,6 +98,7 @@ import time
 import traceback
 import re
 import datetime
+import io
 import os
 import platform
 import logging
@@ -169,6 +180,38 @@ def realm_user_count(realm):
 
 def get_topic_history_for_stream(user_profile, recipient):
     # type: (UserProfile, Recipient) -> List[Tuple[str, int]]
+    stream = Stream.objects.get(id=recipient.type_id)
+    if stream.invite_only:
+        # Subscribers to a private stream only see the messages sent
+        # while they were subscribed, so we can't use the stream's
+        # topic index.
+        return get_topic_history_from_user_messages(user_profile, recipient)
+
+    # The topics come from the stream's topic index; only the unread
+    # counts need the user's messages, and the partial index on
+    # unread UserMessage rows limits that query to unread messages.
+    query = '''
+        SELECT lower("zerver_message"."subject"), count(*)
+        FROM "zerver_usermessage"
+        INNER JOIN "zerver_message" ON (
+            "zerver_usermessage"."message_id" = "zerver_message"."id"
+        ) WHERE (
+            "zerver_usermessage"."user_profile_id" = %s AND
+            "zerver_message"."recipient_id" = %s AND
+            ("zerver_usermessage"."flags" & 1) = 0
+        )
+        GROUP BY lower("zerver_message"."subject")
+    '''
+    cursor = connection.cursor()
+    cursor.execute(query, [user_profile.id, recipient.id])
+    unread_counts = dict(cursor.fetchall()) # type: Dict[Text, int]
+    cursor.close()
+
+    return [(topic_name, unread_counts.get(canonical_name, 0))
+            for (topic_name, canonical_name) in get_stream_topics(recipient.id)]
+
+def get_topic_history_from_user_messages(user_profile, recipient):
+    # type: (UserProfile, Recipient) -> List[Tuple[str, int]]
 
     # We tested the below query on some large prod datasets, and we never
     # saw more than 50ms to execute it, so we think that's acceptable,
@@ -484,6 +527,7 @@ def do_set_realm_message_editing(realm, allow_message_editing, message_content_e
     )
     send_event(event, active_user_ids(realm))
 
+@with_batched_cache_deletes
 def do_deactivate_realm(realm):
     # type: (Realm) -> None
     """
@@ -498,11 +542,10 @@ def do_deactivate_realm(realm):
     realm.deactivated = True
     realm.save(update_fields=["deactivated"])
 
-    for user in active_humans_in_realm(realm):
-        # Don't deactivate the users, but do delete their sessions so they get
-        # bumped to the login screen, where they'll get a realm deactivation
-        # notice when they try to log in.
-        delete_user_sessions(user)
+    # Don't deactivate the users, but do delete their sessions so they get
+    # bumped to the login screen, where they'll get a realm deactivation
+    # notice when they try to log in.
+    delete_users_sessions([user.id for user in active_humans_in_realm(realm)])
 
 def do_reactivate_realm(realm):
     # type: (Realm) -> None
@@ -554,6 +597,7 @@ def do_deactivate_stream(stream, log=True):
         recipient__type=Recipient.STREAM,
         recipient__type_id=stream.id,
         active=True).update(active=False)
+    delete_stream_subscribers_caches([stream.id])
 
     was_invite_only = stream.invite_only
     stream.deactivated = True
@@ -687,6 +731,25 @@ def render_incoming_message(message, content, message_users, realm):
         raise JsonableError(_('Unable to render message'))
     return rendered_content
 
+def render_incoming_messages(messages):
+    # type: (Sequence[MutableMapping[str, Any]]) -> List[Text]
+    """Renders a batch of messages being sent by do_send_messages,
+    using the render pool (see zerver.lib.render_pool) when enabled.
+    Like render_incoming_message, it fails the whole batch if any
+    message can't be rendered."""
+    jobs = []
+    for message in messages:
+        assert message['message'].rendered_content is None
+        jobs.append((message['message'],
+                     message['message'].content,
+                     message['realm'],
+                     alert_words_in_realm(message['realm']),
+                     {user_profile.id for user_profile in message['active_recipients']}))
+    try:
+        return render_markdown_batch(jobs)
+    except BugdownRenderingException:
+        raise JsonableError(_('Unable to render message'))
+
 def get_recipient_user_profiles(recipient, sender_id):
     # type: (Recipient, Text) -> List[UserProfile]
     if recipient.type == Recipient.PERSONAL:
@@ -695,10 +758,18 @@ def get_recipient_user_profiles(recipient, sender_id):
         # For personals, you send out either 1 or 2 copies, for
         # personals to yourself or to someone else, respectively.
         assert((len(recipients) == 1) or (len(recipients) == 2))
-    elif (recipient.type == Recipient.STREAM or recipient.type == Recipient.HUDDLE):
+    elif recipient.type == Recipient.STREAM:
+        # Busy streams get many messages per second, so their
+        # subscribers come from the cache; it only holds the fields we
+        # need for sending messages (see bulk_get_stream_subscribers).
+        subscribers = bulk_get_stream_subscribers([recipient.type_id])[recipient.type_id]
+        recipients = [UserProfile(id=user_profile_id, email=email, is_active=True,
+                                  enable_online_push_notifications=push_enabled)
+                      for (user_profile_id, email, push_enabled) in subscribers]
+    elif recipient.type == Recipient.HUDDLE:
         # We use select_related()/only() here, while the PERSONAL case above uses
-        # get_user_profile_by_id() to get UserProfile objects from cache.  Streams will
-        # typically have more recipients than PMs, so get_user_profile_by_id() would be
+        # get_user_profile_by_id() to get UserProfile objects from cache.  Huddles
+        # can have more recipients than PMs, so get_user_profile_by_id() would be
         # a bit more expensive here, given that we need to hit the DB anyway and only
         # care about the email from the user profile.
         fields = [
@@ -714,6 +785,72 @@ def get_recipient_user_profiles(recipient, sender_id):
         raise ValueError('Bad recipient type')
     return recipients
 
+# Above this many UserMessage rows, do_send_messages streams the rows
+# into the database with COPY rather than building UserMessage objects.
+BULK_INSERT_UMS_COPY_THRESHOLD = 1000
+
+def get_user_message_rows(message, recipients):
+    # type: (Message, Iterable[UserProfile]) -> List[Tuple[int, int, int]]
+    """Computes the (user_profile_id, message_id, flags) rows for a
+    newly sent message, with flags as an integer bitmask.
+
+    The mention, alert word, wildcard and me-message properties are
+    set on the Message via render_markdown by code in the bugdown
+    inline patterns."""
+    base_flags = 0
+    if message.mentions_wildcard:
+        base_flags |= int(UserMessage.flags.wildcard_mentioned)
+    if message.is_me_message:
+        base_flags |= int(UserMessage.flags.is_me_message)
+
+    read_flag = int(UserMessage.flags.read)
+    mentioned_flag = int(UserMessage.flags.mentioned)
+    alert_word_flag = int(UserMessage.flags.has_alert_word)
+
+    mentioned_ids = message.mentions_user_ids
+    ids_with_alert_words = message.user_ids_with_alert_words
+    sender_id = message.sender_id
+    sent_by_human = message.sent_by_human()
+    message_id = message.id
+
+    rows = [] # type: List[Tuple[int, int, int]]
+    for user_profile in recipients:
+        user_profile_id = user_profile.id
+        flags = base_flags
+        if user_profile_id == sender_id and sent_by_human:
+            flags |= read_flag
+        if user_profile_id in mentioned_ids:
+            flags |= mentioned_flag
+        if user_profile_id in ids_with_alert_words:
+            flags |= alert_word_flag
+        rows.append((user_profile_id, message_id, flags))
+    return rows
+
+def bulk_insert_ums(ums):
+    # type: (List[Tuple[int, int, int]]) -> None
+    """Inserts (user_profile_id, message_id, flags) rows into the
+    UserMessage table.  Small batches go through the ORM; large ones
+    (e.g. a message to a stream with thousands of subscribers) are
+    streamed to PostgreSQL with COPY, which avoids allocating a model
+    object per row and building one enormous INSERT statement."""
+    if not ums:
+        return
+
+    if len(ums) < BULK_INSERT_UMS_COPY_THRESHOLD:
+        UserMessage.objects.bulk_create(
+            [UserMessage(user_profile_id=user_profile_id, message_id=message_id, flags=flags)
+             for (user_profile_id, message_id, flags) in ums])
+        return
+
+    data = io.StringIO(u''.join(u'%d\t%d\t%d\n' % row for row in ums))
+    cursor = connection.cursor()
+    try:
+        cursor.copy_expert(
+            'COPY zerver_usermessage (user_profile_id, message_id, flags) FROM STDIN',
+            data)
+    finally:
+        cursor.close()
+
 def do_send_messages(messages_maybe_none):
     # type: (Sequence[Optional[MutableMapping[str, Any]]]) -> List[int]
     # Filter out messages which didn't pass internal_prep_message properly
@@ -747,13 +884,8 @@ def do_send_messages(messages_maybe_none):
 
     links_for_embed = set() # type: Set[Text]
     # Render our messages.
-    for message in messages:
-        assert message['message'].rendered_content is None
-        rendered_content = render_incoming_message(
-            message['message'],
-            message['message'].content,
-            message['active_recipients'],
-            message['realm'])
+    rendered_contents = render_incoming_messages(messages)
+    for message, rendered_content in zip(messages, rendered_contents):
         message['message'].rendered_content = rendered_content
         message['message'].rendered_content_version = bugdown_version
         links_for_embed |= message['message'].links_for_preview
@@ -765,34 +897,20 @@ def do_send_messages(messages_maybe_none):
     user_message_flags = defaultdict(dict) # type: Dict[int, Dict[int, List[str]]]
     with transaction.atomic():
         Message.objects.bulk_create([message['message'] for message in messages])
-        ums = [] # type: List[UserMessage]
+        ums = [] # type: List[Tuple[int, int, int]]
         for message in messages:
-            ums_to_create = [UserMessage(user_profile=user_profile, message=message['message'])
-                             for user_profile in message['active_recipients']]
-
-            # These properties on the Message are set via
-            # render_markdown by code in the bugdown inline patterns
-            wildcard = message['message'].mentions_wildcard
-            mentioned_ids = message['message'].mentions_user_ids
-            ids_with_alert_words = message['message'].user_ids_with_alert_words
-            is_me_message = message['message'].is_me_message
-
-            for um in ums_to_create:
-                if um.user_profile.id == message['message'].sender.id and \
-                        message['message'].sent_by_human():
-                    um.flags |= UserMessage.flags.read
-                if wildcard:
-                    um.flags |= UserMessage.flags.wildcard_mentioned
-                if um.user_profile_id in mentioned_ids:
-                    um.flags |= UserMessage.flags.mentioned
-                if um.user_profile_id in ids_with_alert_words:
-                    um.flags |= UserMessage.flags.has_alert_word
-                if is_me_message:
-                    um.flags |= UserMessage.flags.is_me_message
-
-                user_message_flags[message['message'].id][um.user_profile_id] = um.flags_list()
+            ums_to_create = get_user_message_rows(message['message'],
+                                                  message['active_recipients'])
+            flags_lists = {} # type: Dict[int, List[str]]
+            for user_profile_id, message_id, flags in ums_to_create:
+                if flags not in flags_lists:
+                    flags_lists[flags] = parse_usermessage_flags(flags)
+                user_message_flags[message_id][user_profile_id] = flags_lists[flags]
             ums.extend(ums_to_create)
-        UserMessage.objects.bulk_create(ums)
+        bulk_insert_ums(ums)
+
+        add_messages_to_topic_index([message['message'] for message in messages])
+        add_sent_messages_to_unread_counts([message['message'] for message in messages], ums)
 
         # Claim attachments in message
         for message in messages:
@@ -804,19 +922,11 @@ def do_send_messages(messages_maybe_none):
         # remote cache, so that the single-threaded Tornado server
         # doesn't have to.
         user_flags = user_message_flags.get(message['message'].id, {})
-        sender = message['message'].sender
-        user_presences = get_status_dict(sender)
-        presences = {}
-        for user_profile in message['active_recipients']:
-            if user_profile.email in user_presences:
-                presences[user_profile.id] = user_presences[user_profile.email]
-
         event = dict(
             type         = 'message',
             message      = message['message'].id,
             message_dict_markdown = message_to_dict(message['message'], apply_markdown=True),
-            message_dict_no_markdown = message_to_dict(message['message'], apply_markdown=False),
-            presences    = presences)
+            message_dict_no_markdown = message_to_dict(message['message'], apply_markdown=False))
         users = [{'id': user.id,
                   'flags': user_flags.get(user.id, []),
                   'always_push_notify': user.enable_online_push_notifications}
@@ -1342,15 +1452,12 @@ def bulk_get_subscriber_user_ids(stream_dicts, user_profile, sub_dict):
             continue
         target_stream_dicts.append(stream_dict)
 
-    subscriptions = Subscription.objects.select_related("recipient").filter(
-        recipient__type=Recipient.STREAM,
-        recipient__type_id__in=[stream["id"] for stream in target_stream_dicts],
-        user_profile__is_active=True,
-        active=True).values("user_profile_id", "recipient__type_id")
-
     result = dict((stream["id"], []) for stream in stream_dicts) # type: Dict[int, List[int]]
-    for sub in subscriptions:
-        result[sub["recipient__type_id"]].append(sub["user_profile_id"])
+    if not target_stream_dicts:
+        return result
+
+    result.update(bulk_get_active_subscriber_ids(
+        [stream["id"] for stream in target_stream_dicts]))
 
     return result
 
@@ -1458,6 +1565,18 @@ def query_all_subs_by_stream(streams):
         all_subs_by_stream[sub.recipient.type_id].append(sub.user_profile)
     return all_subs_by_stream
 
+def update_stream_subscribers_caches(streams, all_subs_by_stream):
+    # type: (Iterable[Stream], Mapping[int, List[UserProfile]]) -> None
+    """Refreshes the cached subscribers (see bulk_get_stream_subscribers)
+    of streams whose subscriptions we just changed, using the
+    subscribers we fetched after the change."""
+    cache_set_many({
+        stream_subscribers_cache_key(stream.id): (pack_stream_subscribers(
+            (user.id, user.email, user.enable_online_push_notifications)
+            for user in all_subs_by_stream.get(stream.id, [])),)
+        for stream in streams})
+
+@with_batched_cache_deletes
 def bulk_add_subscriptions(streams, users, from_creation=False):
     # type: (Iterable[Stream], Iterable[UserProfile], bool) -> Tuple[List[Tuple[UserProfile, Stream]], List[Tuple[UserProfile, Stream]]]
     recipients_map = bulk_get_recipients(Recipient.STREAM, [stream.id for stream in streams]) # type: Mapping[int, Recipient]
@@ -1525,6 +1644,7 @@ def bulk_add_subscriptions(streams, users, from_creation=False):
     # We fetch all subscription information upfront, as it's used throughout
     # the following code and we want to minize DB queries
     all_subs_by_stream = query_all_subs_by_stream(streams=streams)
+    update_stream_subscribers_caches(streams, all_subs_by_stream)
 
     def fetch_stream_subscriber_emails(stream):
         # type: (Stream) -> List[Text]
@@ -1654,6 +1774,7 @@ def bulk_remove_subscriptions(users, streams):
         notify_subscriptions_removed(user_profile, streams_by_user[user_profile.id])
 
     all_subs_by_stream = query_all_subs_by_stream(streams=streams)
+    update_stream_subscribers_caches(streams, all_subs_by_stream)
 
     for stream in streams:
         if stream.realm.is_zephyr_mirror_realm and not stream.invite_only:
@@ -1998,6 +2119,7 @@ def do_rename_stream(stream, new_name, log=True):
         to_dict_cache_key_id(message.id, True) for message in messages)
     cache_delete_many(
         to_dict_cache_key_id(message.id, False) for message in messages)
+    clear_local_message_dicts()
     new_email = encode_email_address(stream)
 
     # We will tell our users to essentially
@@ -2343,10 +2465,25 @@ def send_presence_changed(user_profile, presence):
     # type: (UserProfile, UserPresence) -> None
     presence_dict = presence.to_dict()
     event = dict(type="presence", email=user_profile.email,
+                 user_id=user_profile.id,
                  server_timestamp=time.time(),
                  presence={presence_dict['client']: presence.to_dict()})
     send_event(event, active_user_ids(user_profile.realm))
 
+# Tornado's presence table goes stale after 140 seconds (see
+# zerver/tornado/presence.py); with the web app pinging every 50
+# seconds, this keeps active users' entries at most 110 seconds old.
+PRESENCE_REFRESH_INTERVAL_SECS = 60
+
+def send_presence_refresh(user_profile, presence):
+    # type: (UserProfile, UserPresence) -> None
+    # Keeps Tornado's presence table, which decides whether message
+    # recipients are idle, up to date; clients aren't sent these.
+    presence_dict = presence.to_dict()
+    event = dict(type="presence_refresh", user_id=user_profile.id,
+                 presence={presence_dict['client']: presence_dict})
+    send_event(event, [user_profile.id])
+
 def consolidate_client(client):
     # type: (Client) -> Client
     # The web app reports a client as 'website'
@@ -2380,6 +2517,8 @@ def do_update_user_presence(user_profile, client, log_time, status):
     # this protects us from the user having two clients open: one active, the
     # other idle. Without this check, we would constantly toggle their status
     # between the two states.
+    updated = False
+    timestamp_updated = False
     if not created and stale_status or was_idle or status == presence.status:
         # The following block attempts to only update the "status"
         # field in the event that it actually changed.  This is
@@ -2392,6 +2531,8 @@ def do_update_user_presence(user_profile, client, log_time, status):
             presence.status = status
             update_fields.append("status")
         presence.save(update_fields=update_fields)
+        updated = "status" in update_fields
+        timestamp_updated = True
 
     if not user_profile.realm.is_zephyr_mirror_realm and (created or became_online):
         # Push event to all users in the realm so they see the new user
@@ -2405,6 +2546,15 @@ def do_update_user_presence(user_profile, client, log_time, status):
         # that's not a high priority for now, considering that most of our non-MIT
         # realms are pretty small.
         send_presence_changed(user_profile, presence)
+    elif created or became_online or updated:
+        send_presence_refresh(user_profile, presence)
+    elif status == UserPresence.ACTIVE and timestamp_updated and \
+            cache_add(presence_refresh_cache_key(user_profile.id), True,
+                      timeout=PRESENCE_REFRESH_INTERVAL_SECS):
+        # Tornado treats a user whose active timestamp is older than
+        # OFFLINE_THRESHOLD_SECS as idle, so it needs to hear about
+        # active users' pings too, but not about every one of them.
+        send_presence_refresh(user_profile, presence)
 
 def update_user_activity_interval(user_profile, log_time):
     # type: (UserProfile, datetime.datetime) -> None
@@ -2438,11 +2588,12 @@ def do_update_pointer(user_profile, pointer, update_flags=False):
         # Until we handle the new read counts in the Android app
         # natively, this is a shim that will mark as read any messages
         # up until the pointer move
-        UserMessage.objects.filter(user_profile=user_profile,
-                                   message__id__gt=prev_pointer,
-                                   message__id__lte=pointer,
-                                   flags=~UserMessage.flags.read)        \
-                           .update(flags=F('flags').bitor(UserMessage.flags.read))
+        msgs = UserMessage.objects.filter(user_profile=user_profile,
+                                          message__id__gt=prev_pointer,
+                                          message__id__lte=pointer)
+        with transaction.atomic():
+            newly_read = update_flags_returning_changed(msgs, 'add', UserMessage.flags.read)
+            update_unread_counts_for_messages(user_profile, newly_read, -1)
 
     event = dict(type='pointer', pointer=pointer)
     send_event(event, [user_profile.id])
@@ -2487,16 +2638,23 @@ def do_update_message_flags(user_profile, operation, flag, messages, all, stream
     # flags (e.g. bankruptcy).  This patch arose from seeing slow calls
     # to POST /json/messages/flags in the logs.  The filter() statements
     # are kind of magical; they are actually just testing the one bit.
-    if operation == 'add':
-        msgs = msgs.filter(flags=~flagattr)
-        if stream_obj:
-            messages = list(msgs.values_list('message__id', flat=True))
-        count = msgs.update(flags=F('flags').bitor(flagattr))
-    elif operation == 'remove':
-        msgs = msgs.filter(flags=flagattr)
-        if stream_obj:
-            messages = list(msgs.values_list('message__id', flat=True))
-        count = msgs.update(flags=F('flags').bitand(~flagattr))
+    changed_messages = [] # type: List[int]
+    with transaction.atomic():
+        if stream_obj or flag == 'read':
+            changed_messages = update_flags_returning_changed(msgs, operation, flagattr)
+            if stream_obj:
+                messages = changed_messages
+            count = len(changed_messages)
+        elif operation == 'add':
+            msgs = msgs.filter(flags=~flagattr)
+            count = msgs.update(flags=F('flags').bitor(flagattr))
+        elif operation == 'remove':
+            msgs = msgs.filter(flags=flagattr)
+            count = msgs.update(flags=F('flags').bitand(~flagattr))
+
+        if flag == 'read':
+            update_unread_counts_for_messages(user_profile, changed_messages,
+                                              -1 if operation == 'add' else 1)
 
     event = {'type': 'update_message_flags',
              'operation': operation,
@@ -2581,6 +2739,7 @@ def update_to_dict_cache(changed_messages):
         items_for_remote_cache[to_dict_cache_key(changed_message, False)] = \
             (MessageDict.to_dict_uncached(changed_message, apply_markdown=False),)
     cache_set_many(items_for_remote_cache)
+    invalidate_local_message_dicts(message_ids)
     return message_ids
 
 # We use transaction.atomic to support select_for_update in the attachment codepath.
@@ -2717,6 +2876,13 @@ def do_update_message(user_profile, message, subject, propagate_mode, content, r
                                 "rendered_content_version", "last_edit_time",
                                 "edit_history"])
 
+    if subject is not None:
+        refresh_topic_index(message.recipient_id, [orig_subject, subject])
+        move_unread_counts_to_topic(message.recipient_id, orig_subject, subject,
+                                    [m.id for m in changed_messages])
+    # The edited messages may match different searches now.
+    cache_delete(search_generation_cache_key(user_profile.realm_id))
+
     event['message_ids'] = update_to_dict_cache(changed_messages)
 
     def user_info(um):
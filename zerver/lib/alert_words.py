@@ -1,11 +1,12 @@
 from __future__ import absolute_import
 
+from collections import defaultdict
 from django.db.models import Q
 from zerver.models import UserProfile, Realm
 from zerver.lib.cache import cache_with_key, realm_alert_words_cache_key
 import ujson
 import six
-from typing import Dict, Iterable, List, Text
+from typing import DefaultDict, Dict, FrozenSet, Iterable, List, Set, Text, Tuple
 
 @cache_with_key(realm_alert_words_cache_key, timeout=3600*24)
 def alert_words_in_realm(realm):
@@ -44,3 +45,92 @@ def set_user_alert_words(user_profile, alert_words):
     # type: (UserProfile, List[Text]) -> None
     user_profile.alert_words = ujson.dumps(alert_words)
     user_profile.save(update_fields=['alert_words'])
+
+# An alert word only matches when it's delimited by whitespace, the
+# start or end of the message, or one of these characters.
+ALLOWED_BEFORE_PUNCTUATION = frozenset(u'(".,\';[*`>')
+ALLOWED_AFTER_PUNCTUATION = frozenset(u')"?:.,\';]!*`')
+
+class AlertWordMatcher(object):
+    """Finds which of a set of alert words occur in a message, in a
+    single pass over its content, using an Aho-Corasick automaton of
+    the lowercased words.  Matching is case-insensitive; find_words
+    takes lowercased content."""
+
+    def __init__(self, words):
+        # type: (Iterable[Text]) -> None
+        # lowercased word -> the words that lowercase to it
+        self.words_by_pattern = defaultdict(set) # type: DefaultDict[Text, Set[Text]]
+        for word in words:
+            if word:
+                self.words_by_pattern[word.lower()].add(word)
+
+        # The automaton's states are numbered, with 0 the initial
+        # state; for each state, `goto` has its transitions, `fail`
+        # the state for the longest proper suffix of its input that is
+        # also a state, and `output` the patterns that end there.
+        self.goto = [{}] # type: List[Dict[Text, int]]
+        self.output = [[]] # type: List[List[Text]]
+        for pattern in self.words_by_pattern:
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append({})
+                    self.output.append([])
+                state = next_state
+            self.output[state].append(pattern)
+
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for (char, next_state) in self.goto[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and char not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def find_words(self, content):
+        # type: (Text) -> Set[Text]
+        found = set() # type: Set[Text]
+        goto = self.goto
+        fail = self.fail
+        state = 0
+        for (i, char) in enumerate(content):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for pattern in self.output[state]:
+                if pattern in found:
+                    continue
+                start = i + 1 - len(pattern)
+                end = i + 1
+                if (start == 0 or content[start - 1].isspace() or
+                        content[start - 1] in ALLOWED_BEFORE_PUNCTUATION) and \
+                   (end == len(content) or content[end].isspace() or
+                        content[end] in ALLOWED_AFTER_PUNCTUATION):
+                    found.add(pattern)
+
+        words = set() # type: Set[Text]
+        for pattern in found:
+            words.update(self.words_by_pattern[pattern])
+        return words
+
+# realm id -> (the realm's alert words, their matcher)
+realm_alert_word_matchers = {} # type: Dict[int, Tuple[FrozenSet[Text], AlertWordMatcher]]
+
+def get_alert_word_matcher(realm_id, realm_alert_words):
+    # type: (int, Dict[int, List[Text]]) -> AlertWordMatcher
+    """A matcher for all the alert words in the realm (as returned by
+    alert_words_in_realm).  Each process keeps one per realm, and
+    only rebuilds it when the realm's alert words change."""
+    words = frozenset(word for user_words in realm_alert_words.values() for word in user_words)
+    cached = realm_alert_word_matchers.get(realm_id)
+    if cached is None or cached[0] != words:
+        cached = (words, AlertWordMatcher(words))
+        realm_alert_word_matchers[realm_id] = cached
+    return cached[1]
@@ -1077,25 +1077,21 @@ class AlertWordsNotificationProcessor(markdown.preprocessors.Preprocessor):
             # We check for alert words here, the set of which are
             # dependent on which users may see this message.
             #
-            # Our caller passes in the list of possible_words.  We
+            # Our caller passes in the list of possible_words, and
+            # usually a matcher for all of the realm's alert words.  We
             # don't do any special rendering; we just append the alert words
             # we find to the set current_message.alert_words.
 
             realm_words = db_data['possible_words']
+            if not realm_words:
+                return lines
 
-            content = '\n'.join(lines).lower()
-
-            allowed_before_punctuation = "|".join([r'\s', '^', r'[\(\".,\';\[\*`>]'])
-            allowed_after_punctuation = "|".join([r'\s', '$', r'[\)\"\?:.,\';\]!\*`]'])
+            matcher = db_data['alert_word_matcher']
+            if matcher is None:
+                matcher = alert_words.AlertWordMatcher(realm_words)
 
-            for word in realm_words:
-                escaped = re.escape(word.lower())
-                match_re = re.compile(u'(?:%s)%s(?:%s)' %
-                                      (allowed_before_punctuation,
-                                       escaped,
-                                       allowed_after_punctuation))
-                if re.search(match_re, content):
-                    current_message.alert_words.add(word)
+            content = '\n'.join(lines).lower()
+            current_message.alert_words.update(matcher.find_words(content) & realm_words)
 
         return lines
 
@@ -1377,8 +1373,9 @@ def log_bugdown_error(msg):
     could cause an infinite exception loop."""
     logging.getLogger('').error(msg)
 
-def do_convert(content, message=None, message_realm=None, possible_words=None, sent_by_bot=False):
-    # type: (Text, Optional[Message], Optional[Realm], Optional[Set[Text]], Optional[bool]) -> Text
+def do_convert(content, message=None, message_realm=None, possible_words=None, sent_by_bot=False,
+               alert_word_matcher=None):
+    # type: (Text, Optional[Message], Optional[Realm], Optional[Set[Text]], Optional[bool], Optional[alert_words.AlertWordMatcher]) -> Text
     """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
     from zerver.models import get_active_user_dicts_in_realm, get_active_streams, UserProfile
 
@@ -1425,6 +1422,7 @@ def do_convert(content, message=None, message_realm=None, possible_words=None, s
             possible_words = set() # Set[Text]
 
         db_data = {'possible_words': possible_words,
+                   'alert_word_matcher': alert_word_matcher,
                    'full_names': dict((user['full_name'].lower(), user) for user in realm_users),
                    'short_names': dict((user['short_name'].lower(), user) for user in realm_users),
                    'by_email': dict((user['email'].lower(), user) for user in realm_users),
@@ -1484,9 +1482,11 @@ def bugdown_stats_finish():
     bugdown_total_requests += 1
     bugdown_total_time += (time.time() - bugdown_time_start)
 
-def convert(content, message=None, message_realm=None, possible_words=None, sent_by_bot=False):
-    # type: (Text, Optional[Message], Optional[Realm], Optional[Set[Text]], Optional[bool]) -> Text
+def convert(content, message=None, message_realm=None, possible_words=None, sent_by_bot=False,
+            alert_word_matcher=None):
+    # type: (Text, Optional[Message], Optional[Realm], Optional[Set[Text]], Optional[bool], Optional[alert_words.AlertWordMatcher]) -> Text
     bugdown_stats_start()
-    ret = do_convert(content, message, message_realm, possible_words, sent_by_bot)
+    ret = do_convert(content, message, message_realm, possible_words, sent_by_bot,
+                     alert_word_matcher)
     bugdown_stats_finish()
     return ret
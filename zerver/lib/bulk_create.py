@@ -1,11 +1,13 @@
 from __future__ import absolute_import
 from typing import Any, Dict, Iterable, List, Mapping, Optional, Set, Tuple, Text
 
+from zerver.lib.cache import with_batched_cache_deletes
 from zerver.lib.initial_password import initial_password
 from zerver.models import Realm, Stream, UserProfile, Huddle, \
     Subscription, Recipient, Client, RealmAuditLog, get_huddle_hash
 from zerver.lib.create_user import create_user_profile
 
+@with_batched_cache_deletes
 def bulk_create_users(realm, users_raw, bot_type=None, tos_version=None):
     # type: (Realm, Set[Tuple[Text, Text, Text, bool]], Optional[int], Optional[Text]) -> None
     """
@@ -1,18 +1,27 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+from contextlib import contextmanager
 from functools import wraps
 
 from django.core.cache import cache as djcache
 from django.core.cache import caches
 from django.conf import settings
+from django.db import connection, transaction
 from django.db.models import Q
 from django.core.cache.backends.base import BaseCache
 
-from typing import Any, Callable, Dict, Iterable, List, Optional, Union, TypeVar, Text
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, \
+    Union, TypeVar, Text
 
+from zerver.lib.local_cache import LocalCache, invalidate_local_message_dicts
+from zerver.lib.redis_utils import get_redis_client
 from zerver.lib.utils import statsd, statsd_key, make_safe_digest
+from six.moves import cPickle as pickle
+import logging
+import re
 import subprocess
+import threading
 import time
 import base64
 import random
@@ -20,6 +29,8 @@ import sys
 import os
 import os.path
 import hashlib
+import math
+import struct
 import six
 
 if False:
@@ -58,6 +69,123 @@ def remote_cache_stats_finish():
     remote_cache_total_requests += 1
     remote_cache_total_time += (time.time() - remote_cache_time_start)
 
+# Per key family accounting.  A key's family is the part of the key
+# before the first ':' (e.g. user_profile_by_email, message_dict),
+# prefixed with the cache's name for caches other than the default.
+# Each process adds up the calls, keys, hits, bytes stored and time
+# spent on each operation for each family, and every
+# CACHE_STATS_FLUSH_SECS sends the totals to statsd (as
+# cache.family.<family>.<operation>.<stat> counters) and adds them to
+# a hash in redis, which the cache_stats management command reports.
+# We only measure the size of the values we store, since the cache
+# backend unpickles the values we fetch, and since that means pickling
+# them a second time, only one in CACHE_STATS_SIZE_SAMPLE_RATE of them;
+# the bytes stat is an estimate scaled up from that sample.
+CACHE_STATS_FLUSH_SECS = 60
+CACHE_STATS_SIZE_SAMPLE_RATE = 100
+CACHE_STATS_REDIS_KEY = 'cache_stats'
+cache_key_family_re = re.compile(r'^[a-z][a-z0-9_]*$')
+
+# (family, operation) -> [calls, keys, hits, bytes, seconds]
+cache_stats = {} # type: Dict[Tuple[Text, str], List[float]]
+cache_stats_last_flush = time.time()
+cache_stats_values_stored = 0
+CACHE_STATS_FIELDS = ['calls', 'keys', 'hits', 'bytes', 'seconds']
+
+def cache_key_family(key, cache_name=None):
+    # type: (Text, Optional[str]) -> Text
+    family = key.split(':', 1)[0]
+    if ':' not in key or not cache_key_family_re.match(family):
+        # E.g. tweet ids, or the keys of the cache decorator.
+        family = u'other'
+    if cache_name is not None:
+        family = cache_name + u'.' + family
+    return family
+
+def record_cache_stats(operation, keys, seconds, cache_name=None, hit_keys=(), items=None):
+    # type: (str, Iterable[Text], float, Optional[str], Iterable[Text], Optional[Dict[Text, Any]]) -> None
+    """Records a cache operation on `keys`, of which `hit_keys` were found
+    (for fetches), or `items` were stored (for sets)."""
+    global cache_stats_values_stored
+    keys_by_family = {} # type: Dict[Text, List[Text]]
+    for key in keys:
+        keys_by_family.setdefault(cache_key_family(key, cache_name), []).append(key)
+    num_keys = sum(len(family_keys) for family_keys in keys_by_family.values())
+    for (family, family_keys) in keys_by_family.items():
+        stats = cache_stats.setdefault((family, operation), [0, 0, 0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += len(family_keys)
+        # Time spent on operations on several families is split
+        # between them by their number of keys.
+        stats[4] += seconds * len(family_keys) / num_keys
+    for key in hit_keys:
+        cache_stats[(cache_key_family(key, cache_name), operation)][2] += 1
+    for (key, val) in (items or {}).items():
+        cache_stats_values_stored += 1
+        if cache_stats_values_stored % CACHE_STATS_SIZE_SAMPLE_RATE != 0:
+            continue
+        size = len(pickle.dumps(val, pickle.HIGHEST_PROTOCOL))
+        cache_stats[(cache_key_family(key, cache_name), operation)][3] += \
+            size * CACHE_STATS_SIZE_SAMPLE_RATE
+
+    if time.time() - cache_stats_last_flush >= CACHE_STATS_FLUSH_SECS:
+        flush_cache_stats()
+
+def flush_cache_stats():
+    # type: () -> None
+    global cache_stats
+    global cache_stats_last_flush
+    stats_to_flush = cache_stats
+    cache_stats = {}
+    cache_stats_last_flush = time.time()
+    if not stats_to_flush:
+        return
+
+    try:
+        pipeline = get_redis_client().pipeline()
+        pipeline.hsetnx(CACHE_STATS_REDIS_KEY, 'since', int(time.time()))
+        for ((family, operation), stats) in stats_to_flush.items():
+            for (field, value) in zip(CACHE_STATS_FIELDS, stats):
+                name = '%s|%s|%s' % (family, operation, field)
+                if field == 'seconds':
+                    pipeline.hincrbyfloat(CACHE_STATS_REDIS_KEY, name, value)
+                else:
+                    pipeline.hincrby(CACHE_STATS_REDIS_KEY, name, int(value))
+        pipeline.execute()
+    except Exception:
+        logging.exception("Could not save the cache stats")
+
+    for ((family, operation), (calls, keys, hits, size, seconds)) in stats_to_flush.items():
+        stat = 'cache.family.%s.%s' % (statsd_key(family, clean_periods=True), operation)
+        statsd.incr(stat + '.calls', int(calls))
+        statsd.incr(stat + '.keys', int(keys))
+        if operation in ('get', 'get_many'):
+            statsd.incr(stat + '.hit', int(hits))
+            statsd.incr(stat + '.miss', int(keys - hits))
+        if operation in ('set', 'set_many'):
+            statsd.incr(stat + '.bytes', int(size))
+        statsd.incr(stat + '.time_ms', int(seconds * 1000))
+
+def get_cache_stats():
+    # type: () -> Tuple[Optional[int], Dict[Tuple[Text, str], Dict[str, float]]]
+    """The totals saved by flush_cache_stats in all processes, and when
+    they started."""
+    saved = get_redis_client().hgetall(CACHE_STATS_REDIS_KEY)
+    since = None # type: Optional[int]
+    stats = {} # type: Dict[Tuple[Text, str], Dict[str, float]]
+    for (name, value) in saved.items():
+        name = name.decode('utf-8')
+        if name == 'since':
+            since = int(value)
+            continue
+        (family, operation, field) = name.split('|')
+        stats.setdefault((family, operation), {})[field] = float(value)
+    return (since, stats)
+
+def reset_cache_stats():
+    # type: () -> None
+    get_redis_client().delete(CACHE_STATS_REDIS_KEY)
+
 def get_or_create_key_prefix():
     # type: () -> Text
     if settings.CASPER_TESTS:
@@ -136,8 +264,37 @@ def get_cache_with_key(keyfunc, cache_name=None):
 
     return decorator
 
-def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None):
-    # type: (Any, Optional[str], Optional[int], Optional[str]) -> Any
+# With single_flight, only one process recomputes a missing key at a
+# time: it takes a short lock in the cache (see cache_lock), and the
+# others wait up to SINGLE_FLIGHT_WAIT_SECS for its value, rather than
+# all recomputing e.g. a realm's user dicts right after they're
+# flushed.  If the value still hasn't appeared, they compute it
+# themselves.  Tornado never waits; it always computes the value.
+SINGLE_FLIGHT_LOCK_TIMEOUT_SECS = 10
+SINGLE_FLIGHT_WAIT_SECS = 2.0
+SINGLE_FLIGHT_POLL_SECS = 0.05
+
+# With early_refresh, values are stored along with their expiry time
+# and how long they took to compute, and each fetch recomputes the
+# value ahead of its expiry with a probability that increases as the
+# expiry approaches (and with the cost of the computation); see
+# "Optimal Probabilistic Cache Stampede Prevention", Vattani et al.
+# With single_flight too, the other processes keep using the current
+# value while one recomputes it.  Higher values of EARLY_REFRESH_BETA
+# refresh earlier.
+EARLY_REFRESH_BETA = 1.0
+
+def should_refresh_early(val):
+    # type: (Any) -> bool
+    if len(val) < 3:
+        # Stored without early_refresh (e.g. by cache_set_many)
+        return False
+    (_, expires, compute_secs) = val
+    return time.time() - compute_secs * EARLY_REFRESH_BETA * math.log(1.0 - random.random()) >= expires
+
+def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None,
+                   single_flight=False, early_refresh=False):
+    # type: (Any, Optional[str], Optional[int], Optional[str], bool, bool) -> Any
     # This function can't be typed perfectly because returning a generic function
     # isn't supported in mypy - https://github.com/python/mypy/issues/1551.
     """Decorator which applies Django caching to a function.
@@ -145,10 +302,28 @@ def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None)
        Decorator argument is a function which computes a cache key
        from the original function's arguments.  You are responsible
        for avoiding collisions with other uses of this decorator or
-       other uses of caching."""
+       other uses of caching.
+
+       See above for single_flight and early_refresh, which are meant
+       for hot keys that are expensive to compute."""
 
     def decorator(func):
         # type: (Callable[..., Any]) -> (Callable[..., Any])
+        def compute_and_set(key, *args, **kwargs):
+            # type: (Text, *Any, **Any) -> Any
+            start = time.time()
+            val = func(*args, **kwargs)
+            if early_refresh:
+                compute_secs = time.time() - start
+                cache_timeout = timeout
+                if cache_timeout is None:
+                    cache_timeout = get_cache_backend(cache_name).default_timeout
+                cache_set(key, val, cache_name=cache_name, timeout=timeout,
+                          metadata=(start + cache_timeout, compute_secs))
+            else:
+                cache_set(key, val, cache_name=cache_name, timeout=timeout)
+            return val
+
         @wraps(func)
         def func_with_caching(*args, **kwargs):
             # type: (*Any, **Any) -> Callable[..., Any]
@@ -165,30 +340,86 @@ def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None)
             else:
                 metric_key = statsd_key(key)
 
-            status = "hit" if val is not None else "miss"
+            if val is not None and early_refresh and should_refresh_early(val):
+                status = "early_refresh"
+            else:
+                status = "hit" if val is not None else "miss"
             statsd.incr("cache%s.%s.%s" % (extra, metric_key, status))
 
             # Values are singleton tuples so that we can distinguish
-            # a result of None from a missing key.
-            if val is not None:
+            # a result of None from a missing key (with early_refresh,
+            # they also include the expiry data).
+            if status == "hit":
                 return val[0]
 
-            val = func(*args, **kwargs)
+            if not single_flight or settings.RUNNING_INSIDE_TORNADO:
+                # Tornado is single-threaded, so waiting for another
+                # process would block every connected client.
+                return compute_and_set(key, *args, **kwargs)
 
-            cache_set(key, val, cache_name=cache_name, timeout=timeout)
+            with cache_lock(key, cache_name=cache_name) as locked:
+                if locked:
+                    return compute_and_set(key, *args, **kwargs)
+            if val is not None:
+                # Someone else is refreshing it.
+                return val[0]
 
-            return val
+            deadline = time.time() + SINGLE_FLIGHT_WAIT_SECS
+            while time.time() < deadline:
+                time.sleep(SINGLE_FLIGHT_POLL_SECS)
+                val = cache_get(key, cache_name=cache_name)
+                if val is not None:
+                    return val[0]
+            statsd.incr("cache%s.%s.single_flight_timeout" % (extra, metric_key))
+            return compute_and_set(key, *args, **kwargs)
 
         return func_with_caching
 
     return decorator
 
-def cache_set(key, val, cache_name=None, timeout=None):
-    # type: (Text, Any, Optional[str], Optional[int]) -> None
+def cache_lock_key(key):
+    # type: (Text) -> Text
+    return u'lock:' + key
+
+@contextmanager
+def cache_lock(key, cache_name=None, timeout=SINGLE_FLIGHT_LOCK_TIMEOUT_SECS):
+    # type: (Text, Optional[str], int) -> Iterator[bool]
+    """Tries to take a lock on `key`, shared by all processes using the
+    cache; yields whether we got it.  The lock expires after `timeout`
+    seconds, in case its holder dies."""
+    lock_key = KEY_PREFIX + cache_lock_key(key)
+    cache_backend = get_cache_backend(cache_name)
+    token = '%x' % (random.getrandbits(64),)
+    remote_cache_stats_start()
+    locked = cache_backend.add(lock_key, token, timeout=timeout)
+    remote_cache_stats_finish()
+    try:
+        yield locked
+    finally:
+        # Unless the lock expired and someone else took it, release it.
+        if locked and cache_backend.get(lock_key) == token:
+            cache_backend.delete(lock_key)
+
+def cache_set(key, val, cache_name=None, timeout=None, metadata=()):
+    # type: (Text, Any, Optional[str], Optional[int], Tuple[Any, ...]) -> None
+    remote_cache_stats_start()
+    cache_backend = get_cache_backend(cache_name)
+    cache_backend.set(KEY_PREFIX + key, (val,) + metadata, timeout=timeout)
+    remote_cache_stats_finish()
+    record_cache_stats('set', [key], time.time() - remote_cache_time_start, cache_name,
+                       items={key: (val,) + metadata})
+
+def cache_add(key, val, cache_name=None, timeout=None):
+    # type: (Text, Any, Optional[str], Optional[int]) -> bool
+    """Like cache_set, but only if `key` isn't already set; returns
+    whether it was."""
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
-    cache_backend.set(KEY_PREFIX + key, (val,), timeout=timeout)
+    added = cache_backend.add(KEY_PREFIX + key, (val,), timeout=timeout)
     remote_cache_stats_finish()
+    record_cache_stats('set', [key], time.time() - remote_cache_time_start, cache_name,
+                       items={key: (val,)} if added else {})
+    return added
 
 def cache_get(key, cache_name=None):
     # type: (Text, Optional[str]) -> Any
@@ -196,6 +427,8 @@ def cache_get(key, cache_name=None):
     cache_backend = get_cache_backend(cache_name)
     ret = cache_backend.get(KEY_PREFIX + key)
     remote_cache_stats_finish()
+    record_cache_stats('get', [key], time.time() - remote_cache_time_start, cache_name,
+                       hit_keys=[key] if ret is not None else [])
     return ret
 
 def cache_get_many(keys, cache_name=None):
@@ -204,30 +437,152 @@ def cache_get_many(keys, cache_name=None):
     remote_cache_stats_start()
     ret = get_cache_backend(cache_name).get_many(keys)
     remote_cache_stats_finish()
-    return dict([(key[len(KEY_PREFIX):], value) for key, value in ret.items()])
+    ret = dict([(key[len(KEY_PREFIX):], value) for key, value in ret.items()])
+    record_cache_stats('get_many', [key[len(KEY_PREFIX):] for key in keys],
+                       time.time() - remote_cache_time_start, cache_name, hit_keys=ret.keys())
+    return ret
 
 def cache_set_many(items, cache_name=None, timeout=None):
     # type: (Dict[Text, Any], Optional[str], Optional[int]) -> None
     new_items = {}
     for key in items:
         new_items[KEY_PREFIX + key] = items[key]
-    items = new_items
     remote_cache_stats_start()
-    get_cache_backend(cache_name).set_many(items, timeout=timeout)
+    get_cache_backend(cache_name).set_many(new_items, timeout=timeout)
     remote_cache_stats_finish()
+    record_cache_stats('set_many', items.keys(), time.time() - remote_cache_time_start,
+                       cache_name, items=items)
+
+# Cache deletes are batched in two ways, so that code saving many
+# objects (each firing the flush_* signal handlers below) makes one
+# cache_delete_many round trip per cache, with duplicate keys removed:
+#
+# * In a transaction.atomic() block, cache_delete and cache_delete_many
+#   only collect their keys, and the keys are deleted once the
+#   outermost block commits.  If the transaction (or the savepoint in
+#   which the keys were first collected) rolls back, the keys are
+#   discarded along with its changes.  Code in a transaction keeps
+#   reading the old cached values until it commits, so it must not
+#   rely on reading its own changes through the cache.
+# * Outside a transaction, a batched_cache_deletes() block does the
+#   same, deleting the keys when the outermost block exits.
+#
+# The statsd counters cache.batched_deletes.requested and .coalesced
+# show how many deletes were asked for, and how many were duplicates.
+# Django's TestCase never commits the transaction each test runs in,
+# so the test suite disables the first kind of batching (see
+# CACHE_DELETES_AFTER_COMMIT, and test_helpers.cache_deletes_after_commit).
+
+class CacheDeleteBatch(object):
+    def __init__(self):
+        # type: () -> None
+        # cache name -> keys
+        self.keys = {} # type: Dict[Optional[str], Set[Text]]
+        self.requested = 0
+
+    def add(self, keys, cache_name):
+        # type: (Iterable[Text], Optional[str]) -> None
+        keys = list(keys)
+        self.keys.setdefault(cache_name, set()).update(keys)
+        self.requested += len(keys)
+
+    def add_batch(self, batch):
+        # type: (CacheDeleteBatch) -> None
+        for (cache_name, keys) in batch.keys.items():
+            self.keys.setdefault(cache_name, set()).update(keys)
+        self.requested += batch.requested
+
+    def flush(self):
+        # type: () -> None
+        deleted = 0
+        for (cache_name, keys) in self.keys.items():
+            cache_delete_many(keys, cache_name=cache_name)
+            deleted += len(keys)
+        if self.requested:
+            statsd.incr('cache.batched_deletes.requested', self.requested)
+            statsd.incr('cache.batched_deletes.coalesced', self.requested - deleted)
+        self.keys = {}
+        self.requested = 0
+
+pending_cache_deletes = threading.local()
+
+def transaction_cache_delete_batch():
+    # type: () -> Optional[CacheDeleteBatch]
+    """The batch of deletes to run when the current transaction commits,
+    or None outside a transaction."""
+    if not settings.CACHE_DELETES_AFTER_COMMIT or not connection.in_atomic_block:
+        return None
+    batch = getattr(pending_cache_deletes, 'transaction_batch', None)
+    # A rollback drops the batch's on_commit callback, and with it the
+    # batch; so does a commit, after running it.
+    if batch is None or not any(func == batch.flush for (sids, func) in connection.run_on_commit):
+        batch = CacheDeleteBatch()
+        pending_cache_deletes.transaction_batch = batch
+        transaction.on_commit(batch.flush)
+    return batch
+
+@contextmanager
+def batched_cache_deletes():
+    # type: () -> Iterator[None]
+    if getattr(pending_cache_deletes, 'batch', None) is not None:
+        # Part of an enclosing batch.
+        yield
+        return
+
+    batch = CacheDeleteBatch()
+    pending_cache_deletes.batch = batch
+    try:
+        yield
+    finally:
+        pending_cache_deletes.batch = None
+        # If we're inside a transaction after all, its commit (or
+        # rollback) decides.
+        transaction_batch = transaction_cache_delete_batch()
+        if transaction_batch is not None:
+            transaction_batch.add_batch(batch)
+        else:
+            batch.flush()
+
+def with_batched_cache_deletes(func):
+    # type: (FuncT) -> FuncT
+    """Decorator which runs the function in a batched_cache_deletes() block."""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        # type: (*Any, **Any) -> Any
+        with batched_cache_deletes():
+            return func(*args, **kwargs)
+    return wrapper # type: ignore # https://github.com/python/mypy/issues/1927
+
+def add_pending_cache_deletes(keys, cache_name):
+    # type: (List[Text], Optional[str]) -> bool
+    """Adds the keys to the current batch, if there is one."""
+    batch = getattr(pending_cache_deletes, 'batch', None)
+    if batch is None:
+        batch = transaction_cache_delete_batch()
+    if batch is None:
+        return False
+    batch.add(keys, cache_name)
+    return True
 
 def cache_delete(key, cache_name=None):
     # type: (Text, Optional[str]) -> None
+    if add_pending_cache_deletes([key], cache_name):
+        return
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete(KEY_PREFIX + key)
     remote_cache_stats_finish()
+    record_cache_stats('delete', [key], time.time() - remote_cache_time_start, cache_name)
 
 def cache_delete_many(items, cache_name=None):
     # type: (Iterable[Text], Optional[str]) -> None
+    items = list(items)
+    if add_pending_cache_deletes(items, cache_name) or not items:
+        return
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete_many(
         KEY_PREFIX + item for item in items)
     remote_cache_stats_finish()
+    record_cache_stats('delete_many', items, time.time() - remote_cache_time_start, cache_name)
 
 # Required Arguments are as follows:
 # * object_ids: The list of object ids to look up
@@ -243,6 +598,10 @@ def cache_delete_many(items, cache_name=None):
 # * cache_transformer: Function mapping an object from database =>
 #   value for cache (in case the values that we're caching are some
 #   function of the objects, not the objects themselves)
+# * local_cache: A LocalCache (see zerver/lib/local_cache.py) to check
+#   before the remote cache.  It stores items as returned by setter,
+#   so every fetch gets fresh copies from extractor.  Whoever changes
+#   the remote cache entries must invalidate the local ones.
 ObjKT = TypeVar('ObjKT', int, Text)
 ItemT = Any # https://github.com/python/mypy/issues/1721
 CompressedItemT = Any # https://github.com/python/mypy/issues/1721
@@ -252,16 +611,26 @@ def generic_bulk_cached_fetch(cache_key_function, # type: Callable[[ObjKT], Text
                               extractor=lambda obj: obj, # type: Callable[[CompressedItemT], ItemT]
                               setter=lambda obj: obj, # type: Callable[[ItemT], CompressedItemT]
                               id_fetcher=lambda obj: obj.id, # type: Callable[[Any], ObjKT]
-                              cache_transformer=lambda obj: obj # type: Callable[[Any], ItemT]
+                              cache_transformer=lambda obj: obj, # type: Callable[[Any], ItemT]
+                              local_cache=None # type: Optional[LocalCache]
                               ):
     # type: (...) -> Dict[ObjKT, Any]
     cache_keys = {} # type: Dict[ObjKT, Text]
     for object_id in object_ids:
         cache_keys[object_id] = cache_key_function(object_id)
-    cached_objects = cache_get_many([cache_keys[object_id]
-                                     for object_id in object_ids])
-    for (key, val) in cached_objects.items():
-        cached_objects[key] = extractor(cached_objects[key][0])
+
+    cached_objects = {} # type: Dict[Text, Any]
+    if local_cache is not None:
+        for (key, val) in local_cache.get_many(list(cache_keys.values())).items():
+            cached_objects[key] = extractor(val)
+    remote_keys = [cache_keys[object_id] for object_id in object_ids
+                   if cache_keys[object_id] not in cached_objects]
+
+    remote_objects = cache_get_many(remote_keys) if remote_keys else {}
+    items_for_local_cache = {} # type: Dict[Text, CompressedItemT]
+    for (key, val) in remote_objects.items():
+        items_for_local_cache[key] = val[0]
+        cached_objects[key] = extractor(val[0])
     needed_ids = [object_id for object_id in object_ids if
                   cache_keys[object_id] not in cached_objects]
     db_objects = query_function(needed_ids)
@@ -271,9 +640,19 @@ def generic_bulk_cached_fetch(cache_key_function, # type: Callable[[ObjKT], Text
         key = cache_keys[id_fetcher(obj)]
         item = cache_transformer(obj)
         items_for_remote_cache[key] = (setter(item),)
+        items_for_local_cache[key] = items_for_remote_cache[key][0]
         cached_objects[key] = item
     if len(items_for_remote_cache) > 0:
         cache_set_many(items_for_remote_cache)
+
+    if local_cache is not None:
+        local_cache.set_many(items_for_local_cache)
+        local_hits = len(cache_keys) - len(remote_keys)
+        remote_hits = len(remote_objects)
+        statsd.incr('cache.%s.local.hit' % (local_cache.name,), local_hits)
+        statsd.incr('cache.%s.local.miss' % (local_cache.name,), len(remote_keys))
+        statsd.incr('cache.%s.remote.hit' % (local_cache.name,), remote_hits)
+        statsd.incr('cache.%s.remote.miss' % (local_cache.name,), len(remote_keys) - remote_hits)
     return dict((object_id, cached_objects[cache_keys[object_id]]) for object_id in object_ids
                 if cache_keys[object_id] in cached_objects)
 
@@ -310,6 +689,52 @@ def user_profile_by_id_cache_key(user_profile_id):
     # type: (int) -> Text
     return u"user_profile_by_id:%s" % (user_profile_id,)
 
+def presence_refresh_cache_key(user_profile_id):
+    # type: (int) -> Text
+    return u"presence_refresh:%d" % (user_profile_id,)
+
+def stream_subscribers_cache_key(stream_id):
+    # type: (int) -> Text
+    return u"stream_subscribers:%d" % (stream_id,)
+
+# Busy streams can have thousands of subscribers, so we store user id
+# sets as a sorted, packed array of 32-bit ids rather than as a pickled
+# list of Python ints.
+def pack_user_ids(user_ids):
+    # type: (Iterable[int]) -> bytes
+    sorted_ids = sorted(user_ids)
+    return struct.pack('<%dI' % (len(sorted_ids),), *sorted_ids)
+
+def unpack_user_ids(packed_ids):
+    # type: (bytes) -> List[int]
+    return list(struct.unpack('<%dI' % (len(packed_ids) // 4,), packed_ids))
+
+# The cached subscribers of a stream are the (id, email,
+# enable_online_push_notifications) of its active subscribers, which
+# is all do_send_messages needs to fan a message out.  They're stored
+# as the packed ids, the emails in the same order, and the packed ids
+# of the subscribers with online push notifications enabled.
+stream_subscriber_fields = ['email', 'enable_online_push_notifications', 'is_active']
+
+def pack_stream_subscribers(subscribers):
+    # type: (Iterable[Tuple[int, Text, bool]]) -> Tuple[bytes, List[Text], bytes]
+    rows = sorted(subscribers)
+    return (pack_user_ids(row[0] for row in rows),
+            [row[1] for row in rows],
+            pack_user_ids(row[0] for row in rows if row[2]))
+
+def unpack_stream_subscribers(packed):
+    # type: (Tuple[bytes, List[Text], bytes]) -> List[Tuple[int, Text, bool]]
+    (packed_ids, emails, packed_push_ids) = packed
+    push_ids = set(unpack_user_ids(packed_push_ids))
+    return [(user_profile_id, email, user_profile_id in push_ids)
+            for (user_profile_id, email) in zip(unpack_user_ids(packed_ids), emails)]
+
+def delete_stream_subscribers_caches(stream_ids):
+    # type: (Iterable[int]) -> None
+    cache_delete_many([stream_subscribers_cache_key(stream_id)
+                       for stream_id in stream_ids])
+
 # TODO: Refactor these cache helpers into another file that can import
 # models.py so that python v3 style type annotations can also work.
 
@@ -360,13 +785,31 @@ def delete_display_recipient_cache(user_profile):
     keys = [display_recipient_cache_key(rid) for rid in recipient_ids]
     cache_delete_many(keys)
 
+def delete_stream_subscribers_cache_for_user(user_profile):
+    # type: (UserProfile) -> None
+    from zerver.models import Recipient, Subscription  # We need to import here to avoid cyclic dependency.
+    stream_ids = Subscription.objects.filter(user_profile=user_profile,
+                                             recipient__type=Recipient.STREAM,
+                                             active=True)
+    stream_ids = stream_ids.values_list('recipient__type_id', flat=True)
+    delete_stream_subscribers_caches(stream_ids)
+
 # Called by models.py to flush the user_profile cache whenever we save
 # a user_profile object
+@with_batched_cache_deletes
 def flush_user_profile(sender, **kwargs):
     # type: (Any, **Any) -> None
     user_profile = kwargs['instance']
     delete_user_profile_caches([user_profile])
 
+    # The cached stream subscribers only contain active users, and
+    # some of their fields.  A newly created user isn't subscribed to
+    # anything yet.
+    if not kwargs.get('created') and \
+            (kwargs.get('update_fields') is None or
+             set(stream_subscriber_fields) & set(kwargs['update_fields'])):
+        delete_stream_subscribers_cache_for_user(user_profile)
+
     # Invalidate our active_users_in_realm info dict if any user has changed
     # the fields in the dict or become (in)active
     if kwargs.get('update_fields') is None or \
@@ -392,6 +835,7 @@ def flush_user_profile(sender, **kwargs):
 # Called by models.py to flush various caches whenever we save
 # a Realm object.  The main tricky thing here is that Realm info is
 # generally cached indirectly through user_profile objects.
+@with_batched_cache_deletes
 def flush_realm(sender, **kwargs):
     # type: (Any, **Any) -> None
     realm = kwargs['instance']
@@ -428,6 +872,18 @@ def to_dict_cache_key_id(message_id, apply_markdown):
     # type: (int, bool) -> Text
     return u'message_dict:%d:%d' % (message_id, apply_markdown)
 
+def message_window_cache_key(user_profile_id, narrow_hash, direction):
+    # type: (int, Text, Text) -> Text
+    return u'message_window:%d:%s:%s' % (user_profile_id, narrow_hash, direction)
+
+def search_results_cache_key(user_profile_id, search_hash):
+    # type: (int, Text) -> Text
+    return u'search_results:%d:%s' % (user_profile_id, search_hash)
+
+def search_generation_cache_key(realm_id):
+    # type: (int) -> Text
+    return u'search_generation:%d' % (realm_id,)
+
 def to_dict_cache_key(message, apply_markdown):
     # type: (Message, bool) -> Text
     return to_dict_cache_key_id(message.id, apply_markdown)
@@ -435,5 +891,5 @@ def to_dict_cache_key(message, apply_markdown):
 def flush_message(sender, **kwargs):
     # type: (Any, **Any) -> None
     message = kwargs['instance']
-    cache_delete(to_dict_cache_key(message, False))
-    cache_delete(to_dict_cache_key(message, True))
+    cache_delete_many([to_dict_cache_key(message, False), to_dict_cache_key(message, True)])
+    invalidate_local_message_dicts([message.id])
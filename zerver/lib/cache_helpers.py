@@ -15,20 +15,60 @@ from zerver.lib.cache import cache_with_key, cache_set, \
     get_remote_cache_time, get_remote_cache_requests, cache_set_many, \
     to_dict_cache_key_id
 from importlib import import_module
+from zerver.lib.parallel import drop_inherited_connections
 from django.contrib.sessions.models import Session
+from django.utils import timezone
 import logging
-from django.db.models import Q
+import multiprocessing
+import time
+from django.db.models import Max, Q, QuerySet
+from django.db.models.functions import Coalesce
 
 MESSAGE_CACHE_SIZE = 75000
 
+# The *_ids functions below return the primary keys of the objects to
+# cache, most important first, so that e.g. recently active users and
+# realms are back in the cache soonest after a restart.
+
+def message_ids():
+    # type: () -> List[int]
+    return list(Message.objects.order_by('-id')
+                .values_list('id', flat=True)[:MESSAGE_CACHE_SIZE])
+
 def message_fetch_objects():
-    # type: () -> List[Any]
-    try:
-        max_id = Message.objects.only('id').order_by("-id")[0].id
-    except IndexError:
-        return []
-    return Message.objects.select_related().filter(~Q(sender__email='tabbott/extra@mit.edu'),
-                                                   id__gt=max_id - MESSAGE_CACHE_SIZE)
+    # type: () -> QuerySet
+    return Message.objects.select_related().filter(~Q(sender__email='tabbott/extra@mit.edu'))
+
+def realm_ranks_by_activity():
+    # type: () -> Dict[int, int]
+    """Realm id -> rank, the realm with the most recent login first."""
+    rows = UserProfile.objects.values('realm_id') \
+                              .annotate(last_active=Max(Coalesce('last_login', 'date_joined'))) \
+                              .order_by('-last_active')
+    return {row['realm_id']: rank for (rank, row) in enumerate(rows)}
+
+def user_ids():
+    # type: () -> List[int]
+    return list(UserProfile.objects.annotate(last_active=Coalesce('last_login', 'date_joined'))
+                .order_by('-is_active', '-last_active')
+                .values_list('id', flat=True))
+
+def stream_ids():
+    # type: () -> List[int]
+    realm_ranks = realm_ranks_by_activity()
+    rows = Stream.objects.values_list('id', 'realm_id')
+    return [stream_id for (stream_id, realm_id) in
+            sorted(rows, key=lambda row: (realm_ranks.get(row[1], len(realm_ranks)), -row[0]))]
+
+def session_ids():
+    # type: () -> List[Text]
+    # Sessions expire later the more recently they were used.
+    return list(Session.objects.filter(expire_date__gt=timezone.now())
+                .order_by('-expire_date').values_list('session_key', flat=True))
+
+def newest_first_ids(model):
+    # type: (Any) -> Callable[[], List[int]]
+    return lambda: list(model.objects.order_by('-id').values_list('id', flat=True))
 
 def message_cache_items(items_for_remote_cache, message):
     # type: (Dict[Text, Tuple[binary_type]], Message) -> None
@@ -61,39 +101,93 @@ def session_cache_items(items_for_remote_cache, session):
     store = session_engine.SessionStore(session_key=session.session_key) # type: ignore # import_module
     items_for_remote_cache[store.cache_key] = store.decode(session.session_data)
 
-# Format is (objects query, items filler function, timeout, batch size)
+# Format is (object ids function, objects query, items filler
+# function, timeout, batch size)
 #
-# The objects queries are put inside lambdas to prevent Django from
-# doing any setup for things we're unlikely to use (without the lambda
-# wrapper the below adds an extra 3ms or so to startup time for
-# anything importing this file).
+# The objects are fetched by primary key, batch size at a time, so that
+# we never load a whole table at once.  The objects queries are put
+# inside lambdas to prevent Django from doing any setup for things
+# we're unlikely to use (without the lambda wrapper the below adds an
+# extra 3ms or so to startup time for anything importing this file).
 cache_fillers = {
-    'user': (lambda: UserProfile.objects.select_related().all(), user_cache_items, 3600*24*7, 10000),
-    'client': (lambda: Client.objects.select_related().all(), client_cache_items, 3600*24*7, 10000),
-    'recipient': (lambda: Recipient.objects.select_related().all(), recipient_cache_items, 3600*24*7, 10000),
-    'stream': (lambda: Stream.objects.select_related().all(), stream_cache_items, 3600*24*7, 10000),
+    'user': (user_ids, lambda: UserProfile.objects.select_related(), user_cache_items, 3600*24*7, 10000),
+    'client': (newest_first_ids(Client), lambda: Client.objects.select_related(), client_cache_items,
+               3600*24*7, 10000),
+    'recipient': (newest_first_ids(Recipient), lambda: Recipient.objects.select_related(),
+                  recipient_cache_items, 3600*24*7, 10000),
+    'stream': (stream_ids, lambda: Stream.objects.select_related(), stream_cache_items, 3600*24*7, 10000),
     # Message cache fetching disabled until we can fix the fact that it
     # does a bunch of inefficient memcached queries as part of filling
     # the display_recipient cache
-    #    'message': (message_fetch_objects, message_cache_items, 3600 * 24, 1000),
-    'huddle': (lambda: Huddle.objects.select_related().all(), huddle_cache_items, 3600*24*7, 10000),
-    'session': (lambda: Session.objects.all(), session_cache_items, 3600*24*7, 10000),
-} # type: Dict[str, Tuple[Callable[[], List[Any]], Callable[[Dict[Text, Any], Any], None], int, int]]
+    #    'message': (message_ids, message_fetch_objects, message_cache_items, 3600 * 24, 1000),
+    'huddle': (newest_first_ids(Huddle), lambda: Huddle.objects.select_related(), huddle_cache_items,
+               3600*24*7, 10000),
+    'session': (session_ids, lambda: Session.objects.all(), session_cache_items, 3600*24*7, 10000),
+} # type: Dict[str, Tuple[Callable[[], List[Any]], Callable[[], QuerySet], Callable[[Dict[Text, Any], Any], None], int, int]]
+
+def fill_remote_cache_batch(cache, object_ids):
+    # type: (str, List[Any]) -> int
+    """Caches the given objects; returns how many there were (objects
+    may have been deleted since we listed them)."""
+    (_, objects, items_filler, timeout, _) = cache_fillers[cache]
+    items_for_remote_cache = {} # type: Dict[Text, Any]
+    count = 0
+    for obj in objects().filter(pk__in=object_ids):
+        items_filler(items_for_remote_cache, obj)
+        count += 1
+    cache_set_many(items_for_remote_cache, timeout=timeout)
+    return count
 
 def fill_remote_cache(cache):
     # type: (str) -> None
     remote_cache_time_start = get_remote_cache_time()
     remote_cache_requests_start = get_remote_cache_requests()
-    items_for_remote_cache = {} # type: Dict[Text, Any]
-    (objects, items_filler, timeout, batch_size) = cache_fillers[cache]
+    start = time.time()
+    (ids, _, _, _, batch_size) = cache_fillers[cache]
+    object_ids = ids()
     count = 0
-    for obj in objects():
-        items_filler(items_for_remote_cache, obj)
-        count += 1
-        if (count % batch_size == 0):
-            cache_set_many(items_for_remote_cache, timeout=3600*24)
-            items_for_remote_cache = {}
-    cache_set_many(items_for_remote_cache, timeout=3600*24*7)
-    logging.info("Succesfully populated %s cache!  Consumed %s remote cache queries (%s time)" %
-                 (cache, get_remote_cache_requests() - remote_cache_requests_start,
+    for i in range(0, len(object_ids), batch_size):
+        count += fill_remote_cache_batch(cache, object_ids[i:i + batch_size])
+    logging.info("Succesfully populated %s cache with %d objects in %.1fs!  "
+                 "Consumed %s remote cache queries (%s time)" %
+                 (cache, count, time.time() - start,
+                  get_remote_cache_requests() - remote_cache_requests_start,
                   round(get_remote_cache_time() - remote_cache_time_start, 2)))
+
+def fill_remote_cache_job(job):
+    # type: (Tuple[str, List[Any]]) -> Tuple[str, int]
+    (cache, object_ids) = job
+    return (cache, fill_remote_cache_batch(cache, object_ids))
+
+def fill_remote_caches_in_parallel(caches, processes):
+    # type: (List[str], int) -> None
+    """Fills the caches in `processes` worker processes, one batch of
+    objects per job.  The first batch of each cache goes first, then
+    the second, and so on, so that the most important objects of every
+    cache are filled soonest."""
+    jobs = [] # type: List[Tuple[int, str, List[Any]]]
+    total = {} # type: Dict[str, int]
+    for cache in caches:
+        (ids, _, _, _, batch_size) = cache_fillers[cache]
+        object_ids = ids()
+        total[cache] = len(object_ids)
+        for i in range(0, len(object_ids), batch_size):
+            jobs.append((i // batch_size, cache, object_ids[i:i + batch_size]))
+    jobs.sort(key=lambda job: job[0])
+
+    start = time.time()
+    done = {cache: 0 for cache in caches}
+    pool = multiprocessing.Pool(processes=processes, initializer=drop_inherited_connections)
+    try:
+        for (cache, count) in pool.imap_unordered(fill_remote_cache_job,
+                                                  [(cache, object_ids) for (_, cache, object_ids) in jobs]):
+            done[cache] += count
+            elapsed = time.time() - start
+            logging.info("%s cache: %d/%d objects; %d/%d objects overall (%.0f objects/s)" %
+                         (cache, done[cache], total[cache], sum(done.values()),
+                          sum(total.values()), sum(done.values()) / max(elapsed, 0.001)))
+    finally:
+        pool.close()
+        pool.join()
+    logging.info("Succesfully populated the %s caches in %.1fs!" %
+                 (", ".join(caches), time.time() - start))
@@ -24,6 +24,7 @@ from zerver.lib.hotspots import get_next_hotspots
 from zerver.lib.narrow import check_supported_events_narrow_filter
 from zerver.lib.realm_icon import realm_icon_url
 from zerver.lib.request import JsonableError
+from zerver.lib.unread_counts import get_unread_counts
 from zerver.lib.actions import validate_user_access_to_subscribers_helper, \
     do_get_streams, get_default_streams_for_realm, \
     gather_subscriptions_helper, get_realm_domains, \
@@ -138,9 +139,10 @@ def fetch_initial_state_data(user_profile, event_types, queue_id,
         state['never_subscribed'] = never_subscribed
 
     if want('update_message_flags'):
-        # There's no initial data for message flag updates, client will
-        # get any updates during a session from get_events()
-        pass
+        # The flags themselves come with the messages, but we include
+        # the user's unread counts, so clients don't have to download
+        # their unread messages to count them.
+        state['unread_counts'] = get_unread_counts(user_profile)
 
     if want('stream'):
         state['streams'] = do_get_streams(user_profile)
@@ -169,6 +171,13 @@ def fetch_initial_state_data(user_profile, event_types, queue_id,
 
     return state
 
+def refresh_unread_counts(state, user_profile):
+    # type: (Dict[str, Any], UserProfile) -> None
+    # Events only say which messages changed, so we re-read the
+    # counts, which have been updated by the time the event is applied.
+    if 'unread_counts' in state:
+        state['unread_counts'] = get_unread_counts(user_profile)
+
 def apply_events(state, events, user_profile, include_subscribers=True):
     # type: (Dict[str, Any], Iterable[Dict[str, Any]], UserProfile, bool) -> None
     for event in events:
@@ -178,12 +187,16 @@ def apply_event(state, event, user_profile, include_subscribers):
     # type: (Dict[str, Any], Dict[str, Any], UserProfile, bool) -> None
     if event['type'] == "message":
         state['max_message_id'] = max(state['max_message_id'], event['message']['id'])
+        if 'read' not in (event.get('flags') or []):
+            refresh_unread_counts(state, user_profile)
     elif event['type'] == "hotspots":
         state['hotspots'] = event['hotspots']
     elif event['type'] == "custom_profile_fields":
         state['custom_profile_fields'] = event['fields']
     elif event['type'] == "pointer":
         state['pointer'] = max(state['pointer'], event['pointer'])
+        # Moving the pointer can mark messages as read (see do_update_pointer).
+        refresh_unread_counts(state, user_profile)
     elif event['type'] == "realm_user":
         person = event['person']
 
@@ -351,7 +364,8 @@ def apply_event(state, event, user_profile, include_subscribers):
         state['presences'][event['email']] = event['presence']
     elif event['type'] == "update_message":
         # The client will get the updated message directly
-        pass
+        if 'subject' in event:
+            refresh_unread_counts(state, user_profile)
     elif event['type'] == "reaction":
         # The client will get the message with the reactions directly
         pass
@@ -362,7 +376,8 @@ def apply_event(state, event, user_profile, include_subscribers):
         pass
     elif event['type'] == "update_message_flags":
         # The client will get the message with the updated flags directly
-        pass
+        if event['flag'] == 'read':
+            refresh_unread_counts(state, user_profile)
     elif event['type'] == "realm_domains":
         if event['op'] == 'add':
             state['realm_domains'].append(event['realm_domain'])
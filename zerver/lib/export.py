@@ -19,6 +19,8 @@ import subprocess
 import tempfile
 from zerver.lib.avatar_hash import user_avatar_hash
 from zerver.lib.create_user import random_api_key
+from zerver.lib.topic_index import rebuild_topic_index
+from zerver.lib.unread_counts import rebuild_unread_counts
 from zerver.models import UserProfile, Realm, Client, Huddle, Stream, \
     UserMessage, Subscription, Message, RealmEmoji, RealmFilter, \
     RealmDomain, Recipient, DefaultStream, get_user_profile_by_id, \
@@ -79,7 +81,9 @@ ALL_ZERVER_TABLES = [
     'zerver_referral',
     'zerver_scheduledjob',
     'zerver_stream',
+    'zerver_streamtopic',
     'zerver_subscription',
+    'zerver_unreadmessagecount',
     'zerver_useractivity',
     'zerver_useractivityinterval',
     'zerver_usermessage',
@@ -98,6 +102,9 @@ NON_EXPORTED_TABLES = [
     'zerver_pushdevicetoken',
     'zerver_referral',
     'zerver_scheduledjob',
+    # Derived from zerver_message and zerver_usermessage; rebuilt on import.
+    'zerver_streamtopic',
+    'zerver_unreadmessagecount',
     'zerver_userprofile_groups',
     'zerver_userprofile_user_permissions',
 ]
@@ -1491,6 +1498,11 @@ def do_import_realm(import_dir):
 
     # Import zerver_message and zerver_usermessage
     import_message_data(import_dir)
+    rebuild_topic_index(list(Recipient.objects.filter(
+        type=Recipient.STREAM, type_id__in=Stream.objects.filter(realm=realm))
+        .values_list('id', flat=True)))
+    rebuild_unread_counts(list(UserProfile.objects.filter(realm=realm)
+                               .values_list('id', flat=True)))
 
     # Do attachments AFTER message data is loaded.
     # TODO: de-dup how we read these json files.
@@ -0,0 +1,175 @@
+from __future__ import absolute_import
+
+from collections import OrderedDict
+
+from django.conf import settings
+
+from typing import Any, Dict, Iterable, List, Optional, Text, Tuple
+
+from zerver.lib.redis_utils import get_redis_client
+from zerver.lib.utils import statsd
+
+import logging
+import threading
+import time
+import ujson
+
+class LocalCache(object):
+    """A bounded, in-process LRU cache, whose entries also expire after
+    `timeout` seconds.  Used as a tier in front of the remote cache for
+    items that many requests fetch (see generic_bulk_cached_fetch).
+
+    `active` is False while the cache can't be trusted (e.g. when it
+    may have missed invalidations); the cache is then not used.  `name`
+    is used for the statsd hit rates."""
+
+    def __init__(self, name, max_size, timeout):
+        # type: (str, int, int) -> None
+        self.name = name
+        self.max_size = max_size
+        self.timeout = timeout
+        self.items = OrderedDict() # type: OrderedDict[Text, Tuple[float, Any]]
+        self.lock = threading.Lock()
+        self.active = True
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, keys):
+        # type: (Iterable[Text]) -> Dict[Text, Any]
+        now = time.time()
+        result = {} # type: Dict[Text, Any]
+        with self.lock:
+            for key in keys:
+                item = self.items.get(key)
+                if item is None:
+                    self.misses += 1
+                    continue
+                (expires, value) = item
+                if expires < now:
+                    del self.items[key]
+                    self.misses += 1
+                    continue
+                # Move the key to the most recently used end.
+                del self.items[key]
+                self.items[key] = item
+                result[key] = value
+                self.hits += 1
+        return result
+
+    def set_many(self, items):
+        # type: (Dict[Text, Any]) -> None
+        expires = time.time() + self.timeout
+        with self.lock:
+            for (key, value) in items.items():
+                self.items.pop(key, None)
+                self.items[key] = (expires, value)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+
+    def delete_many(self, keys):
+        # type: (Iterable[Text]) -> None
+        with self.lock:
+            for key in keys:
+                self.items.pop(key, None)
+
+    def clear(self):
+        # type: () -> None
+        with self.lock:
+            self.items.clear()
+
+# Message dicts (the to_dict cache) are cached in each process, in front
+# of the remote cache.  Whenever a process changes or deletes a message
+# dict in the remote cache, it calls invalidate_local_message_dicts,
+# which publishes the message ids on a redis channel; every process
+# listens on that channel (in a background thread) and drops those
+# messages from its local cache.  While a process isn't subscribed, its
+# local cache is inactive, since it could miss invalidations.  The
+# entries' timeout bounds how stale a message can get if an
+# invalidation still races with a concurrent fetch.
+MESSAGE_DICT_INVALIDATION_CHANNEL = 'message_dict_invalidations'
+
+message_dict_local_cache = None # type: Optional[LocalCache]
+message_dict_local_cache_lock = threading.Lock()
+
+def message_dict_local_cache_keys(message_ids):
+    # type: (Iterable[int]) -> List[Text]
+    # Avoid a circular import with zerver.lib.cache.
+    from zerver.lib.cache import to_dict_cache_key_id
+    keys = [] # type: List[Text]
+    for message_id in message_ids:
+        keys.append(to_dict_cache_key_id(message_id, True))
+        keys.append(to_dict_cache_key_id(message_id, False))
+    return keys
+
+def listen_for_message_dict_invalidations(local_cache):
+    # type: (LocalCache) -> None
+    while True:
+        try:
+            pubsub = get_redis_client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(MESSAGE_DICT_INVALIDATION_CHANNEL)
+            # Anything cached before we subscribed may have missed
+            # invalidations.
+            local_cache.clear()
+            local_cache.active = True
+            for message in pubsub.listen():
+                message_ids = ujson.loads(message['data'])
+                if message_ids == 'all':
+                    local_cache.clear()
+                else:
+                    local_cache.delete_many(message_dict_local_cache_keys(message_ids))
+        except Exception:
+            logging.exception("Lost subscription to message dict invalidations")
+        local_cache.active = False
+        time.sleep(1)
+
+def get_message_dict_local_cache():
+    # type: () -> Optional[LocalCache]
+    """The process's local message dict cache, or None if it is disabled
+    (MESSAGE_DICT_LOCAL_CACHE_SIZE = 0) or inactive."""
+    global message_dict_local_cache
+    if settings.MESSAGE_DICT_LOCAL_CACHE_SIZE == 0:
+        return None
+    if message_dict_local_cache is None:
+        with message_dict_local_cache_lock:
+            if message_dict_local_cache is None:
+                local_cache = LocalCache('message_dict', settings.MESSAGE_DICT_LOCAL_CACHE_SIZE,
+                                         settings.MESSAGE_DICT_LOCAL_CACHE_TIMEOUT_SECS)
+                # Inactive until the listener has subscribed.
+                local_cache.active = False
+                listener = threading.Thread(target=listen_for_message_dict_invalidations,
+                                            args=(local_cache,))
+                listener.daemon = True
+                listener.start()
+                message_dict_local_cache = local_cache
+    if not message_dict_local_cache.active:
+        return None
+    return message_dict_local_cache
+
+def publish_message_dict_invalidation(payload):
+    # type: (Any) -> None
+    try:
+        get_redis_client().publish(MESSAGE_DICT_INVALIDATION_CHANNEL, ujson.dumps(payload))
+    except Exception:
+        # Other processes may serve the old message dicts until their
+        # entries time out (or their listener loses its subscription
+        # too, deactivating their caches).
+        logging.exception("Could not publish message dict invalidations")
+        statsd.incr('message_dict_local_cache.publish_failed')
+
+def invalidate_local_message_dicts(message_ids):
+    # type: (List[int]) -> None
+    if settings.MESSAGE_DICT_LOCAL_CACHE_SIZE == 0 or not message_ids:
+        return
+    if message_dict_local_cache is not None:
+        message_dict_local_cache.delete_many(message_dict_local_cache_keys(message_ids))
+    publish_message_dict_invalidation(message_ids)
+
+def clear_local_message_dicts():
+    # type: () -> None
+    """For changes to more messages than we'd want to list, e.g. all the
+    messages of a renamed stream."""
+    if settings.MESSAGE_DICT_LOCAL_CACHE_SIZE == 0:
+        return
+    if message_dict_local_cache is not None:
+        message_dict_local_cache.clear()
+    publish_message_dict_invalidation('all')
@@ -9,6 +9,7 @@ from six import binary_type
 
 from typing import Set, Text
 
+from zerver.lib.alert_words import AlertWordMatcher, get_alert_word_matcher
 from zerver.lib.avatar import get_avatar_url
 from zerver.lib.avatar_hash import gravatar_hash
 import zerver.lib.bugdown as bugdown
@@ -292,18 +293,23 @@ def access_message(user_profile, message_id):
     # stream in your realm, so return the message, user_message pair
     return (message, user_message)
 
-def render_markdown(message, content, realm=None, realm_alert_words=None, message_users=None):
-    # type: (Message, Text, Optional[Realm], Optional[RealmAlertWords], Set[UserProfile]) -> Text
+def render_markdown(message, content, realm=None, realm_alert_words=None, message_users=None,
+                    message_user_ids=None):
+    # type: (Message, Text, Optional[Realm], Optional[RealmAlertWords], Set[UserProfile], Optional[Set[int]]) -> Text
     """Return HTML for given markdown. Bugdown may add properties to the
     message object such as `mentions_user_ids` and `mentions_wildcard`.
     These are only on this Django object and are not saved in the
     database.
+
+    Callers that only have the recipients' ids (e.g. the render pool)
+    can pass `message_user_ids` instead of `message_users`.
     """
 
-    if message_users is None:
-        message_user_ids = set() # type: Set[int]
-    else:
-        message_user_ids = {u.id for u in message_users}
+    if message_user_ids is None:
+        if message_users is None:
+            message_user_ids = set()
+        else:
+            message_user_ids = {u.id for u in message_users}
 
     if message is not None:
         message.mentions_wildcard = False
@@ -316,10 +322,13 @@ def render_markdown(message, content, realm=None, realm_alert_words=None, messag
             realm = message.get_realm()
 
     possible_words = set() # type: Set[Text]
+    alert_word_matcher = None # type: Optional[AlertWordMatcher]
     if realm_alert_words is not None:
         for user_id, words in realm_alert_words.items():
             if user_id in message_user_ids:
                 possible_words.update(set(words))
+        if possible_words and realm is not None:
+            alert_word_matcher = get_alert_word_matcher(realm.id, realm_alert_words)
 
     if message is None:
         # If we don't have a message, then we are in the compose preview
@@ -331,7 +340,8 @@ def render_markdown(message, content, realm=None, realm_alert_words=None, messag
     # DO MAIN WORK HERE -- call bugdown to convert
     rendered_content = bugdown.convert(content, message=message, message_realm=realm,
                                        possible_words=possible_words,
-                                       sent_by_bot=sent_by_bot)
+                                       sent_by_bot=sent_by_bot,
+                                       alert_word_matcher=alert_word_matcher)
 
     if message is not None:
         message.user_ids_with_alert_words = set()
@@ -1,6 +1,9 @@
 from __future__ import absolute_import
 from __future__ import print_function
-from typing import Any, Dict, Generator, Iterable, Tuple
+from typing import Any, Dict, Generator, Iterable, List, Tuple
+
+from django.core.cache import caches
+from django.db import connections
 
 import os
 import pty
@@ -53,6 +56,25 @@ def run_parallel(job, data, threads=6):
             else:
                 raise
 
+# See drop_inherited_connections.
+_inherited_handles = [] # type: List[Any]
+
+def drop_inherited_connections():
+    # type: () -> None
+    """For use in a forked worker process (e.g. as a multiprocessing.Pool
+    initializer), which inherits the parent's open database and
+    memcached connections.  Make Django open fresh ones on first use,
+    and keep the inherited handles referenced, so that their
+    destructors never send a disconnect over a socket that the parent
+    process is still using."""
+    for conn in connections.all():
+        _inherited_handles.append(conn.connection)
+        conn.connection = None
+    for cache in caches.all():
+        if getattr(cache, '_client', None) is not None:
+            _inherited_handles.append(cache._client)
+            cache._client = None
+
 if __name__ == "__main__":
     # run some unit tests
     import time
@@ -0,0 +1,102 @@
+from __future__ import absolute_import
+
+from typing import Any, Dict, List, Optional, Set, Text, Tuple
+
+from django.conf import settings
+
+from zerver.lib.bugdown import BugdownRenderingException
+from zerver.lib.message import RealmAlertWords, render_markdown
+from zerver.lib.parallel import drop_inherited_connections
+from zerver.models import Message, Realm
+
+import logging
+import multiprocessing
+
+# A pool of forked worker processes used by do_send_messages to render
+# the messages of a large batch (e.g. from a mirror bot or the message
+# sender worker) concurrently.  It is disabled unless
+# settings.BUGDOWN_RENDER_POOL_SIZE is set.
+
+# Properties that render_markdown sets on the Message object; they are
+# computed in the worker, so we copy them back onto the caller's object.
+RENDER_SIDE_EFFECT_FIELDS = [
+    'mentions_wildcard',
+    'mentions_user_ids',
+    'alert_words',
+    'user_ids_with_alert_words',
+    'is_me_message',
+    'links_for_preview',
+]
+
+# Batches smaller than this aren't worth the IPC overhead.
+MIN_POOL_BATCH_SIZE = 2
+
+# bugdown.do_convert gives up after 5 seconds; this is a backstop in
+# case a worker dies or hangs without ever reporting back.
+RENDER_RESULT_TIMEOUT = 10
+
+RenderJob = Tuple[Message, Text, Realm, RealmAlertWords, Set[int]]
+RenderResult = Optional[Tuple[Text, Dict[str, Any]]]
+
+_pool = None # type: Optional[Any]
+
+def get_render_pool():
+    # type: () -> Optional[Any]
+    global _pool
+    if not settings.BUGDOWN_RENDER_POOL_SIZE:
+        return None
+    if _pool is None:
+        _pool = multiprocessing.Pool(processes=settings.BUGDOWN_RENDER_POOL_SIZE,
+                                     initializer=drop_inherited_connections)
+    return _pool
+
+def render_job(job):
+    # type: (RenderJob) -> RenderResult
+    """Runs in a pool worker.  Returns None if bugdown failed to render
+    the message; bugdown itself has already logged and reported the
+    failure by then."""
+    (message, content, realm, realm_alert_words, message_user_ids) = job
+    try:
+        rendered_content = render_markdown(
+            message=message,
+            content=content,
+            realm=realm,
+            realm_alert_words=realm_alert_words,
+            message_user_ids=message_user_ids,
+        )
+    except BugdownRenderingException:
+        return None
+    side_effects = {field: getattr(message, field) for field in RENDER_SIDE_EFFECT_FIELDS}
+    return (rendered_content, side_effects)
+
+def render_markdown_batch(jobs):
+    # type: (List[RenderJob]) -> List[Text]
+    """Renders a batch of messages, in the render pool if it is enabled
+    and the batch is large enough, and otherwise serially in this
+    process.  Either way, each Message gets the same properties that
+    render_markdown would set on it, and a BugdownRenderingException
+    is raised if any message fails to render."""
+    pool = get_render_pool()
+    if pool is None or len(jobs) < MIN_POOL_BATCH_SIZE:
+        return [render_markdown(message=message, content=content, realm=realm,
+                                realm_alert_words=realm_alert_words,
+                                message_user_ids=message_user_ids)
+                for (message, content, realm, realm_alert_words, message_user_ids) in jobs]
+
+    async_results = [pool.apply_async(render_job, (job,)) for job in jobs]
+    rendered = [] # type: List[Text]
+    for job, async_result in zip(jobs, async_results):
+        try:
+            result = async_result.get(timeout=RENDER_RESULT_TIMEOUT)
+        except multiprocessing.TimeoutError:
+            logging.error("Timed out waiting for render pool to render message")
+            raise BugdownRenderingException()
+        if result is None:
+            raise BugdownRenderingException()
+
+        (rendered_content, side_effects) = result
+        message = job[0]
+        for field, value in side_effects.items():
+            setattr(message, field, value)
+        rendered.append(rendered_content)
+    return rendered
@@ -5,9 +5,10 @@ import logging
 from django.conf import settings
 from django.contrib.auth import SESSION_KEY, get_user_model
 from django.contrib.sessions.models import Session
+from django.core.cache import caches
 from django.utils.timezone import now as timezone_now
 from importlib import import_module
-from typing import List, Mapping, Optional, Text
+from typing import Iterable, List, Mapping, Optional, Text
 
 from zerver.models import Realm, UserProfile, get_user_profile_by_id
 
@@ -34,19 +35,36 @@ def delete_session(session):
     # type: (Session) -> None
     session_engine.SessionStore(session.session_key).delete() # type: ignore # import_module
 
+def delete_sessions(sessions):
+    # type: (List[Session]) -> None
+    """Like delete_session for each of the sessions, but with one
+    database query and, for cached sessions, one cache round trip."""
+    if not sessions:
+        return
+    session_keys = [session.session_key for session in sessions]
+    Session.objects.filter(session_key__in=session_keys).delete()
+    stores = [session_engine.SessionStore(session_key) # type: ignore # import_module
+              for session_key in session_keys]
+    cache_keys = [store.cache_key for store in stores if hasattr(store, 'cache_key')]
+    if cache_keys:
+        caches[settings.SESSION_CACHE_ALIAS].delete_many(cache_keys)
+
+def delete_users_sessions(user_profile_ids):
+    # type: (Iterable[int]) -> None
+    user_profile_ids = set(user_profile_ids)
+    delete_sessions([session for session in Session.objects.all()
+                     if get_session_user(session) in user_profile_ids])
+
 def delete_user_sessions(user_profile):
     # type: (UserProfile) -> None
-    for session in Session.objects.all():
-        if get_session_user(session) == user_profile.id:
-            delete_session(session)
+    delete_users_sessions([user_profile.id])
 
 def delete_realm_user_sessions(realm):
     # type: (Realm) -> None
     realm_user_ids = [user_profile.id for user_profile in
                       UserProfile.objects.filter(realm=realm)]
-    for session in Session.objects.filter(expire_date__gte=timezone_now()):
-        if get_session_user(session) in realm_user_ids:
-            delete_session(session)
+    delete_sessions([session for session in Session.objects.filter(expire_date__gte=timezone_now())
+                     if get_session_user(session) in realm_user_ids])
 
 def delete_all_user_sessions():
     # type: () -> None
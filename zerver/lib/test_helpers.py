@@ -7,12 +7,13 @@ from typing import (cast, Any, Callable, Dict, Generator, Iterable, Iterator, Li
 from django.core import signing
 from django.core.urlresolvers import LocaleRegexURLResolver
 from django.conf import settings
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.test.client import (
     BOUNDARY, MULTIPART_CONTENT, encode_multipart,
 )
 from django.template import loader
 from django.http import HttpResponse
+from django.db import connection
 from django.db.utils import IntegrityError
 
 from zerver.lib.avatar import avatar_url
@@ -90,7 +91,7 @@ def simulated_queue_client(client):
 def tornado_redirected_to_list(lst):
     # type: (List[Mapping[str, Any]]) -> Iterator[None]
     real_event_queue_process_notification = event_queue.process_notification
-    event_queue.process_notification = lambda notice: lst.append(notice)
+    event_queue.process_notification = lambda notice: lst.extend(notice.get('notices', [notice]))
     # process_notification takes a single parameter called 'notice'.
     # lst.append takes a single argument called 'object'.
     # Some code might call process_notification using keyword arguments,
@@ -99,6 +100,21 @@ def tornado_redirected_to_list(lst):
     yield
     event_queue.process_notification = real_event_queue_process_notification
 
+@contextmanager
+def cache_deletes_after_commit():
+    # type: () -> Iterator[None]
+    """Defers the cache deletes made in transactions until they commit,
+    as outside the test suite.  The test's own transaction never
+    commits, so the block stands in for it: the deletes left pending
+    run when it exits."""
+    start = len(connection.run_on_commit)
+    with override_settings(CACHE_DELETES_AFTER_COMMIT=True):
+        yield
+    callbacks = connection.run_on_commit[start:]
+    del connection.run_on_commit[start:]
+    for (sids, func) in callbacks:
+        func()
+
 @contextmanager
 def simulated_empty_cache():
     # type: () -> Generator[List[Tuple[str, Union[Text, List[Text]], Text]], None, None]
@@ -0,0 +1,122 @@
+from __future__ import absolute_import
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, CharField, F, Value, When
+from django.db.models.functions import Greatest, Lower
+
+from zerver.models import Message, Recipient, StreamTopic
+
+from typing import Dict, Iterable, List, Text, Tuple
+
+# Maintains the StreamTopic table: for each topic of each stream, its
+# message count and most recent message.  Listing a stream's topics
+# reads this table instead of aggregating over the stream's messages.
+#
+# * do_send_messages counts new messages in with add_messages_to_topic_index
+# * topic edits in do_update_message call refresh_topic_index for the
+#   old and new topic; anything added later that moves messages between
+#   topics or deletes them (zerver/lib/retention.py only finds expired
+#   messages so far) needs to do the same
+# * code that bulk-loads messages (realm import) calls
+#   rebuild_topic_index afterwards
+#
+# Topics are case-insensitive.  A topic's canonical name is always
+# computed by Postgres's lower(), never in Python: the two disagree on
+# some non-ASCII characters, and the backfills and rebuilds do it in SQL.
+
+def canonical_topic_name(topic_name):
+    # type: (Text) -> Lower
+    """SQL expression for the canonical name of `topic_name`, for
+    filtering on and saving canonical names."""
+    return Lower(Value(topic_name, output_field=CharField()))
+
+def add_messages_to_topic_index(messages):
+    # type: (Iterable[Message]) -> None
+    # Messages are grouped by exact topic name; spellings differing only
+    # in case end up updating the same StreamTopic row.
+    # (recipient_id, topic name) -> [last message id, count]
+    topics = {} # type: Dict[Tuple[int, Text], List[int]]
+    for message in messages:
+        if message.recipient.type != Recipient.STREAM:
+            continue
+        key = (message.recipient_id, message.subject)
+        if key not in topics:
+            topics[key] = [message.id, 0]
+        topic = topics[key]
+        topic[0] = max(topic[0], message.id)
+        topic[1] += 1
+
+    for (recipient_id, topic_name), (last_message_id, count) in sorted(topics.items()):
+        add_to_stream_topic(recipient_id, topic_name, last_message_id, count)
+
+def add_to_stream_topic(recipient_id, topic_name, last_message_id, count):
+    # type: (int, Text, int, int) -> None
+    query = StreamTopic.objects.filter(recipient_id=recipient_id,
+                                       canonical_name=canonical_topic_name(topic_name))
+
+    def update():
+        # type: () -> int
+        # A single UPDATE, so that concurrent senders to a topic
+        # don't lose each other's counts.
+        return query.update(
+            topic_name=Case(When(last_message_id__lt=last_message_id, then=Value(topic_name)),
+                            default=F('topic_name'), output_field=CharField()),
+            last_message_id=Greatest(F('last_message_id'), Value(last_message_id)),
+            message_count=F('message_count') + count)
+
+    if update():
+        return
+    try:
+        with transaction.atomic():
+            StreamTopic.objects.create(recipient_id=recipient_id,
+                                       canonical_name=canonical_topic_name(topic_name),
+                                       topic_name=topic_name, last_message_id=last_message_id,
+                                       message_count=count)
+    except IntegrityError:
+        # Someone else just created the topic.
+        update()
+
+def refresh_topic_index(recipient_id, topic_names):
+    # type: (int, Iterable[Text]) -> None
+    """Recomputes the given topics of a stream from its messages."""
+    for topic_name in set(topic_names):
+        canonical_name = canonical_topic_name(topic_name)
+        messages = Message.objects.filter(recipient_id=recipient_id) \
+                                  .annotate(canonical_subject=Lower('subject')) \
+                                  .filter(canonical_subject=canonical_name)
+        latest = messages.order_by('-id').values_list('id', 'subject').first()
+        if latest is None:
+            StreamTopic.objects.filter(recipient_id=recipient_id,
+                                       canonical_name=canonical_name).delete()
+            continue
+        StreamTopic.objects.update_or_create(
+            recipient_id=recipient_id, canonical_name=canonical_name,
+            defaults=dict(topic_name=latest[1], last_message_id=latest[0],
+                          message_count=messages.count()))
+
+def rebuild_topic_index(recipient_ids):
+    # type: (List[int]) -> None
+    """Recomputes all the topics of the given stream recipients."""
+    if not recipient_ids:
+        return
+    with transaction.atomic():
+        StreamTopic.objects.filter(recipient_id__in=recipient_ids).delete()
+        cursor = connection.cursor()
+        cursor.execute('''
+            INSERT INTO zerver_streamtopic
+                (recipient_id, topic_name, canonical_name, last_message_id, message_count)
+            SELECT recipient_id, (array_agg(subject ORDER BY id DESC))[1],
+                   lower(subject), max(id), count(*)
+            FROM zerver_message
+            WHERE recipient_id = ANY(%s)
+            GROUP BY recipient_id, lower(subject)
+        ''', [list(recipient_ids)])
+        cursor.close()
+
+def get_stream_topics(recipient_id):
+    # type: (int) -> List[Tuple[Text, Text]]
+    """(topic name, canonical name) for each topic of the stream, most
+    recently active first."""
+    return list(StreamTopic.objects.filter(recipient_id=recipient_id)
+                .order_by('-last_message_id')
+                .values_list('topic_name', 'canonical_name'))
@@ -0,0 +1,207 @@
+from __future__ import absolute_import
+
+from collections import defaultdict
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F
+from django.db.models.query import QuerySet
+
+from zerver.lib.topic_index import canonical_topic_name
+from zerver.models import Message, Recipient, UnreadMessageCount, UserMessage, \
+    UserProfile, get_recipient
+
+from typing import Any, DefaultDict, Dict, Iterable, List, Sequence, Text, Tuple
+
+# Maintains the UnreadMessageCount table (see its definition in
+# zerver/models.py for how conversations are keyed):
+#
+# * do_send_messages adds the new messages' unread UserMessage rows
+# * do_update_message_flags and do_update_pointer apply read/unread
+#   changes (including marking everything read or unread), using
+#   update_flags_returning_changed so that concurrent requests don't
+#   both count the same messages; the flags and counts change in one
+#   transaction
+# * topic edits in do_update_message move counts between topics
+# * realm import rebuilds the imported users' counts from their
+#   UserMessage rows
+#
+# fetch_initial_state_data delivers a user's counts as 'unread_counts'.
+
+# (recipient_id, topic); the topic is the message's exact topic name,
+# which add_to_unread_counts canonicalizes in SQL, so spellings that
+# differ only in case update the same UnreadMessageCount rows.
+ConversationKey = Tuple[int, Text]
+# conversation -> user_profile_id -> change in unread count
+UnreadCountChanges = DefaultDict[ConversationKey, DefaultDict[int, int]]
+
+def conversation_key(recipient_id, recipient_type, sender_id, topic_name):
+    # type: (int, int, int, Text) -> ConversationKey
+    if recipient_type == Recipient.STREAM:
+        return (recipient_id, topic_name)
+    if recipient_type == Recipient.PERSONAL:
+        # The message's recipient is the user who received it; the
+        # conversation is with its sender.
+        return (get_recipient(Recipient.PERSONAL, sender_id).id, u'')
+    return (recipient_id, u'')
+
+def new_unread_count_changes():
+    # type: () -> UnreadCountChanges
+    return defaultdict(lambda: defaultdict(int))
+
+def add_sent_messages_to_unread_counts(messages, ums):
+    # type: (Iterable[Message], Iterable[Tuple[int, int, int]]) -> None
+    """`ums` are the (user_profile_id, message_id, flags) UserMessage rows
+    created for the newly sent `messages`."""
+    keys = {} # type: Dict[int, ConversationKey]
+    for message in messages:
+        keys[message.id] = conversation_key(message.recipient_id, message.recipient.type,
+                                            message.sender_id, message.subject)
+
+    read_flag = int(UserMessage.flags.read)
+    changes = new_unread_count_changes()
+    for (user_profile_id, message_id, flags) in ums:
+        if not flags & read_flag:
+            changes[keys[message_id]][user_profile_id] += 1
+    apply_unread_count_changes(changes)
+
+def update_flags_returning_changed(msgs, operation, flagattr):
+    # type: (QuerySet, Text, int) -> List[int]
+    """Sets (operation 'add') or clears ('remove') `flagattr` on the
+    UserMessage rows in `msgs`, and returns the ids of the messages
+    whose flag actually changed.
+
+    This is a single UPDATE ... RETURNING, and Postgres rechecks the
+    flag test on each row once it has locked it, so when two requests
+    (e.g. from the web app and a phone) mark the same messages read at
+    once, only one of them sees each message change and the unread
+    counts are adjusted once."""
+    if operation == 'add':
+        new_flags = 'flags | %s'
+        needs_change = '(flags & %s) = 0'
+    else:
+        new_flags = 'flags & ~%s'
+        needs_change = '(flags & %s) != 0'
+    (query, params) = msgs.values('id').query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute('''
+        UPDATE zerver_usermessage SET flags = %s
+        WHERE id IN (%s) AND %s
+        RETURNING message_id
+    ''' % (new_flags, query, needs_change), [int(flagattr)] + list(params) + [int(flagattr)])
+    changed = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    return changed
+
+def update_unread_counts_for_messages(user_profile, message_ids, delta):
+    # type: (UserProfile, Sequence[int], int) -> None
+    """Adds `delta` (1 when marked unread, -1 when marked read) to the
+    user's count for each of the messages."""
+    if not message_ids:
+        return
+    changes = new_unread_count_changes()
+    rows = Message.objects.filter(id__in=message_ids).values(
+        'recipient_id', 'recipient__type', 'sender_id', 'subject')
+    for row in rows:
+        key = conversation_key(row['recipient_id'], row['recipient__type'],
+                               row['sender_id'], row['subject'])
+        changes[key][user_profile.id] += delta
+    apply_unread_count_changes(changes)
+
+def move_unread_counts_to_topic(recipient_id, orig_topic_name, topic_name, message_ids):
+    # type: (int, Text, Text, Iterable[int]) -> None
+    """For stream messages moved from one topic to another."""
+    if orig_topic_name == topic_name:
+        return
+    orig_key = (recipient_id, orig_topic_name)
+    key = (recipient_id, topic_name)
+    changes = new_unread_count_changes()
+    rows = UserMessage.objects.filter(message_id__in=list(message_ids),
+                                      flags=~UserMessage.flags.read) \
+                              .values('user_profile_id').annotate(unread=Count('id'))
+    for row in rows:
+        changes[orig_key][row['user_profile_id']] -= row['unread']
+        changes[key][row['user_profile_id']] += row['unread']
+    apply_unread_count_changes(changes)
+
+def apply_unread_count_changes(changes):
+    # type: (UnreadCountChanges) -> None
+    for (recipient_id, topic), user_changes in sorted(changes.items()):
+        users_by_delta = defaultdict(list) # type: DefaultDict[int, List[int]]
+        for user_profile_id, delta in user_changes.items():
+            if delta != 0:
+                users_by_delta[delta].append(user_profile_id)
+        for delta, user_profile_ids in sorted(users_by_delta.items()):
+            add_to_unread_counts(recipient_id, topic, user_profile_ids, delta)
+
+def add_to_unread_counts(recipient_id, topic, user_profile_ids, delta):
+    # type: (int, Text, List[int], int) -> None
+    canonical_topic = canonical_topic_name(topic)
+    query = UnreadMessageCount.objects.filter(recipient_id=recipient_id, topic=canonical_topic)
+    if delta < 0:
+        rows = query.filter(user_profile_id__in=user_profile_ids)
+        rows.update(count=F('count') + delta)
+        rows.filter(count__lte=0).delete()
+        return
+
+    existing = list(query.filter(user_profile_id__in=user_profile_ids)
+                    .values_list('user_profile_id', flat=True))
+    if existing:
+        query.filter(user_profile_id__in=existing).update(count=F('count') + delta)
+    missing = set(user_profile_ids) - set(existing)
+    if not missing:
+        return
+    try:
+        with transaction.atomic():
+            UnreadMessageCount.objects.bulk_create(
+                [UnreadMessageCount(user_profile_id=user_profile_id, recipient_id=recipient_id,
+                                    topic=canonical_topic, count=delta)
+                 for user_profile_id in sorted(missing)])
+    except IntegrityError:
+        # Another process created some of these rows; they exist now,
+        # so this time they'll be updated.
+        add_to_unread_counts(recipient_id, topic, sorted(missing), delta)
+
+def rebuild_unread_counts(user_profile_ids):
+    # type: (List[int]) -> None
+    """Recomputes the users' counts from their unread UserMessage rows."""
+    if not user_profile_ids:
+        return
+    with transaction.atomic():
+        UnreadMessageCount.objects.filter(user_profile_id__in=user_profile_ids).delete()
+        cursor = connection.cursor()
+        cursor.execute('''
+            INSERT INTO zerver_unreadmessagecount (user_profile_id, recipient_id, topic, count)
+            SELECT zerver_usermessage.user_profile_id,
+                   CASE WHEN zerver_recipient.type = 1 THEN sender_recipient.id
+                        ELSE zerver_message.recipient_id END,
+                   CASE WHEN zerver_recipient.type = 2 THEN lower(zerver_message.subject)
+                        ELSE '' END,
+                   count(*)
+            FROM zerver_usermessage
+            INNER JOIN zerver_message ON zerver_usermessage.message_id = zerver_message.id
+            INNER JOIN zerver_recipient ON zerver_message.recipient_id = zerver_recipient.id
+            LEFT OUTER JOIN zerver_recipient sender_recipient ON (
+                sender_recipient.type = 1 AND sender_recipient.type_id = zerver_message.sender_id
+            )
+            WHERE zerver_usermessage.user_profile_id = ANY(%s) AND
+                  (zerver_usermessage.flags & 1) = 0
+            GROUP BY 1, 2, 3
+        ''', [list(user_profile_ids)])
+        cursor.close()
+
+def get_unread_counts(user_profile):
+    # type: (UserProfile) -> Dict[str, List[Dict[str, Any]]]
+    streams = [] # type: List[Dict[str, Any]]
+    pms = [] # type: List[Dict[str, Any]]
+    huddles = [] # type: List[Dict[str, Any]]
+    rows = UnreadMessageCount.objects.filter(user_profile=user_profile).values(
+        'recipient_id', 'recipient__type', 'recipient__type_id', 'topic', 'count')
+    for row in rows.order_by('recipient_id', 'topic'):
+        if row['recipient__type'] == Recipient.STREAM:
+            streams.append(dict(stream_id=row['recipient__type_id'], topic=row['topic'],
+                                count=row['count']))
+        elif row['recipient__type'] == Recipient.PERSONAL:
+            pms.append(dict(sender_id=row['recipient__type_id'], count=row['count']))
+        else:
+            huddles.append(dict(recipient_id=row['recipient_id'], count=row['count']))
+    return dict(streams=streams, pms=pms, huddles=huddles)
@@ -0,0 +1,107 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Iterable, List, Set, Text
+
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from zerver.lib.alert_words import AlertWordMatcher
+
+import random
+import re
+import time
+
+def find_alert_words_with_regexes(words, content):
+    # type: (Iterable[Text], Text) -> Set[Text]
+    """The previous implementation in AlertWordsNotificationProcessor:
+    one regex per word."""
+    allowed_before_punctuation = "|".join([r'\s', '^', r'[\(\".,\';\[\*`>]'])
+    allowed_after_punctuation = "|".join([r'\s', '$', r'[\)\"\?:.,\';\]!\*`]'])
+
+    found = set() # type: Set[Text]
+    for word in words:
+        escaped = re.escape(word.lower())
+        match_re = re.compile(u'(?:%s)%s(?:%s)' %
+                              (allowed_before_punctuation,
+                               escaped,
+                               allowed_after_punctuation))
+        if re.search(match_re, content):
+            found.add(word)
+    return found
+
+class Command(BaseCommand):
+    help = """Compare the alert word matcher with the previous one-regex-per-word implementation.
+
+Generates --words random alert words and --messages random messages of
+about --length characters (some mentioning alert words), checks that
+both implementations find the same words, and reports the time each
+takes per message.
+
+Usage: ./manage.py benchmark_alert_words [--words 500] [--messages 200] [--length 1000]"""
+
+    def add_arguments(self, parser):
+        # type: (CommandParser) -> None
+        parser.add_argument('--words', dest='words', type=int, default=500,
+                            help="Number of alert words in the realm (default 500)")
+        parser.add_argument('--messages', dest='messages', type=int, default=200,
+                            help="Number of messages to match (default 200)")
+        parser.add_argument('--length', dest='length', type=int, default=1000,
+                            help="Approximate length of each message in characters (default 1000)")
+        parser.add_argument('--seed', dest='seed', type=int, default=0,
+                            help="Random seed (default 0)")
+
+    def random_word(self, rng):
+        # type: (random.Random) -> Text
+        return u''.join(rng.choice(u'abcdefghijklmnopqrstuvwxyz') for i in range(rng.randint(3, 10)))
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        rng = random.Random(options['seed'])
+        words = set() # type: Set[Text]
+        while len(words) < options['words']:
+            word = self.random_word(rng)
+            if rng.random() < 0.1:
+                word += u' ' + self.random_word(rng)
+            words.add(word)
+        word_list = sorted(words)
+
+        punctuation = [u' ', u' ', u' ', u', ', u'. ', u'\n', u' (', u') ', u'*', u'`', u'!']
+        messages = [] # type: List[Text]
+        for i in range(options['messages']):
+            parts = [] # type: List[Text]
+            length = 0
+            while length < options['length']:
+                if rng.random() < 0.02:
+                    part = rng.choice(word_list)
+                else:
+                    part = self.random_word(rng)
+                part += rng.choice(punctuation)
+                parts.append(part)
+                length += len(part)
+            messages.append(u''.join(parts).lower())
+
+        start = time.time()
+        matcher = AlertWordMatcher(words)
+        build_time = time.time() - start
+
+        start = time.time()
+        matcher_results = [matcher.find_words(content) & words for content in messages]
+        matcher_time = time.time() - start
+
+        start = time.time()
+        regex_results = [find_alert_words_with_regexes(words, content) for content in messages]
+        regex_time = time.time() - start
+
+        if matcher_results != regex_results:
+            raise CommandError("The implementations found different alert words!")
+
+        num_messages = len(messages)
+        print("%d alert words, %d messages of ~%d characters; %d alert word hits" % (
+            len(words), num_messages, options['length'],
+            sum(len(result) for result in matcher_results)))
+        print("%-24s %12s" % ("implementation", "ms/message"))
+        print("%-24s %12.3f" % ("regex per word", regex_time * 1000 / num_messages))
+        print("%-24s %12.3f" % ("automaton", matcher_time * 1000 / num_messages))
+        print("Building the automaton took %.1fms (once per realm and change "
+              "to its alert words); %.1fx speedup per message" % (
+                  build_time * 1000, regex_time / max(matcher_time, 1e-9)))
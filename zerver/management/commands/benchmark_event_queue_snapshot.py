@@ -0,0 +1,103 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Callable
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.tornado import event_queue
+from zerver.tornado.event_queue import ClientDescriptor, EventQueue, \
+    add_to_client_dicts, dump_event_queues, load_event_queues, restore_pending_queues
+from zerver.tornado.message_payload import MessagePayload
+
+import os
+import shutil
+import tempfile
+import time
+import ujson
+
+def timed(name, f):
+    # type: (str, Callable[[], Any]) -> None
+    start = time.time()
+    f()
+    print("%-40s %8.3fs" % (name, time.time() - start))
+
+class Command(BaseCommand):
+    help = """Time dumping and loading Tornado's event queue snapshot.
+
+Builds synthetic event queues in this process (nothing talks to the
+database or a running Tornado), then dumps and reloads them in the
+snapshot format, and in the old single-JSON-document format for
+comparison.
+
+Usage: ./manage.py benchmark_event_queue_snapshot [--queues 50000] [--events 20]"""
+
+    def add_arguments(self, parser):
+        # type: (CommandParser) -> None
+        parser.add_argument('--queues', dest='queues', type=int, default=50000,
+                            help="Number of event queues (default 50000)")
+        parser.add_argument('--events', dest='events', type=int, default=20,
+                            help="Pending message events per queue (default 20)")
+
+    def reset(self):
+        # type: () -> None
+        event_queue.clients.clear()
+        event_queue.user_clients.clear()
+        event_queue.realm_clients_all_streams.clear()
+        event_queue.realm_stream_clients.clear()
+        del event_queue.gc_heap[:]
+        event_queue.pending_queues.clear()
+        event_queue.pending_user_queues.clear()
+
+    def populate(self, num_queues, num_events):
+        # type: (int, int) -> None
+        payloads = [MessagePayload(dict(id=message_id, type='stream', content='x' * 200,
+                                        display_recipient='Verona', subject='benchmark'),
+                                   is_mentioned=False)
+                    for message_id in range(num_events)]
+        for i in range(num_queues):
+            queue_id = 'benchmark:%d' % (i,)
+            client = ClientDescriptor(i, 'user%d@example.com' % (i,), 1, EventQueue(queue_id),
+                                      None, 'website')
+            for payload in payloads:
+                client.event_queue.push(dict(type='message', message=payload, flags=[]))
+            event_queue.clients[queue_id] = client
+            add_to_client_dicts(client)
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        tmp_dir = tempfile.mkdtemp()
+        filename = os.path.join(tmp_dir, 'event_queues.snapshot')
+        legacy_filename = os.path.join(tmp_dir, 'event_queues.json')
+        try:
+            self.reset()
+            timed("build %d queues" % (options['queues'],),
+                  lambda: self.populate(options['queues'], options['events']))
+
+            def dump_legacy():
+                # type: () -> None
+                with open(legacy_filename, 'w') as f:
+                    ujson.dump([(qid, client.to_dict())
+                                for (qid, client) in event_queue.clients.items()], f)
+
+            timed("dump (legacy JSON)", dump_legacy)
+            timed("dump (snapshot)", lambda: dump_event_queues(filename))
+            print("%-40s %8.1fMB / %.1fMB" % ("file size (legacy / snapshot)",
+                                             os.path.getsize(legacy_filename) / 1e6,
+                                             os.path.getsize(filename) / 1e6))
+
+            self.reset()
+
+            def load_legacy():
+                # type: () -> None
+                with open(legacy_filename, 'r') as f:
+                    for (qid, client_dict) in ujson.loads(f.read()):
+                        ClientDescriptor.from_dict(client_dict)
+
+            timed("load (legacy JSON)", load_legacy)
+            timed("index snapshot (Tornado starts serving)", lambda: load_event_queues(filename))
+            timed("restore all indexed queues", restore_pending_queues)
+            print("%-40s %8d" % ("queues restored", len(event_queue.clients)))
+        finally:
+            self.reset()
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,198 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, Iterator, List, Optional, Text, Tuple
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+from django.db import connection
+from django.http import HttpRequest, QueryDict
+
+from zerver.lib.db import TimeTrackingCursor, reset_queries
+from zerver.models import Recipient, UserMessage, UserProfile, get_display_recipient, \
+    get_user_profile_by_email
+from zerver.views.messages import get_messages_backend, LARGER_THAN_MAX_MESSAGE_ID
+
+from contextlib import contextmanager
+
+import time
+import ujson
+
+class Command(BaseCommand):
+    help = """Time get_messages_backend for a fixed matrix of narrows.
+
+The narrows cover the NarrowBuilder operators, the home view with its
+muting conditions, and the first unread message.  Each is fetched
+--iterations times as --user, and we report latency percentiles, the
+number of database queries per request, and the EXPLAIN plan of the
+main query.  The stream, topic and users in the narrows are taken from
+the user's most recent messages.  Searches are answered from the
+search result cache after the first request, as they would be in
+production.
+
+With --populate, the database is first replaced by a synthetic realm
+(development only): populate_db with --messages messages, --users extra
+users, --streams extra streams, and --muted-topics muted topics per user.
+
+Usage: ./manage.py benchmark_narrow_queries [--populate --messages 100000 --users 500 --streams 100]"""
+
+    def add_arguments(self, parser):
+        # type: (CommandParser) -> None
+        parser.add_argument('--user', dest='user', default='hamlet@zulip.com',
+                            help="Email of the user to fetch messages as (default hamlet@zulip.com)")
+        parser.add_argument('--iterations', dest='iterations', type=int, default=20,
+                            help="Number of times to fetch each narrow (default 20)")
+        parser.add_argument('--num', dest='num', type=int, default=100,
+                            help="Number of messages to fetch per request (default 100)")
+        parser.add_argument('--search', dest='search', default='love',
+                            help="Search term for the search narrow (default 'love')")
+        parser.add_argument('--no-explain', dest='explain', action='store_false', default=True,
+                            help="Don't print the EXPLAIN plans")
+        parser.add_argument('--populate', dest='populate', action='store_true', default=False,
+                            help="Replace the database with a synthetic realm first")
+        parser.add_argument('--messages', dest='messages', type=int, default=10000,
+                            help="With --populate, number of messages (default 10000)")
+        parser.add_argument('--users', dest='users', type=int, default=100,
+                            help="With --populate, number of extra users (default 100)")
+        parser.add_argument('--streams', dest='streams', type=int, default=20,
+                            help="With --populate, number of extra streams (default 20)")
+        parser.add_argument('--muted-topics', dest='muted_topics', type=int, default=5,
+                            help="With --populate, number of topics each user mutes (default 5)")
+
+    def narrows(self, user_profile, search):
+        # type: (UserProfile, Text) -> List[Tuple[str, List[List[Text]]]]
+        def latest_message(recipient_type):
+            # type: (int) -> Optional[Any]
+            user_message = UserMessage.objects.filter(
+                user_profile=user_profile, message__recipient__type=recipient_type) \
+                .select_related('message', 'message__recipient', 'message__sender') \
+                .order_by('-message_id').first()
+            return user_message.message if user_message is not None else None
+
+        narrows = [
+            ("all messages", []),
+            ("in:home", [['in', 'home']]),
+            ("is:private", [['is', 'private']]),
+            ("is:starred", [['is', 'starred']]),
+            ("is:mentioned", [['is', 'mentioned']]),
+            ("has:link", [['has', 'link']]),
+            ("has:attachment", [['has', 'attachment']]),
+            ("has:image", [['has', 'image']]),
+            ("search", [['search', search]]),
+        ] # type: List[Tuple[str, List[List[Text]]]]
+
+        stream_message = latest_message(Recipient.STREAM)
+        if stream_message is not None:
+            stream_name = get_display_recipient(stream_message.recipient)
+            narrows += [
+                ("stream", [['stream', stream_name]]),
+                ("stream, topic", [['stream', stream_name],
+                                   ['topic', stream_message.subject]]),
+                ("stream, search", [['stream', stream_name], ['search', search]]),
+                ("sender", [['sender', stream_message.sender.email]]),
+            ]
+        personal_message = latest_message(Recipient.PERSONAL)
+        if personal_message is not None:
+            if personal_message.sender_id == user_profile.id:
+                other_email = get_display_recipient(personal_message.recipient)[0]['email']
+            else:
+                other_email = personal_message.sender.email
+            narrows.append(("pm-with", [['pm-with', other_email]]))
+        huddle_message = latest_message(Recipient.HUDDLE)
+        if huddle_message is not None:
+            other_emails = [member['email'] for member in get_display_recipient(huddle_message.recipient)
+                            if member['email'] != user_profile.email]
+            narrows.append(("group-pm-with", [['group-pm-with', other_emails[0]]]))
+        return narrows
+
+    @contextmanager
+    def captured_sql(self):
+        # type: () -> Iterator[List[Text]]
+        """Captures the SQL of the get_messages query."""
+        sql = [] # type: List[Text]
+        old_execute = TimeTrackingCursor.execute
+
+        def execute(cursor, query, vars=None):
+            # type: (TimeTrackingCursor, Text, Any) -> TimeTrackingCursor
+            if '/* get_messages */' in query:
+                sql.append(cursor.mogrify(query, vars).decode('utf-8'))
+            return old_execute(cursor, query, vars)
+
+        TimeTrackingCursor.execute = execute # type: ignore # monkey-patching
+        try:
+            yield sql
+        finally:
+            TimeTrackingCursor.execute = old_execute # type: ignore # monkey-patching
+
+    def get_messages(self, user_profile, params):
+        # type: (UserProfile, Dict[str, Any]) -> None
+        request = HttpRequest()
+        request.method = 'GET'
+        request.GET = QueryDict('', mutable=True)
+        for (name, value) in params.items():
+            request.GET[name] = ujson.dumps(value)
+        request._log_data = {} # type: ignore # Zulip-specific attribute
+        response = get_messages_backend(request, user_profile)
+        if response.status_code != 200:
+            raise CommandError("get_messages failed for %s: %s" % (params, response.content))
+
+    def time_narrow(self, user_profile, params, iterations):
+        # type: (UserProfile, Dict[str, Any], int) -> Tuple[List[float], int]
+        times = [] # type: List[float]
+        num_queries = 0
+        for i in range(iterations):
+            reset_queries()
+            start = time.time()
+            self.get_messages(user_profile, params)
+            times.append(time.time() - start)
+            num_queries = len(connection.connection.queries)
+        return (sorted(times), num_queries)
+
+    def explain(self, user_profile, params):
+        # type: (UserProfile, Dict[str, Any]) -> List[Text]
+        with self.captured_sql() as sql:
+            self.get_messages(user_profile, params)
+        plans = [] # type: List[Text]
+        cursor = connection.cursor()
+        for query in sql:
+            cursor.execute("EXPLAIN ANALYZE " + query)
+            plans.append('\n'.join(row[0] for row in cursor.fetchall()))
+        cursor.close()
+        return plans
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        if options['populate']:
+            if not settings.DEVELOPMENT:
+                raise CommandError("--populate replaces the database's contents, "
+                                   "so it is only available in development.")
+            call_command('populate_db', num_messages=options['messages'],
+                         extra_users=options['users'], extra_streams=options['streams'],
+                         muted_topics=options['muted_topics'])
+
+        user_profile = get_user_profile_by_email(options['user'])
+        num = options['num']
+        matrix = [(name, dict(narrow=narrow, anchor=LARGER_THAN_MAX_MESSAGE_ID,
+                              num_before=num, num_after=0))
+                  for (name, narrow) in self.narrows(user_profile, options['search'])]
+        matrix.append(("first unread", dict(narrow=[], anchor=0, num_before=num, num_after=num,
+                                            use_first_unread_anchor=True)))
+
+        def percentile(times, p):
+            # type: (List[float], int) -> float
+            return times[min(len(times) - 1, len(times) * p // 100)] * 1000
+
+        print("%-16s %8s %8s %8s %8s %8s" % ("narrow", "p50 ms", "p90 ms", "p99 ms",
+                                             "max ms", "queries"))
+        for (name, params) in matrix:
+            (times, num_queries) = self.time_narrow(user_profile, params, options['iterations'])
+            print("%-16s %8.1f %8.1f %8.1f %8.1f %8d" % (
+                name, percentile(times, 50), percentile(times, 90), percentile(times, 99),
+                times[-1] * 1000, num_queries))
+
+        if options['explain']:
+            for (name, params) in matrix:
+                print("\n=== %s: %s" % (name, ujson.dumps(params['narrow'])))
+                for plan in self.explain(user_profile, params):
+                    print(plan)
@@ -0,0 +1,97 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.tornado import event_queue
+from zerver.tornado.event_queue import ClientDescriptor, EventQueue, \
+    add_to_client_dicts, process_message_event
+
+import time
+
+class Command(BaseCommand):
+    help = """Time delivering public stream messages to narrowed event queues.
+
+Builds synthetic event queues in this process (nothing talks to the
+database or a running Tornado), each narrowed to one of --streams
+streams like a stream bot's queue, then delivers --messages messages
+round-robin to those streams.  It runs once with queues indexed by
+stream, and once with every narrowed queue checked for every message,
+which was the old behavior.
+
+Usage: ./manage.py benchmark_narrowed_queue_dispatch [--queues 10000] [--streams 100]"""
+
+    def add_arguments(self, parser):
+        # type: (CommandParser) -> None
+        parser.add_argument('--queues', dest='queues', type=int, default=10000,
+                            help="Number of narrowed event queues (default 10000)")
+        parser.add_argument('--streams', dest='streams', type=int, default=100,
+                            help="Number of streams the queues are narrowed to (default 100)")
+        parser.add_argument('--messages', dest='messages', type=int, default=100,
+                            help="Number of messages to deliver (default 100)")
+
+    def reset(self):
+        # type: () -> None
+        event_queue.clients.clear()
+        event_queue.user_clients.clear()
+        event_queue.realm_clients_all_streams.clear()
+        event_queue.realm_stream_clients.clear()
+        del event_queue.gc_heap[:]
+
+    def populate(self, num_queues, num_streams):
+        # type: (int, int) -> None
+        for i in range(num_queues):
+            queue_id = 'benchmark:%d' % (i,)
+            client = ClientDescriptor(i, 'bot%d@example.com' % (i,), 1, EventQueue(queue_id),
+                                      None, 'API', apply_markdown=False,
+                                      all_public_streams=True,
+                                      narrow=[['stream', 'stream%d' % (i % num_streams,)]])
+            event_queue.clients[queue_id] = client
+            add_to_client_dicts(client)
+
+    def message_events(self, num_messages, num_streams):
+        # type: (int, int) -> List[Dict[str, Any]]
+        events = []
+        for message_id in range(num_messages):
+            stream_name = 'stream%d' % (message_id % num_streams,)
+            message_dict = dict(id=message_id, type='stream', sender_id=0,
+                                sender_email='sender@example.com', client='website',
+                                display_recipient=stream_name, subject='benchmark',
+                                content='hello')
+            events.append(dict(type='message', realm_id=1, stream_name=stream_name,
+                               invite_only=False,
+                               message_dict_markdown=message_dict,
+                               message_dict_no_markdown=message_dict))
+        return events
+
+    def deliver(self, name, events):
+        # type: (str, List[Dict[str, Any]]) -> None
+        start = time.time()
+        for event in events:
+            process_message_event(event, [])
+        elapsed = time.time() - start
+        delivered = sum(len(client.event_queue.queue)
+                        for client in event_queue.clients.values())
+        print("%-30s %8.3fs (%.2fms/message, %d events delivered)" %
+              (name, elapsed, elapsed * 1000 / len(events), delivered))
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        events = self.message_events(options['messages'], options['streams'])
+        try:
+            self.reset()
+            self.populate(options['queues'], options['streams'])
+            self.deliver("stream-indexed dispatch", events)
+
+            self.reset()
+            self.populate(options['queues'], options['streams'])
+            # Move every narrowed queue to the realm-wide list, so that
+            # each one is checked against every message.
+            for clients in event_queue.realm_stream_clients.values():
+                event_queue.realm_clients_all_streams.setdefault(1, []).extend(clients)
+            event_queue.realm_stream_clients.clear()
+            self.deliver("scan all narrowed queues", events)
+        finally:
+            self.reset()
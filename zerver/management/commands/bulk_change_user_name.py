@@ -7,6 +7,7 @@ from argparse import ArgumentParser
 from django.core.management.base import BaseCommand
 
 from zerver.lib.actions import do_change_full_name
+from zerver.lib.cache import batched_cache_deletes
 from zerver.models import UserProfile, get_user_profile_by_email
 
 class Command(BaseCommand):
@@ -20,7 +21,7 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         # type: (*Any, **str) -> None
         data_file = options['data_file']
-        with open(data_file, "r") as f:
+        with open(data_file, "r") as f, batched_cache_deletes():
             for line in f:
                 email, new_name = line.strip().split(",", 1)
 
@@ -0,0 +1,59 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.cache import flush_cache_stats, get_cache_stats, reset_cache_stats
+
+import time
+
+class Command(BaseCommand):
+    help = """Report the cache's hit rates, value sizes and latency for each key family.
+
+A key's family is the part of the key before the first ':' (e.g.
+user_profile_by_email).  The totals cover all processes, which save
+them every minute or so (see record_cache_stats in zerver/lib/cache.py).
+
+Usage: ./manage.py cache_stats [--sort seconds] [--reset]"""
+
+    def add_arguments(self, parser):
+        # type: (CommandParser) -> None
+        parser.add_argument('--sort',
+                            dest='sort',
+                            default='seconds',
+                            choices=['calls', 'keys', 'bytes', 'seconds'],
+                            help="Total to sort the families by (default seconds)")
+        parser.add_argument('--reset',
+                            dest='reset',
+                            default=False,
+                            action='store_true',
+                            help="Clear the totals after reporting them")
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        flush_cache_stats()
+        (since, stats) = get_cache_stats()
+        if since is not None:
+            print("Since %s:" % (time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(since)),))
+
+        print("%-40s %-11s %10s %10s %7s %11s %9s %9s" % (
+            "family", "operation", "calls", "keys", "hit %", "bytes/key", "ms/call", "total s"))
+        for ((family, operation), totals) in sorted(stats.items(),
+                                                    key=lambda item: -item[1].get(options['sort'], 0)):
+            calls = totals.get('calls', 0)
+            keys = totals.get('keys', 0)
+            hit_rate = ''
+            if operation in ('get', 'get_many') and keys:
+                hit_rate = '%.1f' % (100 * totals.get('hits', 0) / keys,)
+            bytes_per_key = ''
+            if operation in ('set', 'set_many') and keys:
+                bytes_per_key = '%d' % (totals.get('bytes', 0) / keys,)
+            ms_per_call = 1000 * totals.get('seconds', 0) / calls if calls else 0
+            print("%-40s %-11s %10d %10d %7s %11s %9.2f %9.1f" % (
+                family, operation, calls, keys, hit_rate, bytes_per_key, ms_per_call,
+                totals.get('seconds', 0)))
+
+        if options['reset']:
+            reset_cache_stats()
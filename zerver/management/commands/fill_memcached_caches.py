@@ -3,20 +3,38 @@ from __future__ import absolute_import
 from typing import Any
 
 from argparse import ArgumentParser
-from django.core.management.base import BaseCommand
-from zerver.lib.cache_helpers import fill_remote_cache, cache_fillers
+from django.core.management.base import BaseCommand, CommandError
+from zerver.lib.cache_helpers import fill_remote_cache, fill_remote_caches_in_parallel, \
+    cache_fillers
 
 class Command(BaseCommand):
+    help = """Populate the memcached caches, e.g. after a restart.
+
+With --processes N (N > 1), the caches are filled by N worker
+processes, most recently active users and realms first.
+
+Usage: ./manage.py fill_memcached_caches [--cache user] [--processes 4]"""
+
     def add_arguments(self, parser):
         # type: (ArgumentParser) -> None
         parser.add_argument('--cache', dest="cache", default=None,
-                            help="Populate the memcached cache of messages.")
+                            help="Populate only this cache (one of %s)." %
+                            (", ".join(sorted(cache_fillers.keys())),))
+        parser.add_argument('--processes', dest="processes", type=int, default=4,
+                            help="Number of worker processes to fill the caches with (default 4).")
 
     def handle(self, *args, **options):
-        # type: (*Any, **str) -> None
+        # type: (*Any, **Any) -> None
         if options["cache"] is not None:
-            fill_remote_cache(options["cache"])
+            if options["cache"] not in cache_fillers:
+                raise CommandError("Unknown cache: %s" % (options["cache"],))
+            caches = [options["cache"]]
+        else:
+            caches = list(cache_fillers.keys())
+
+        if options["processes"] > 1:
+            fill_remote_caches_in_parallel(caches, options["processes"])
             return
 
-        for cache in cache_fillers.keys():
+        for cache in caches:
             fill_remote_cache(cache)
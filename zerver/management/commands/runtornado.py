@@ -21,6 +21,8 @@ from zerver.lib.queue import setup_tornado_rabbitmq
 from zerver.tornado.application import create_tornado_application
 from zerver.tornado.event_queue import add_client_gc_hook, \
     missedmessage_hook, process_notification, setup_event_queue
+from zerver.tornado.sharding import notify_tornado_queue_name, \
+    tornado_return_queue_name, tornado_sharding_enabled
 from zerver.tornado.socket import respond_send_message
 
 import logging
@@ -70,6 +72,13 @@ class Command(BaseCommand):
         if not port.isdigit():
             raise CommandError("%r is not a valid port number." % (port,))
 
+        if tornado_sharding_enabled():
+            if int(port) not in settings.TORNADO_SHARD_PORTS:
+                raise CommandError("Port %s is not listed in TORNADO_SHARD_PORTS." % (port,))
+            settings.TORNADO_SHARD = settings.TORNADO_SHARD_PORTS.index(int(port))
+            # Each shard persists its own event queues across restarts.
+            settings.JSON_PERSISTENT_QUEUE_FILENAME += ".%d" % (settings.TORNADO_SHARD,)
+
         xheaders = options.get('xheaders', True)
         no_keep_alive = options.get('no_keep_alive', False)
         quit_command = 'CTRL-C'
@@ -93,8 +102,10 @@ class Command(BaseCommand):
             if settings.USING_RABBITMQ:
                 queue_client = get_queue_client()
                 # Process notifications received via RabbitMQ
-                queue_client.register_json_consumer('notify_tornado', process_notification)
-                queue_client.register_json_consumer('tornado_return', respond_send_message)
+                queue_client.register_json_consumer(
+                    notify_tornado_queue_name(settings.TORNADO_SHARD), process_notification)
+                queue_client.register_json_consumer(
+                    tornado_return_queue_name(settings.TORNADO_SHARD), respond_send_message)
 
             try:
                 # Application is an instance of Django's standard wsgi handler.
@@ -0,0 +1,55 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError, CommandParser
+
+from zerver.tornado.event_queue import requests_client
+from zerver.tornado.sharding import get_tornado_shard_count, get_tornado_uri
+
+import ujson
+
+class Command(BaseCommand):
+    help = """Report the memory used by each event queue in the Tornado server(s).
+
+Queues are listed largest first; sizes are the estimated encoded size of
+their pending events.
+
+Usage: ./manage.py tornado_queue_stats [--limit 50]"""
+
+    def add_arguments(self, parser):
+        # type: (CommandParser) -> None
+        parser.add_argument('-n', '--limit',
+                            dest='limit',
+                            type=int,
+                            default=50,
+                            help="Number of queues to list per shard (default 50)")
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        if settings.TORNADO_SERVER is None:
+            raise CommandError("No Tornado server is configured (TORNADO_SERVER is None).")
+
+        for shard in range(get_tornado_shard_count()):
+            tornado_uri = get_tornado_uri(shard)
+            resp = requests_client.post(tornado_uri + '/tornado_queue_stats',
+                                        data=dict(secret=settings.SHARED_SECRET))
+            resp.raise_for_status()
+            stats = ujson.loads(resp.text)
+            queues = sorted(stats['queues'], key=lambda queue: -queue['bytes'])
+
+            print("%s: %d queues, %d bytes in queues (limit %d per queue), "
+                  "%d bytes of shared message payloads" %
+                  (tornado_uri, len(queues), sum(queue['bytes'] for queue in queues),
+                   stats['max_queue_bytes'], stats['shared_payload_bytes']))
+            print("%-30s %10s %8s %10s %9s  %s" % ("queue id", "bytes", "events",
+                                                   "user id", "idle secs", "client"))
+            for queue in queues[:options['limit']]:
+                print("%-30s %10d %8d %10d %9d  %s%s" % (
+                    queue['queue_id'], queue['bytes'], queue['events'],
+                    queue['user_profile_id'], queue['idle_secs'],
+                    queue['client_type_name'],
+                    " (connected)" if queue['connected'] else ""))
+            print()
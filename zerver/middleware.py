@@ -17,6 +17,8 @@ from zerver.lib.cache import get_remote_cache_time, get_remote_cache_requests
 from zerver.lib.bugdown import get_bugdown_time, get_bugdown_requests
 from zerver.models import flush_per_request_caches, get_realm
 from zerver.exceptions import RateLimited
+from zerver.tornado.notification_batch import finish_notification_batch, \
+    flush_notification_batch, notification_batch_open, start_notification_batch
 from django.contrib.sessions.middleware import SessionMiddleware
 from django.views.csrf import csrf_failure as html_csrf_failure
 from django.utils.cache import patch_vary_headers
@@ -347,6 +349,37 @@ class FlushDisplayRecipientCache(object):
         flush_per_request_caches()
         return response
 
+class BatchTornadoNotifications(object):
+    """Sends the events produced while handling a request to Tornado in
+    one batch per Tornado server; see zerver.tornado.notification_batch."""
+    def process_request(self, request):
+        # type: (HttpRequest) -> None
+        if settings.RUNNING_INSIDE_TORNADO:
+            return
+        if notification_batch_open():
+            # A previous request on this thread ended without its
+            # batch being finished; don't hold its events hostage.
+            flush_notification_batch()
+        start_notification_batch()
+        request._notification_batch = True
+
+    def process_response(self, request, response):
+        # type: (HttpRequest, HttpResponse) -> HttpResponse
+        if getattr(request, '_notification_batch', False):
+            request._notification_batch = False
+            finish_notification_batch()
+        return response
+
+    def process_exception(self, request, exception):
+        # type: (HttpRequest, Exception) -> None
+        # If no middleware turns the exception into a response,
+        # process_response isn't called; send the events for whatever
+        # the view already committed now, not with this thread's next
+        # request.
+        if getattr(request, '_notification_batch', False):
+            request._notification_batch = False
+            finish_notification_batch()
+
 class SessionHostDomainMiddleware(SessionMiddleware):
     def process_response(self, request, response):
         # type: (HttpRequest, HttpResponse) -> HttpResponse
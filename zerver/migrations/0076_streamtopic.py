@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zerver', '0075_attachment_path_id_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StreamTopic',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('topic_name', models.CharField(max_length=60)),
+                ('canonical_name', models.CharField(max_length=60)),
+                ('last_message_id', models.IntegerField()),
+                ('message_count', models.IntegerField(default=0)),
+                ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='zerver.Recipient')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='streamtopic',
+            unique_together=set([('recipient', 'canonical_name')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='streamtopic',
+            index_together=set([('recipient', 'last_message_id')]),
+        ),
+        # Index the existing stream messages; see zerver/lib/topic_index.py.
+        migrations.RunSQL('''
+            INSERT INTO zerver_streamtopic
+                (recipient_id, topic_name, canonical_name, last_message_id, message_count)
+            SELECT zerver_message.recipient_id,
+                   (array_agg(zerver_message.subject ORDER BY zerver_message.id DESC))[1],
+                   lower(zerver_message.subject), max(zerver_message.id), count(*)
+            FROM zerver_message
+            INNER JOIN zerver_recipient ON zerver_message.recipient_id = zerver_recipient.id
+            WHERE zerver_recipient.type = 2
+            GROUP BY zerver_message.recipient_id, lower(zerver_message.subject);
+        ''', reverse_sql='DELETE FROM zerver_streamtopic;'),
+        # Used for the unread counts in get_topic_history_for_stream.
+        migrations.RunSQL('''
+            CREATE INDEX zerver_usermessage_unread_message_id
+            ON zerver_usermessage (user_profile_id, message_id)
+            WHERE (flags & 1) = 0;
+        ''', reverse_sql='DROP INDEX zerver_usermessage_unread_message_id;'),
+    ]
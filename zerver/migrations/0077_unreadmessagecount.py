@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zerver', '0076_streamtopic'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadMessageCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('topic', models.CharField(max_length=60)),
+                ('count', models.IntegerField(default=0)),
+                ('recipient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='zerver.Recipient')),
+                ('user_profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='unreadmessagecount',
+            unique_together=set([('user_profile', 'recipient', 'topic')]),
+        ),
+        # Count the existing unread messages; see zerver/lib/unread_counts.py.
+        migrations.RunSQL('''
+            INSERT INTO zerver_unreadmessagecount (user_profile_id, recipient_id, topic, count)
+            SELECT zerver_usermessage.user_profile_id,
+                   CASE WHEN zerver_recipient.type = 1 THEN sender_recipient.id
+                        ELSE zerver_message.recipient_id END,
+                   CASE WHEN zerver_recipient.type = 2 THEN lower(zerver_message.subject)
+                        ELSE '' END,
+                   count(*)
+            FROM zerver_usermessage
+            INNER JOIN zerver_message ON zerver_usermessage.message_id = zerver_message.id
+            INNER JOIN zerver_recipient ON zerver_message.recipient_id = zerver_recipient.id
+            LEFT OUTER JOIN zerver_recipient sender_recipient ON (
+                sender_recipient.type = 1 AND sender_recipient.type_id = zerver_message.sender_id
+            )
+            WHERE (zerver_usermessage.flags & 1) = 0
+            GROUP BY 1, 2, 3;
+        ''', reverse_sql='DELETE FROM zerver_unreadmessagecount;'),
+    ]
@@ -21,7 +21,8 @@ from zerver.lib.cache import cache_with_key, flush_user_profile, flush_realm, \
     display_recipient_cache_key, cache_delete, \
     get_stream_cache_key, active_user_dicts_in_realm_cache_key, \
     bot_dicts_in_realm_cache_key, active_user_dict_fields, \
-    bot_dict_fields, flush_message
+    bot_dict_fields, flush_message, stream_subscribers_cache_key, \
+    pack_stream_subscribers, unpack_stream_subscribers
 from zerver.lib.utils import make_safe_digest, generate_random_token
 from zerver.lib.str_utils import ModelReprMixin
 from django.db import transaction
@@ -896,7 +897,8 @@ def get_client_remote_cache(name):
     return client
 
 # get_stream_backend takes either a realm id or a realm
-@cache_with_key(get_stream_cache_key, timeout=3600*24*7)
+@cache_with_key(get_stream_cache_key, timeout=3600*24*7,
+                single_flight=True, early_refresh=True)
 def get_stream_backend(stream_name, realm):
     # type: (Text, Realm) -> Stream
     return Stream.objects.select_related("realm").get(
@@ -1153,6 +1155,39 @@ def get_context_for_message(message):
 
 post_save.connect(flush_message, sender=Message)
 
+# One row per topic of each stream, maintained as messages are sent,
+# moved between topics and deleted (see zerver/lib/topic_index.py), so
+# that listing a stream's topics doesn't aggregate over its messages.
+# Topics are case-insensitive; canonical_name is the name as lowercased
+# by Postgres (see canonical_topic_name), and topic_name the name as of
+# the most recent message.
+class StreamTopic(models.Model):
+    recipient = models.ForeignKey(Recipient) # type: Recipient
+    topic_name = models.CharField(max_length=MAX_SUBJECT_LENGTH) # type: Text
+    canonical_name = models.CharField(max_length=MAX_SUBJECT_LENGTH) # type: Text
+    last_message_id = models.IntegerField() # type: int
+    message_count = models.IntegerField(default=0) # type: int
+
+    class Meta(object):
+        unique_together = ("recipient", "canonical_name")
+        index_together = ("recipient", "last_message_id")
+
+# Each user's number of unread messages per conversation, maintained
+# as messages are sent and flagged read or unread (see
+# zerver/lib/unread_counts.py), so that unread counts don't require
+# scanning the user's UserMessage rows.  A conversation is a stream
+# topic (recipient is the stream's, topic its canonical name), a
+# huddle, or, for 1:1 private messages, the other user (recipient is
+# that user's personal recipient); topic is '' for private messages.
+class UnreadMessageCount(models.Model):
+    user_profile = models.ForeignKey(UserProfile) # type: UserProfile
+    recipient = models.ForeignKey(Recipient) # type: Recipient
+    topic = models.CharField(max_length=MAX_SUBJECT_LENGTH) # type: Text
+    count = models.IntegerField(default=0) # type: int
+
+    class Meta(object):
+        unique_together = ("user_profile", "recipient", "topic")
+
 class Reaction(ModelReprMixin, models.Model):
     user_profile = models.ForeignKey(UserProfile) # type: UserProfile
     message = models.ForeignKey(Message) # type: Message
@@ -1324,23 +1359,64 @@ class Subscription(ModelReprMixin, models.Model):
         # type: () -> Text
         return u"<Subscription: %r -> %s>" % (self.user_profile, self.recipient)
 
-@cache_with_key(user_profile_by_id_cache_key, timeout=3600*24*7)
+@cache_with_key(user_profile_by_id_cache_key, timeout=3600*24*7,
+                single_flight=True, early_refresh=True)
 def get_user_profile_by_id(uid):
     # type: (int) -> UserProfile
     return UserProfile.objects.select_related().get(id=uid)
 
-@cache_with_key(user_profile_by_email_cache_key, timeout=3600*24*7)
+def bulk_get_stream_subscribers(stream_ids):
+    # type: (List[int]) -> Dict[int, List[Tuple[int, Text, bool]]]
+    """Returns the (id, email, enable_online_push_notifications) of the
+    active users with an active subscription to each of the given
+    streams, sorted by id.  These are cached under
+    stream_subscribers_cache_key; bulk_add_subscriptions and
+    bulk_remove_subscriptions refresh them, and changes to the users
+    invalidate them (see flush_user_profile)."""
+    def query_function(stream_ids):
+        # type: (List[int]) -> List[Tuple[int, List[Tuple[int, Text, bool]]]]
+        subscribers = {stream_id: [] for stream_id in stream_ids} # type: Dict[int, List[Tuple[int, Text, bool]]]
+        rows = Subscription.objects.filter(
+            recipient__type=Recipient.STREAM,
+            recipient__type_id__in=stream_ids,
+            user_profile__is_active=True,
+            active=True).values_list('recipient__type_id', 'user_profile_id',
+                                     'user_profile__email',
+                                     'user_profile__enable_online_push_notifications')
+        for (stream_id, user_profile_id, email, push_enabled) in rows:
+            subscribers[stream_id].append((user_profile_id, email, push_enabled))
+        return list(subscribers.items())
+
+    return generic_bulk_cached_fetch(stream_subscribers_cache_key,
+                                     query_function,
+                                     stream_ids,
+                                     extractor=unpack_stream_subscribers,
+                                     setter=pack_stream_subscribers,
+                                     id_fetcher=lambda row: row[0],
+                                     cache_transformer=lambda row: sorted(row[1]))
+
+def bulk_get_active_subscriber_ids(stream_ids):
+    # type: (List[int]) -> Dict[int, List[int]]
+    """The sorted ids of the active subscribers of each of the given
+    streams; see bulk_get_stream_subscribers."""
+    return {stream_id: [subscriber[0] for subscriber in subscribers]
+            for (stream_id, subscribers) in bulk_get_stream_subscribers(stream_ids).items()}
+
+@cache_with_key(user_profile_by_email_cache_key, timeout=3600*24*7,
+                single_flight=True, early_refresh=True)
 def get_user_profile_by_email(email):
     # type: (Text) -> UserProfile
     return UserProfile.objects.select_related().get(email__iexact=email.strip())
 
-@cache_with_key(active_user_dicts_in_realm_cache_key, timeout=3600*24*7)
+@cache_with_key(active_user_dicts_in_realm_cache_key, timeout=3600*24*7,
+                single_flight=True, early_refresh=True)
 def get_active_user_dicts_in_realm(realm):
     # type: (Realm) -> List[Dict[str, Any]]
     return UserProfile.objects.filter(realm=realm, is_active=True) \
                               .values(*active_user_dict_fields)
 
-@cache_with_key(bot_dicts_in_realm_cache_key, timeout=3600*24*7)
+@cache_with_key(bot_dicts_in_realm_cache_key, timeout=3600*24*7,
+                single_flight=True, early_refresh=True)
 def get_bot_dicts_in_realm(realm):
     # type: (Realm) -> List[Dict[str, Any]]
     return UserProfile.objects.filter(realm=realm, is_bot=True).values(*bot_dict_fields)
@@ -3,8 +3,10 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 from zerver.lib.alert_words import (
+    AlertWordMatcher,
     add_user_alert_words,
     alert_words_in_realm,
+    get_alert_word_matcher,
     remove_user_alert_words,
     user_alert_words,
 )
@@ -114,6 +116,26 @@ class AlertWordTests(ZulipTestCase):
                          self.interesting_alert_word_list)
         self.assertEqual(realm_words[user2.id], ['another'])
 
+    def test_alert_word_matcher(self):
+        # type: () -> None
+        matcher = AlertWordMatcher(['alert', 'Alert', 'multi-word word', u'☃', 'he', 'she'])
+        self.assertEqual(matcher.find_words(u'(alert) and she'), {'alert', 'Alert', 'she'})
+        self.assertEqual(matcher.find_words(u'alerts: ashe, "multi-word word"'), {'multi-word word'})
+        self.assertEqual(matcher.find_words(u'☃!\n*he*'), {u'☃', 'he'})
+        self.assertEqual(matcher.find_words(u'she\'s'), {'she'})
+        self.assertEqual(matcher.find_words(u'shell'), set())
+
+        user = get_user_profile_by_email("cordelia@zulip.com")
+        add_user_alert_words(user, ['alert'])
+        realm_words = alert_words_in_realm(user.realm)
+        matcher = get_alert_word_matcher(user.realm_id, realm_words)
+        self.assertIs(get_alert_word_matcher(user.realm_id, alert_words_in_realm(user.realm)),
+                      matcher)
+        add_user_alert_words(user, ['another'])
+        new_matcher = get_alert_word_matcher(user.realm_id, alert_words_in_realm(user.realm))
+        self.assertIsNot(new_matcher, matcher)
+        self.assertEqual(new_matcher.find_words(u'another alert'), {'alert', 'another'})
+
     def test_json_list_default(self):
         # type: () -> None
         self.login("hamlet@zulip.com")
@@ -14,6 +14,7 @@ from zerver.lib.actions import (
 from zerver.lib.alert_words import alert_words_in_realm
 from zerver.lib.camo import get_camo_url
 from zerver.lib.message import render_markdown
+from zerver.lib.render_pool import render_markdown_batch
 from zerver.lib.request import (
     JsonableError,
 )
@@ -38,6 +39,7 @@ from zerver.models import (
 )
 
 import copy
+import pickle
 import mock
 import os
 import ujson
@@ -45,7 +47,7 @@ import six
 
 from six.moves import urllib
 from zerver.lib.str_utils import NonBinaryStr
-from typing import Any, AnyStr, Dict, List, Optional, Tuple, Text
+from typing import Any, AnyStr, Dict, List, Optional, Set, Tuple, Text
 
 class FencedBlockPreprocessorTest(TestCase):
     def test_simple_quoting(self):
@@ -969,6 +971,63 @@ class BugdownErrorTests(ZulipTestCase):
                 self.send_message("othello@zulip.com", "Denmark", Recipient.STREAM, message)
 
 
+class FakeAsyncResult(object):
+    def __init__(self, value):
+        # type: (Any) -> None
+        self.value = value
+
+    def get(self, timeout=None):
+        # type: (Optional[float]) -> Any
+        return self.value
+
+class FakeRenderPool(object):
+    """Runs jobs inline, but on a pickled copy of their arguments, the
+    way a real worker process would see them."""
+    def apply_async(self, func, args):
+        # type: (Any, Tuple[Any, ...]) -> FakeAsyncResult
+        return FakeAsyncResult(func(*pickle.loads(pickle.dumps(args))))
+
+class RenderPoolTest(ZulipTestCase):
+    def make_job(self, content):
+        # type: (Text) -> Tuple[Message, Text, Realm, Dict[int, List[Text]], Set[int]]
+        sender = get_user_profile_by_email("othello@zulip.com")
+        hamlet = get_user_profile_by_email("hamlet@zulip.com")
+        msg = Message(sender=sender, sending_client=get_client("test"))
+        return (msg, content, sender.realm, alert_words_in_realm(sender.realm),
+                {sender.id, hamlet.id})
+
+    def test_render_in_pool(self):
+        # type: () -> None
+        hamlet = get_user_profile_by_email("hamlet@zulip.com")
+        do_set_alert_words(hamlet, ["scaryword"])
+        jobs = [self.make_job(u'@**King Hamlet** scaryword'),
+                self.make_job(u'/me is **bold**'),
+                self.make_job(u'@all')]
+        with mock.patch('zerver.lib.render_pool.get_render_pool',
+                        return_value=FakeRenderPool()):
+            rendered = render_markdown_batch(jobs)
+
+        serial = [render_markdown(msg, content, realm=realm,
+                                  realm_alert_words=realm_alert_words,
+                                  message_user_ids=user_ids)
+                  for (msg, content, realm, realm_alert_words, user_ids)
+                  in [self.make_job(job[1]) for job in jobs]]
+        self.assertEqual(rendered, serial)
+
+        self.assertEqual(jobs[0][0].mentions_user_ids, {hamlet.id})
+        self.assertEqual(jobs[0][0].user_ids_with_alert_words, {hamlet.id})
+        self.assertTrue(jobs[1][0].is_me_message)
+        self.assertTrue(jobs[2][0].mentions_wildcard)
+
+    def test_render_in_pool_failure(self):
+        # type: () -> None
+        jobs = [self.make_job(u'one'), self.make_job(u'two')]
+        with mock.patch('zerver.lib.render_pool.get_render_pool',
+                        return_value=FakeRenderPool()), \
+                self.simulated_markdown_failure():
+            with self.assertRaises(bugdown.BugdownRenderingException):
+                render_markdown_batch(jobs)
+
 class BugdownAvatarTestCase(ZulipTestCase):
     def test_avatar_with_id(self):
         # type: () -> None
@@ -10,6 +10,7 @@ from django.conf import settings
 from zerver.lib.actions import do_deactivate_realm, do_deactivate_user, \
     do_reactivate_user, do_reactivate_realm
 from zerver.lib.initial_password import initial_password
+from zerver.lib.sessions import user_sessions
 from zerver.lib.test_helpers import (
     HostRequestMock,
 )
@@ -581,6 +582,14 @@ class DeactivatedRealmTest(ZulipTestCase):
                                   **self.api_auth("hamlet@zulip.com"))
         self.assert_json_error_contains(result, "has been deactivated", status_code=401)
 
+    def test_deactivate_realm_deletes_sessions(self):
+        # type: () -> None
+        hamlet = get_user_profile_by_email("hamlet@zulip.com")
+        self.login("hamlet@zulip.com")
+        self.assertEqual(len(user_sessions(hamlet)), 1)
+        do_deactivate_realm(get_realm("zulip"))
+        self.assertEqual(user_sessions(hamlet), [])
+
     def test_fetch_api_key_deactivated_realm(self):
         # type: () -> None
         """
@@ -3,7 +3,7 @@
 # high-level documentation on how this system works.
 from __future__ import absolute_import
 from __future__ import print_function
-from typing import Any, Callable, Dict, List, Optional, Union, Text, Tuple
+from typing import Any, Callable, Dict, List, Mapping, Optional, Union, Text, Tuple
 
 from django.conf import settings
 from django.http import HttpRequest, HttpResponse
@@ -78,7 +78,9 @@ from zerver.lib.events import (
     fetch_initial_state_data,
 )
 from zerver.lib.message import render_markdown
-from zerver.lib.test_helpers import POSTRequestMock, get_subscription
+from zerver.middleware import BatchTornadoNotifications
+from zerver.lib.cache import cache_delete, presence_refresh_cache_key
+from zerver.lib.test_helpers import POSTRequestMock, get_subscription, queries_captured
 from zerver.lib.test_classes import (
     ZulipTestCase,
 )
@@ -89,11 +91,27 @@ from zerver.lib.validator import (
 
 from zerver.views.events_register import _default_all_public_streams, _default_narrow
 
-from zerver.tornado.event_queue import allocate_client_descriptor, EventQueue
+from zerver.tornado.event_queue import allocate_client_descriptor, ClientDescriptor, \
+    EventQueue, gc_event_queues, gc_heap, get_client_descriptor, get_tornado_stats, \
+    get_client_descriptors_for_realm_all_streams, get_client_descriptors_for_realm_stream, \
+    get_client_descriptors_for_user, \
+    process_notification, send_event
+from zerver.tornado.notification_batch import batched_notifications, notification_batch_open
+from zerver.tornado.presence import user_is_idle, user_presences
+from zerver.tornado.stats import fanout_stats, percentiles
+from zerver.tornado.message_payload import MessagePayload, encode_events, expand_event
+from zerver.tornado.queue_snapshot import SnapshotFormatError, SnapshotWriter, \
+    is_snapshot, read_snapshot
+from zerver.tornado.sharding import get_shard_for_queue_id, get_tornado_uri, get_user_shard, \
+    notify_tornado_queue_name, partition_users_by_shard, tornado_sharding_enabled
 from zerver.tornado.views import get_events_backend
 
 from collections import OrderedDict
+import datetime
 import mock
+import os
+import shutil
+import tempfile
 import time
 import ujson
 from six.moves import range
@@ -302,6 +320,28 @@ class GetEventsTest(ZulipTestCase):
         self.assertEqual(events[0]["type"], "message")
         self.assertEqual(events[0]["message"]["display_recipient"], "Denmark")
 
+    def test_narrowed_queue_stream_index(self):
+        # type: () -> None
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        client = allocate_client_descriptor(
+            dict(user_profile_id = user_profile.id,
+                 user_profile_email = user_profile.email,
+                 realm_id = user_profile.realm_id,
+                 event_types = ["message"],
+                 client_type_name = "website",
+                 apply_markdown = True,
+                 all_public_streams = False,
+                 queue_timeout = 600,
+                 last_connection_time = time.time(),
+                 narrow = [["stream", "Denmark"]]))
+        self.assertIn(client, get_client_descriptors_for_realm_stream(user_profile.realm_id,
+                                                                      "denmark"))
+        self.assertNotIn(client, get_client_descriptors_for_realm_all_streams(
+            user_profile.realm_id))
+        client.cleanup()
+        self.assertNotIn(client, get_client_descriptors_for_realm_stream(user_profile.realm_id,
+                                                                         "denmark"))
+
 class EventsRegisterTest(ZulipTestCase):
     user_profile = get_user_profile_by_email("hamlet@zulip.com")
     maxDiff = None # type: Optional[int]
@@ -343,7 +383,8 @@ class EventsRegisterTest(ZulipTestCase):
         # normal_state = do action then fetch at the end (the "normal" code path)
         hybrid_state = fetch_initial_state_data(self.user_profile, event_types, "", include_subscribers=include_subscribers)
         action()
-        events = client.event_queue.contents()
+        # Expand shared message payloads into the dicts clients receive.
+        events = [expand_event(event) for event in client.event_queue.contents()]
         self.assertTrue(len(events) == num_events)
 
         before = ujson.dumps(hybrid_state)
@@ -1682,6 +1723,34 @@ class EventQueueTest(TestCase):
                            "messages": [1, 2, 3, 4, 5, 6],
                            "timestamp": "1"}])
 
+    def test_flag_add_remove_cancelling(self):
+        # type: () -> None
+        queue = EventQueue("1")
+        for (operation, messages) in [("add", list(range(1, 1001))),
+                                      ("add", list(range(500, 1001))),
+                                      ("remove", [10, 11, 12]),
+                                      ("add", [11]),
+                                      ("remove", [2000])]:
+            queue.push({"type": "update_message_flags",
+                        "flag": "read",
+                        "operation": operation,
+                        "all": False,
+                        "messages": messages,
+                        "timestamp": "1"})
+        self.assertEqual(queue.virtual_events["flags/add/read"]["message_ranges"],
+                         [[1, 9], [11, 1000]])
+        self.assertEqual(queue.virtual_events["flags/remove/read"]["message_ranges"],
+                         [[10, 10], [12, 12], [2000, 2000]])
+
+        # Survives a save and restore, and expands to plain id lists.
+        queue = EventQueue.from_dict(ujson.loads(ujson.dumps(queue.to_dict())))
+        contents = queue.contents()
+        self.assertEqual([(event["id"], event["operation"]) for event in contents],
+                         [(3, "add"), (4, "remove")])
+        self.assertEqual(contents[0]["messages"], [1, 2, 3, 4, 5, 6, 7, 8, 9] +
+                         list(range(11, 1001)))
+        self.assertEqual(contents[1]["messages"], [10, 12, 2000])
+
     def test_collapse_event(self):
         # type: () -> None
         queue = EventQueue("1")
@@ -1699,6 +1768,268 @@ class EventQueueTest(TestCase):
                            'type': 'unknown',
                            "timestamp": "1"}])
 
+    def test_shared_message_payload(self):
+        # type: () -> None
+        payload = MessagePayload({"id": 5, "content": "hello"}, is_mentioned=True)
+        queue = EventQueue("1")
+        queue.push({"type": "message", "message": payload, "flags": ["mentioned"]})
+        queue.push({"type": "message", "message": payload, "flags": ["mentioned"],
+                    "local_message_id": "1.1"})
+        contents = queue.contents()
+        self.assertEqual(contents[0]["message"]["is_mentioned"], True)
+        self.assertIs(contents[0]["message"], contents[1]["message"])
+        self.assertEqual(ujson.loads(encode_events(contents)),
+                         [{"id": 0, "type": "message", "flags": ["mentioned"],
+                           "message": {"id": 5, "content": "hello", "is_mentioned": True}},
+                          {"id": 1, "type": "message", "flags": ["mentioned"],
+                           "local_message_id": "1.1",
+                           "message": {"id": 5, "content": "hello", "is_mentioned": True}}])
+        self.assertEqual(EventQueue.from_dict(queue.to_dict()).contents()[0]["message"],
+                         {"id": 5, "content": "hello", "is_mentioned": True})
+
+    def test_byte_budget_collapse(self):
+        # type: () -> None
+        queue = EventQueue("1")
+        with self.settings(EVENT_QUEUE_MAX_BYTES=200):
+            queue.push({"type": "unknown", "data": "x" * 50})
+            self.assertEqual(queue.byte_size, len(ujson.dumps(queue.queue[0])))
+            queue.prune(0)
+            self.assertEqual(queue.byte_size, 0)
+            # Each event is 85 bytes, so the third one overflows the budget.
+            for i in range(3):
+                queue.push({"type": "unknown", "data": "x" * 50})
+        self.assertEqual(queue.byte_size, 0)
+        self.assertEqual(queue.contents(),
+                         [{"id": 4,
+                           "type": "restart",
+                           "server_generation": settings.SERVER_GENERATION,
+                           "immediate": True}])
+
+class EventQueueGCTest(ZulipTestCase):
+    def allocate_queue(self):
+        # type: () -> ClientDescriptor
+        user_profile = get_user_profile_by_email('hamlet@zulip.com')
+        return allocate_client_descriptor(
+            dict(user_profile_id = user_profile.id,
+                 user_profile_email = user_profile.email,
+                 realm_id = user_profile.realm_id,
+                 event_types = None,
+                 client_type_name = "website",
+                 apply_markdown = True,
+                 all_public_streams = False,
+                 queue_timeout = 600,
+                 last_connection_time = time.time(),
+                 narrow = []))
+
+    def test_gc_expired_queues(self):
+        # type: () -> None
+        idle_client = self.allocate_queue()
+        active_client = self.allocate_queue()
+        later = time.time() + 601
+        # Reconnected recently, so its original heap entry is stale.
+        active_client.last_connection_time = later - 10
+
+        with mock.patch('zerver.tornado.event_queue.time.time', return_value=later), \
+                mock.patch('zerver.tornado.event_queue.statsd') as statsd:
+            gc_event_queues()
+
+        self.assertIsNone(get_client_descriptor(idle_client.event_queue.id))
+        self.assertIs(get_client_descriptor(active_client.event_queue.id), active_client)
+        self.assertIn((active_client.expiry_time(), active_client.event_queue.id), gc_heap)
+        statsd.timing.assert_called_once_with('tornado.gc_event_queues.pause', mock.ANY)
+        active_client.cleanup()
+
+    def test_event_size_estimated_once_per_event(self):
+        # type: () -> None
+        clients = [self.allocate_queue() for i in range(3)]
+        user_profile_id = clients[0].user_profile_id
+        with mock.patch('zerver.tornado.event_queue.estimate_event_size',
+                        return_value=10) as m:
+            process_notification(dict(event=dict(type='unknown'), users=[user_profile_id]))
+        m.assert_called_once_with(dict(type='unknown'))
+        for client in clients:
+            self.assertEqual(client.event_queue.byte_size, 10)
+            client.cleanup()
+
+    def test_event_size_not_estimated_without_queues(self):
+        # type: () -> None
+        with mock.patch('zerver.tornado.event_queue.estimate_event_size') as m:
+            process_notification(dict(event=dict(type='unknown'), users=[-1]))
+        self.assertFalse(m.called)
+
+class NotificationBatchTest(ZulipTestCase):
+    def test_batched_notifications(self):
+        # type: () -> None
+        with mock.patch('zerver.tornado.event_queue.send_notification') as m:
+            with batched_notifications():
+                send_event(dict(type='pointer', pointer=1), [1])
+                with batched_notifications():
+                    send_event(dict(type='pointer', pointer=2), [2])
+                self.assertFalse(m.called)
+            m.assert_called_once_with(
+                dict(notices=[dict(event=dict(type='pointer', pointer=1), users=[1]),
+                              dict(event=dict(type='pointer', pointer=2), users=[2])]),
+                0)
+
+            m.reset_mock()
+            send_event(dict(type='pointer', pointer=3), [3])
+            m.assert_called_once_with(dict(event=dict(type='pointer', pointer=3), users=[3]), 0)
+
+    def test_request_events_sent_as_one_batch(self):
+        # type: () -> None
+        events = [] # type: List[Mapping[str, Any]]
+        with mock.patch('zerver.tornado.event_queue.send_notification',
+                        side_effect=lambda notice, shard: events.append(notice)):
+            result = self.common_subscribe_to_streams("hamlet@zulip.com", ["new stream"])
+        self.assert_json_success(result)
+        self.assertEqual(len(events), 1)
+        self.assertGreater(len(events[0]['notices']), 1)
+
+    def test_batched_events_copied(self):
+        # type: () -> None
+        events = [] # type: List[Mapping[str, Any]]
+        event = dict(type='pointer', pointer=1)
+        with mock.patch('zerver.tornado.event_queue.send_notification',
+                        side_effect=lambda notice, shard: events.append(notice)):
+            with batched_notifications():
+                send_event(event, [1])
+                event['pointer'] = 2
+        self.assertEqual(events[0]['event'], dict(type='pointer', pointer=1))
+
+    def test_process_notification_batch(self):
+        # type: () -> None
+        with mock.patch('zerver.tornado.event_queue.process_event') as m:
+            process_notification(dict(notices=[dict(event=dict(type='pointer'), users=[1]),
+                                               dict(event=dict(type='pointer'), users=[2])]))
+        self.assertEqual(m.call_count, 2)
+
+    def test_batch_sent_when_view_raises(self):
+        # type: () -> None
+        middleware = BatchTornadoNotifications()
+        request = POSTRequestMock({}, None)
+        events = [] # type: List[Mapping[str, Any]]
+        with mock.patch('zerver.tornado.event_queue.send_notification',
+                        side_effect=lambda notice, shard: events.append(notice)):
+            middleware.process_request(request)
+            send_event(dict(type='pointer', pointer=1), [1])
+            self.assertEqual(events, [])
+            middleware.process_exception(request, Exception())
+        self.assertEqual(len(events), 1)
+        self.assertFalse(notification_batch_open())
+
+class TornadoStatsTest(ZulipTestCase):
+    def test_fanout_stats(self):
+        # type: () -> None
+        user_profile = get_user_profile_by_email('hamlet@zulip.com')
+        client = allocate_client_descriptor(
+            dict(user_profile_id = user_profile.id,
+                 user_profile_email = user_profile.email,
+                 realm_id = user_profile.realm_id,
+                 event_types = None,
+                 client_type_name = "website",
+                 apply_markdown = True,
+                 all_public_streams = False,
+                 queue_timeout = 600,
+                 last_connection_time = time.time(),
+                 narrow = []))
+        fanout_stats.pop('pointer', None)
+        process_notification(dict(event=dict(type='pointer', pointer=1),
+                                  users=[user_profile.id]))
+        stats = get_tornado_stats()
+        self.assertEqual(stats['fanout']['pointer']['count'], 1)
+        # Other tests may have left queues for this user behind.
+        self.assertEqual(stats['fanout']['pointer']['clients_touched'],
+                         len(get_client_descriptors_for_user(user_profile.id)))
+        self.assertEqual(sum(stats['fanout']['pointer']['clients_touched_histogram'].values()), 1)
+        self.assertGreaterEqual(stats['queue_depth']['max'], 1)
+        client.cleanup()
+
+    def test_percentiles(self):
+        # type: () -> None
+        self.assertEqual(percentiles(list(range(100))),
+                         dict(p50=50, p90=90, p99=99, max=99))
+        self.assertEqual(percentiles([]), dict(p50=0, p90=0, p99=0, max=0))
+
+class TornadoPresenceTest(ZulipTestCase):
+    def test_presence_table(self):
+        # type: () -> None
+        user_profile = get_user_profile_by_email('hamlet@zulip.com')
+        UserPresence.objects.filter(user_profile=user_profile).delete()
+        user_presences.pop(user_profile.id, None)
+        cache_delete(presence_refresh_cache_key(user_profile.id))
+        self.assertIsNone(user_is_idle(user_profile.id))
+
+        now = time.time()
+        log_time = timezone_now()
+        do_update_user_presence(user_profile, get_client("website"), log_time,
+                                UserPresence.ACTIVE)
+        self.assertFalse(user_is_idle(user_profile.id))
+        self.assertTrue(user_is_idle(user_profile.id, now=now + 150))
+
+        # Pings that only move an active timestamp forward refresh the
+        # table, but at most once per PRESENCE_REFRESH_INTERVAL_SECS.
+        do_update_user_presence(user_profile, get_client("website"),
+                                log_time + datetime.timedelta(seconds=50),
+                                UserPresence.ACTIVE)
+        self.assertFalse(user_is_idle(user_profile.id, now=now + 150))
+        with mock.patch('zerver.lib.actions.send_event') as m:
+            do_update_user_presence(user_profile, get_client("website"),
+                                    log_time + datetime.timedelta(seconds=100),
+                                    UserPresence.ACTIVE)
+        self.assertFalse(m.called)
+
+        # Tornado never reads presence from the database; a stale
+        # active timestamp just means the user is idle.
+        with queries_captured() as queries:
+            self.assertTrue(user_is_idle(user_profile.id, now=now + 200))
+        self.assertEqual(len(queries), 0)
+
+        # Going idle, once the active timestamp is stale.
+        do_update_user_presence(user_profile, get_client("website"),
+                                log_time + datetime.timedelta(seconds=200),
+                                UserPresence.IDLE)
+        self.assertTrue(user_is_idle(user_profile.id, now=now + 150))
+
+        # After a Tornado restart, we don't guess until we hear from the user.
+        user_presences.pop(user_profile.id, None)
+        self.assertIsNone(user_is_idle(user_profile.id))
+
+class EventQueueSnapshotTest(TestCase):
+    def test_snapshot_round_trip(self):
+        # type: () -> None
+        tmp_dir = tempfile.mkdtemp()
+        filename = os.path.join(tmp_dir, 'event_queues.json')
+        try:
+            writer = SnapshotWriter(filename)
+            writer.add('1:1', 10, False, dict(queue='first'))
+            writer.add('1:2', 11, True, dict(queue='second'))
+            writer.add('1:3', 12, False, dict(queue='third'))
+            writer.commit()
+            with open(filename, 'rb') as f:
+                data = f.read()
+            self.assertTrue(is_snapshot(data))
+
+            records = list(read_snapshot(data))
+            self.assertEqual([(r.queue_id, r.user_profile_id, r.realm_wide) for r in records],
+                             [('1:1', 10, False), ('1:2', 11, True), ('1:3', 12, False)])
+            self.assertEqual(records[1].load(), dict(queue='second'))
+
+            # Damaging one queue's body only loses that queue.
+            damaged = data.replace(b'"second"', b'"sEcond"')
+            records = list(read_snapshot(damaged))
+            self.assertEqual(len(records), 3)
+            with self.assertRaises(SnapshotFormatError):
+                records[1].load()
+            self.assertEqual(records[2].load(), dict(queue='third'))
+
+            # A truncated file keeps every complete record.
+            with mock.patch('logging.error') as error:
+                records = list(read_snapshot(data[:-3]))
+            self.assertEqual([r.queue_id for r in records], ['1:1', '1:2'])
+            self.assertEqual(error.call_count, 1)
+        finally:
+            shutil.rmtree(tmp_dir)
+
 class TestEventsRegisterAllPublicStreamsDefaults(TestCase):
     def setUp(self):
         # type: () -> None
@@ -1781,3 +2112,38 @@ class TestEventsRegisterNarrowDefaults(TestCase):
         self.user_profile.save()
         result = _default_narrow(self.user_profile, [])
         self.assertEqual(result, [])
+
+class TornadoShardingTest(TestCase):
+    def test_sharding_disabled(self):
+        # type: () -> None
+        self.assertFalse(tornado_sharding_enabled())
+        self.assertEqual(notify_tornado_queue_name(0), 'notify_tornado')
+        self.assertEqual(get_user_shard(7), 0)
+        self.assertEqual(partition_users_by_shard([1, 2, 3]), {0: [1, 2, 3]})
+
+    def test_partition_users_by_shard(self):
+        # type: () -> None
+        with self.settings(TORNADO_SHARD_PORTS=[9993, 9994]):
+            self.assertEqual(notify_tornado_queue_name(1), 'notify_tornado_shard_1')
+            self.assertEqual(get_shard_for_queue_id('1:1234:5'), 1)
+            with self.settings(TORNADO_SERVER='http://127.0.0.1:9993',
+                               TORNADO_SHARD_HOST='10.0.0.2'):
+                self.assertEqual(get_tornado_uri(1), 'http://10.0.0.2:9994')
+            self.assertEqual(partition_users_by_shard([1, 2, 3]), {0: [2], 1: [1, 3]})
+            self.assertEqual(partition_users_by_shard([dict(id=4, flags=[])]),
+                             {0: [dict(id=4, flags=[])]})
+
+    def test_send_event_routing(self):
+        # type: () -> None
+        with self.settings(TORNADO_SHARD_PORTS=[9993, 9994]), \
+                mock.patch('zerver.tornado.event_queue.queue_json_publish') as m:
+            send_event(dict(type='pointer', pointer=1), [3])
+            self.assertEqual([call[0][0] for call in m.call_args_list],
+                             ['notify_tornado_shard_1'])
+
+            m.reset_mock()
+            send_event(dict(type='message', stream_name='Verona', invite_only=False),
+                       [dict(id=3, flags=[])])
+            self.assertEqual([call[0][0] for call in m.call_args_list],
+                             ['notify_tornado_shard_0', 'notify_tornado_shard_1'])
+            self.assertEqual(m.call_args_list[0][0][1]['users'], [])
@@ -6,13 +6,19 @@ import glob
 from datetime import timedelta
 from mock import MagicMock, patch
 from six.moves import map, filter
+from six import StringIO
 
 from django.conf import settings
 from django.core.management import call_command
 from django.test import TestCase
+from django.utils import timezone
+from zerver.lib import cache
+from zerver.lib.cache import cache_delete, cache_get, cache_get_many, cache_set, \
+    flush_cache_stats, get_cache_stats, reset_cache_stats, user_profile_by_id_cache_key
+from zerver.lib.cache_helpers import user_ids
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import stdout_suppressed
-from zerver.models import get_realm
+from zerver.models import get_realm, get_user_profile_by_email
 from confirmation.models import RealmCreationKey, generate_realm_creation_url
 
 class TestCommandsCanStart(TestCase):
@@ -142,3 +148,40 @@ class TestGenerateRealmCreationLink(ZulipTestCase):
 
             result = self.client_get(generated_link)
             self.assert_in_success_response(["The organization creation link has expired or is not valid."], result)
+
+class TestCacheStats(ZulipTestCase):
+    @patch('zerver.lib.cache.CACHE_STATS_REDIS_KEY', 'test_cache_stats')
+    @patch('zerver.lib.cache.CACHE_STATS_SIZE_SAMPLE_RATE', 1)
+    def test_cache_stats(self):
+        # type: () -> None
+        flush_cache_stats()
+        reset_cache_stats()
+
+        cache_set(u'test_family:1', u'value')
+        cache_get(u'test_family:1')
+        cache_get_many([u'test_family:1', u'test_family:2', u'other_family:1'])
+        cache_delete(u'test_family:1')
+        cache_get(u'http://example.com/', cache_name='database')
+        self.assertEqual(cache.cache_stats[(u'test_family', 'get_many')][:3], [1, 2, 1])
+        self.assertEqual(cache.cache_stats[(u'other_family', 'get_many')][:3], [1, 1, 0])
+        self.assertGreater(cache.cache_stats[(u'test_family', 'set')][3], 0)
+        self.assertIn((u'database.other', 'get'), cache.cache_stats)
+
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            call_command('cache_stats', '--reset')
+        self.assertIn('test_family', stdout.getvalue())
+        self.assertEqual(cache.cache_stats, {})
+        self.assertEqual(get_cache_stats(), (None, {}))
+
+class TestFillMemcachedCaches(ZulipTestCase):
+    def test_fill_user_cache(self):
+        # type: () -> None
+        hamlet = get_user_profile_by_email('hamlet@zulip.com')
+        hamlet.last_login = timezone.now()
+        hamlet.save(update_fields=['last_login'])
+        self.assertEqual(user_ids()[0], hamlet.id)
+
+        cache_delete(user_profile_by_id_cache_key(hamlet.id))
+        call_command('fill_memcached_caches', '--cache', 'user', '--processes', '1')
+        self.assertEqual(cache_get(user_profile_by_id_cache_key(hamlet.id))[0].email,
+                         hamlet.email)
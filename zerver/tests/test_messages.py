@@ -32,7 +32,7 @@ from zerver.models import (
     MAX_MESSAGE_LENGTH, MAX_SUBJECT_LENGTH,
     Message, Realm, Recipient, Stream, UserMessage, UserProfile, Attachment, RealmDomain,
     get_realm, get_stream, get_user_profile_by_email,
-    Reaction, sew_messages_and_reactions, flush_per_request_caches
+    Reaction, StreamTopic, sew_messages_and_reactions, flush_per_request_caches
 )
 
 from zerver.lib.actions import (
@@ -40,13 +40,18 @@ from zerver.lib.actions import (
     check_send_message,
     extract_recipients,
     do_create_user,
+    do_send_messages,
     get_client,
     get_recipient,
+    internal_prep_message,
 )
+from zerver.lib.cache import to_dict_cache_key_id
+from zerver.lib.local_cache import LocalCache
+from zerver.lib.topic_index import add_messages_to_topic_index, rebuild_topic_index
 
 from zerver.lib.upload import create_attachment
 
-from zerver.views.messages import create_mirrored_message_users
+from zerver.views.messages import create_mirrored_message_users, fetch_message_list
 
 import datetime
 import DNS
@@ -94,6 +99,7 @@ class TopicHistoryTest(ZulipTestCase):
                 message=message,
                 flags=flags,
             )
+            add_messages_to_topic_index([message])
 
         create_test_message('topic2', read=False)
         create_test_message('toPIc1', read=False, starred=True)
@@ -144,6 +150,63 @@ class TopicHistoryTest(ZulipTestCase):
         result = self.client_get(endpoint, dict())
         self.assert_json_error(result, 'Invalid stream id')
 
+    def test_topic_index_follows_edits(self):
+        # type: () -> None
+        self.login("hamlet@zulip.com")
+        stream = get_stream('Scotland', get_realm('zulip'))
+        recipient = get_recipient(Recipient.STREAM, stream.id)
+        id1 = self.send_message("hamlet@zulip.com", "Scotland", Recipient.STREAM,
+                                subject="Indexed topic")
+        id2 = self.send_message("hamlet@zulip.com", "Scotland", Recipient.STREAM,
+                                subject="indexed TOPIC")
+
+        topic = StreamTopic.objects.get(recipient=recipient, canonical_name='indexed topic')
+        self.assertEqual(topic.topic_name, 'indexed TOPIC')
+        self.assertEqual(topic.last_message_id, id2)
+        self.assertEqual(topic.message_count, 2)
+
+        result = self.client_patch("/json/messages/" + str(id2), {
+            'message_id': id2,
+            'subject': 'moved',
+            'propagate_mode': 'change_one'
+        })
+        self.assert_json_success(result)
+
+        topic = StreamTopic.objects.get(recipient=recipient, canonical_name='indexed topic')
+        self.assertEqual(topic.last_message_id, id1)
+        self.assertEqual(topic.message_count, 1)
+        topic = StreamTopic.objects.get(recipient=recipient, canonical_name='moved')
+        self.assertEqual(topic.last_message_id, id2)
+        self.assertEqual(topic.message_count, 1)
+
+        self.client_patch("/json/messages/" + str(id1), {
+            'message_id': id1,
+            'subject': 'moved',
+            'propagate_mode': 'change_one'
+        })
+        self.assertFalse(StreamTopic.objects.filter(recipient=recipient,
+                                                    canonical_name='indexed topic').exists())
+        self.assertEqual(StreamTopic.objects.get(recipient=recipient,
+                                                 canonical_name='moved').message_count, 2)
+
+    def test_topic_index_canonical_names_match_rebuild(self):
+        # type: () -> None
+        # Python's and Postgres's lowercasing differ on e.g. U+0130, so
+        # the incremental updates must canonicalize the same way the
+        # rebuild does.
+        stream = get_stream('Scotland', get_realm('zulip'))
+        recipient = get_recipient(Recipient.STREAM, stream.id)
+        self.send_message("hamlet@zulip.com", "Scotland", Recipient.STREAM,
+                          subject=u"\u0130stanbul")
+        rebuild_topic_index([recipient.id])
+        message_id = self.send_message("hamlet@zulip.com", "Scotland", Recipient.STREAM,
+                                       subject=u"\u0130STANBUL")
+
+        topics = StreamTopic.objects.filter(recipient=recipient, topic_name__in=[
+            u"\u0130stanbul", u"\u0130STANBUL"])
+        self.assertEqual([(topic.topic_name, topic.last_message_id, topic.message_count)
+                          for topic in topics],
+                         [(u"\u0130STANBUL", message_id, 2)])
 
 class TestCrossRealmPMs(ZulipTestCase):
     def make_realm(self, domain):
@@ -467,6 +530,44 @@ class StreamMessagesTest(ZulipTestCase):
 
         self.assert_length(queries, 12)
 
+    def test_bulk_insert_ums_with_copy(self):
+        # type: () -> None
+        realm = get_realm('zulip')
+        subscribers = self.users_subscribed_to_stream("Denmark", realm)
+        iago = get_user_profile_by_email("iago@zulip.com")
+        self.subscribe_to_stream(iago.email, "Denmark")
+
+        with mock.patch('zerver.lib.actions.BULK_INSERT_UMS_COPY_THRESHOLD', 1), \
+                mock.patch('zerver.lib.actions.UserMessage.objects.bulk_create') as bulk_create_mock:
+            msg_id = self.send_message("hamlet@zulip.com", "Denmark", Recipient.STREAM,
+                                       content="test @**Iago** rules")
+        bulk_create_mock.assert_not_called()
+
+        ums = UserMessage.objects.filter(message_id=msg_id)
+        self.assertEqual(set(um.user_profile_id for um in ums),
+                         set(user.id for user in subscribers) | {iago.id})
+        for um in ums:
+            if um.user_profile_id == iago.id:
+                self.assertEqual(um.flags_list(), ['mentioned'])
+            elif um.user_profile.email == "hamlet@zulip.com":
+                self.assertEqual(um.flags_list(), ['read'])
+            else:
+                self.assertEqual(um.flags_list(), [])
+
+    def test_send_messages_makes_no_presence_queries(self):
+        # type: () -> None
+        # Recipients' idleness is decided by Tornado's presence table.
+        realm = get_realm('zulip')
+        messages = [internal_prep_message(realm, 'hamlet@zulip.com', 'stream', 'Verona',
+                                          u'topic', u'message %d' % (i,))
+                    for i in range(10)]
+        with queries_captured() as queries:
+            do_send_messages(messages)
+
+        presence_queries = [query for query in queries
+                            if 'zerver_userpresence' in query['sql']]
+        self.assert_length(presence_queries, 0)
+
     def test_stream_message_dict(self):
         # type: () -> None
         user_profile = get_user_profile_by_email("iago@zulip.com")
@@ -694,6 +795,54 @@ class MessageDictTest(ZulipTestCase):
                          sender.full_name)
 
 
+class MessageDictLocalCacheTest(ZulipTestCase):
+    def test_lru(self):
+        # type: () -> None
+        local_cache = LocalCache('test', max_size=2, timeout=60)
+        local_cache.set_many({u'a': 1, u'b': 2})
+        self.assertEqual(local_cache.get_many([u'a']), {u'a': 1})
+        # 'b' is now the least recently used item.
+        local_cache.set_many({u'c': 3})
+        self.assertEqual(local_cache.get_many([u'a', u'b', u'c']), {u'a': 1, u'c': 3})
+        self.assertEqual((local_cache.hits, local_cache.misses), (3, 1))
+
+        with mock.patch('zerver.lib.local_cache.time.time', return_value=time.time() + 61):
+            self.assertEqual(local_cache.get_many([u'a', u'c']), {})
+
+    @override_settings(MESSAGE_DICT_LOCAL_CACHE_SIZE=100)
+    def test_edits_invalidate_local_cache(self):
+        # type: () -> None
+        self.login("hamlet@zulip.com")
+        msg_id = self.send_message("hamlet@zulip.com", "Scotland", Recipient.STREAM,
+                                   content="before edit")
+        key = to_dict_cache_key_id(msg_id, True)
+        local_cache = LocalCache('message_dict', 100, 60)
+        redis_client = mock.Mock()
+
+        def fetch_content():
+            # type: () -> Text
+            return fetch_message_list([msg_id], {msg_id: []}, {}, True)[0]['content']
+
+        with mock.patch('zerver.lib.local_cache.message_dict_local_cache', local_cache), \
+                mock.patch('zerver.views.messages.get_message_dict_local_cache',
+                           return_value=local_cache), \
+                mock.patch('zerver.lib.local_cache.get_redis_client', return_value=redis_client):
+            self.assertEqual(fetch_content(), '<p>before edit</p>')
+            self.assertEqual(local_cache.misses, 1)
+            self.assertIn(key, local_cache.items)
+            self.assertEqual(fetch_content(), '<p>before edit</p>')
+            self.assertEqual(local_cache.hits, 1)
+
+            result = self.client_patch("/json/messages/" + str(msg_id), {
+                'message_id': msg_id,
+                'content': 'after edit'
+            })
+            self.assert_json_success(result)
+            self.assertNotIn(key, local_cache.items)
+            redis_client.publish.assert_called_with('message_dict_invalidations',
+                                                    ujson.dumps([msg_id]))
+            self.assertEqual(fetch_content(), '<p>after edit</p>')
+
 class SewMessageAndReactionTest(ZulipTestCase):
     def test_sew_messages_and_reaction(self):
         # type: () -> None
@@ -13,7 +13,7 @@ from sqlalchemy.sql import compiler # type: ignore
 from zerver.models import (
     Realm, Recipient, Stream, Subscription, UserProfile, Attachment,
     get_display_recipient, get_recipient, get_realm, get_stream, get_user_profile_by_email,
-    Reaction
+    Reaction, UserMessage
 )
 from zerver.lib.message import (
     MessageDict,
@@ -34,13 +34,14 @@ from zerver.lib.test_classes import (
 )
 from zerver.views.messages import (
     exclude_muting_conditions,
-    get_messages_backend, ok_to_include_history,
+    get_messages_backend, normalize_search_narrow, ok_to_include_history,
     NarrowBuilder, BadNarrowOperator, Query,
     LARGER_THAN_MAX_MESSAGE_ID,
 )
 
 from typing import Dict, List, Mapping, Sequence, Tuple, Generic, Union, Any, Text
 from six.moves import range
+import mock
 import os
 import re
 import ujson
@@ -259,6 +260,19 @@ class NarrowBuilderTest(ZulipTestCase):
         term = dict(operator='search', operand='"french fries"', negated=True)
         self._do_add_term_test(term, 'WHERE NOT (search_pgroonga @@ :search_pgroonga_1)')
 
+    def test_add_term_using_search_operator_without_search_fields(self):
+        # type: () -> None
+        builder = NarrowBuilder(self.user_profile, column('id'), search_fields=False)
+        term = dict(operator='search', operand='fries')
+        with self.settings(USING_PGROONGA=False):
+            query = str(builder.add_term(self.raw_query, term))
+        self.assertIn('WHERE search_tsvector @@ plainto_tsquery(', query)
+        self.assertNotIn('ts_match_locs_array', query)
+        with self.settings(USING_PGROONGA=True):
+            query = str(builder.add_term(self.raw_query, term))
+        self.assertIn('WHERE search_pgroonga @@ :search_pgroonga_1', query)
+        self.assertNotIn('match_positions_character', query)
+
     def test_add_term_using_has_operator_and_attachment_operand(self):
         # type: () -> None
         term = dict(operator='has', operand='attachment')
@@ -363,6 +377,27 @@ class BuildNarrowFilterTest(TestCase):
         with self.assertRaises(JsonableError):
             build_narrow_filter(["invalid_operator", "operand"])
 
+class NormalizeSearchNarrowTest(TestCase):
+    @override_settings(USING_PGROONGA=False)
+    def test_normalize_search_narrow_tsearch(self):
+        # type: () -> None
+        narrow = [dict(operator='search', operand='  Lunch'),
+                  dict(operator='stream', operand='Verona'),
+                  dict(operator='search', operand='"After  Lunch" plans')]
+        self.assertEqual(normalize_search_narrow(narrow),
+                         [dict(operator='stream', operand='Verona'),
+                          dict(operator='search', operand='lunch "After  Lunch" plans')])
+
+        negated = [dict(operator='search', operand='lunch', negated=True)]
+        self.assertNotEqual(normalize_search_narrow(negated),
+                            normalize_search_narrow([dict(operator='search', operand='lunch')]))
+
+    @override_settings(USING_PGROONGA=True)
+    def test_normalize_search_narrow_pgroonga(self):
+        # type: () -> None
+        narrow = [dict(operator='search', operand='lunch OR  dinner')]
+        self.assertEqual(normalize_search_narrow(narrow), narrow)
+
 class IncludeHistoryTest(ZulipTestCase):
     def test_ok_to_include_history(self):
         # type: () -> None
@@ -827,6 +862,60 @@ class GetOldMessagesTest(ZulipTestCase):
         self.assertEqual(len(multi_search_result['messages']), 1)
         self.assertEqual(multi_search_result['messages'][0]['match_content'], '<p><span class="highlight">discuss</span> lunch <span class="highlight">after</span> lunch</p>')
 
+    @override_settings(USING_PGROONGA=False)
+    def test_get_messages_with_cached_search(self):
+        # type: () -> None
+        email = 'cordelia@zulip.com'
+        self.login(email)
+
+        def send(content):
+            # type: (Text) -> int
+            return self.send_message(email, "Verona", Recipient.STREAM, content)
+
+        def index_messages():
+            # type: () -> None
+            self._update_tsvector_index()
+            with connection.cursor() as cursor:
+                cursor.execute("DELETE FROM fts_update_log")
+
+        def search(operand):
+            # type: (Text) -> List[int]
+            narrow = [dict(operator='search', operand=operand)]
+            result = self.get_and_check_messages(dict(
+                narrow=ujson.dumps(narrow),
+                anchor=LARGER_THAN_MAX_MESSAGE_ID,
+                num_before=10,
+                num_after=0,
+            ))
+            return [message['id'] for message in result['messages']]
+
+        message_ids = [send('zephyrology is fun'), send('no match'), send('more zephyrology')]
+        index_messages()
+        self.assertEqual(search('zephyrology'), [message_ids[0], message_ids[2]])
+
+        # Equivalent searches are answered from the cached results.
+        with mock.patch('zerver.views.messages.query_message_page_rows') as query:
+            self.assertEqual(search('  Zephyrology '), [message_ids[0], message_ids[2]])
+        self.assertFalse(query.called)
+
+        # A new message discards the cached results, but they aren't
+        # cached again until the new message has been indexed.
+        new_id = send('zephyrology again')
+        with mock.patch('zerver.views.messages.query_message_page_rows') as query:
+            self.assertEqual(search('zephyrology'), [message_ids[0], message_ids[2]])
+        self.assertFalse(query.called)
+        index_messages()
+        self.assertEqual(search('zephyrology'), [message_ids[0], message_ids[2], new_id])
+
+        # So does editing a message.
+        result = self.client_patch("/json/messages/" + str(message_ids[1]), {
+            'message_id': message_ids[1],
+            'content': 'zephyrology after all',
+        })
+        self.assert_json_success(result)
+        index_messages()
+        self.assertEqual(search('zephyrology'), sorted(message_ids + [new_id]))
+
     @override_settings(USING_PGROONGA=False)
     def test_get_messages_with_search_not_subscribed(self):
         # type: () -> None
@@ -1369,3 +1458,65 @@ class GetOldMessagesTest(ZulipTestCase):
         self.common_check_get_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                               'narrow': '[["search", "\\"jumping\\" quickly"]]'},
                                              sql)
+
+class GetMessagePageTest(ZulipTestCase):
+    def get_page(self, params):
+        # type: (Dict[str, Any]) -> Dict[str, Any]
+        result = self.client_get("/json/messages/page", params)
+        self.assert_json_success(result)
+        return ujson.loads(result.content)
+
+    def test_page_through_history(self):
+        # type: () -> None
+        self.login("hamlet@zulip.com")
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        expected_ids = sorted(UserMessage.objects.filter(user_profile=user_profile)
+                              .values_list('message_id', flat=True), reverse=True)
+
+        result = self.get_page(dict(num=3))
+        fetched_ids = [message['id'] for message in reversed(result['messages'])]
+        page_queries = 0
+        while result['continuation'] is not None:
+            with queries_captured() as queries:
+                result = self.get_page(dict(num=3, continuation=result['continuation']))
+            page_queries += len([query for query in queries
+                                 if "/* get_message_page */" in query['sql']])
+            fetched_ids.extend(message['id'] for message in reversed(result['messages']))
+        self.assertEqual(fetched_ids, expected_ids)
+
+        # The first request fetched ids for MESSAGE_WINDOW_PAGES pages,
+        # so continuing only queries again once per window.
+        num_pages = (len(expected_ids) + 2) // 3
+        self.assertLess(page_queries, num_pages)
+
+    def test_page_newer_with_narrow(self):
+        # type: () -> None
+        self.login("hamlet@zulip.com")
+        narrow = ujson.dumps([dict(operator='stream', operand='Verona')])
+        result = self.get_page(dict(narrow=narrow, num=2, anchor=0, direction='newer'))
+        self.assertEqual(len(result['messages']), 2)
+        first_ids = [message['id'] for message in result['messages']]
+        self.assertEqual(first_ids, sorted(first_ids))
+
+        result = self.get_page(dict(narrow=narrow, num=2,
+                                    continuation=result['continuation']))
+        for message in result['messages']:
+            self.assertGreater(message['id'], first_ids[-1])
+            self.assertEqual(message['display_recipient'], 'Verona')
+
+    def test_invalid_continuation(self):
+        # type: () -> None
+        self.login("hamlet@zulip.com")
+        result = self.get_page(dict(num=1))
+        token = result['continuation']
+        # Tokens are tied to the narrow they were issued for.
+        narrow = ujson.dumps([dict(operator='stream', operand='Verona')])
+        result = self.client_get("/json/messages/page", dict(num=1, narrow=narrow,
+                                                             continuation=token))
+        self.assert_json_error(result, "Invalid continuation token")
+
+        result = self.client_get("/json/messages/page", dict(num=1, continuation='garbage'))
+        self.assert_json_error(result, "Invalid continuation token")
+
+        result = self.client_get("/json/messages/page", dict(num=0))
+        self.assert_json_error(result, "num must be between 1 and 1000")
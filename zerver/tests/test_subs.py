@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
-from typing import Any, Dict, List, Mapping, Optional, Sequence, Set, Text
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Set, Text, Tuple
 
 from django.http import HttpRequest, HttpResponse
 
@@ -34,7 +34,8 @@ from zerver.lib.test_runner import (
 
 from zerver.models import (
     get_display_recipient, Message, Realm, Recipient, Stream, Subscription,
-    DefaultStream, UserProfile, get_user_profile_by_id
+    DefaultStream, UserProfile, get_user_profile_by_id, get_recipient,
+    bulk_get_active_subscriber_ids, bulk_get_stream_subscribers,
 )
 
 from zerver.lib.actions import (
@@ -44,7 +45,8 @@ from zerver.lib.actions import (
     gather_subscriptions, get_default_streams_for_realm, get_realm, get_stream,
     get_user_profile_by_email, set_default_streams, check_stream_name,
     create_stream_if_needed, create_streams_if_needed, active_user_ids,
-    do_deactivate_stream,
+    do_deactivate_stream, do_deactivate_user, get_recipient_user_profiles,
+    do_change_enable_online_push_notifications,
 )
 
 from zerver.views.streams import (
@@ -2427,6 +2429,75 @@ class GetSubscribersTest(ZulipTestCase):
         result = self.make_subscriber_request(stream_id, email=other_email)
         self.assert_json_error(result, "Invalid stream id")
 
+class StreamSubscribersCacheTest(ZulipTestCase):
+    def cached_subscribers(self, stream):
+        # type: (Stream) -> Optional[List[Tuple[int, Text, bool]]]
+        cached = cache.cache_get(cache.stream_subscribers_cache_key(stream.id))
+        if cached is None:
+            return None
+        return cache.unpack_stream_subscribers(cached[0])
+
+    def test_pack_user_ids(self):
+        # type: () -> None
+        packed = cache.pack_user_ids([30, 2, 1000000])
+        self.assertEqual(len(packed), 12)
+        self.assertEqual(cache.unpack_user_ids(packed), [2, 30, 1000000])
+        self.assertEqual(cache.unpack_user_ids(cache.pack_user_ids([])), [])
+
+        packed_subscribers = cache.pack_stream_subscribers(
+            [(30, u'b@zulip.com', True), (2, u'a@zulip.com', False)])
+        self.assertEqual(cache.unpack_stream_subscribers(packed_subscribers),
+                         [(2, u'a@zulip.com', False), (30, u'b@zulip.com', True)])
+
+    def test_subscribers_cache_maintenance(self):
+        # type: () -> None
+        stream = self.make_stream('subscriber_cache_stream')
+        hamlet = get_user_profile_by_email('hamlet@zulip.com')
+        othello = get_user_profile_by_email('othello@zulip.com')
+
+        bulk_add_subscriptions([stream], [hamlet, othello])
+        self.assertEqual(self.cached_subscribers(stream), sorted([
+            (hamlet.id, hamlet.email, hamlet.enable_online_push_notifications),
+            (othello.id, othello.email, othello.enable_online_push_notifications)]))
+
+        bulk_remove_subscriptions([othello], [stream])
+        self.assertEqual([subscriber[0] for subscriber in self.cached_subscribers(stream)],
+                         [hamlet.id])
+        self.assertEqual(bulk_get_active_subscriber_ids([stream.id]),
+                         {stream.id: [hamlet.id]})
+
+        do_change_enable_online_push_notifications(hamlet, False)
+        self.assertEqual(self.cached_subscribers(stream), None)
+        self.assertEqual(bulk_get_stream_subscribers([stream.id]),
+                         {stream.id: [(hamlet.id, hamlet.email, False)]})
+
+        # A full save invalidates the cache too.
+        self.assertIsNotNone(self.cached_subscribers(stream))
+        hamlet.email = 'new-hamlet@zulip.com'
+        hamlet.save()
+        self.assertEqual(self.cached_subscribers(stream), None)
+        self.assertEqual(bulk_get_stream_subscribers([stream.id]),
+                         {stream.id: [(hamlet.id, 'new-hamlet@zulip.com', False)]})
+
+        do_deactivate_user(hamlet)
+        self.assertEqual(self.cached_subscribers(stream), None)
+        self.assertEqual(bulk_get_active_subscriber_ids([stream.id]),
+                         {stream.id: []})
+
+    def test_send_uses_cached_subscribers(self):
+        # type: () -> None
+        stream = self.make_stream('subscriber_cache_stream')
+        hamlet = get_user_profile_by_email('hamlet@zulip.com')
+        othello = get_user_profile_by_email('othello@zulip.com')
+        bulk_add_subscriptions([stream], [hamlet, othello])
+        recipient = get_recipient(Recipient.STREAM, stream.id)
+
+        with queries_captured() as queries:
+            recipients = get_recipient_user_profiles(recipient, hamlet.id)
+        self.assert_length(queries, 0)
+        self.assertEqual(sorted((user.id, user.email) for user in recipients),
+                         sorted([(hamlet.id, hamlet.email), (othello.id, othello.email)]))
+
 class AccessStreamTest(ZulipTestCase):
     def test_access_stream(self):
         # type: () -> None
@@ -4,10 +4,12 @@ from __future__ import absolute_import
 from typing import Any, Dict, List
 
 from zerver.models import (
-    get_user_profile_by_email, Recipient, UserMessage
+    get_stream, get_user_profile_by_email, Recipient, UserMessage
 )
 
 from zerver.lib.test_helpers import tornado_redirected_to_list
+from zerver.lib.unread_counts import get_unread_counts, update_flags_returning_changed
+from zerver.views.home import approximate_unread_count
 from zerver.lib.test_classes import (
     ZulipTestCase,
 )
@@ -334,3 +336,71 @@ class UnreadCountTests(ZulipTestCase):
                                                            "topic_name": invalid_topic_name,
                                                            "stream_name": "Denmark"})
         self.assert_json_error(result, 'No such topic \'abc\'')
+
+    def test_unread_counts(self):
+        # type: () -> None
+        self.login("hamlet@zulip.com")
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        iago = get_user_profile_by_email("iago@zulip.com")
+        self.assertEqual(get_unread_counts(user_profile),
+                         dict(streams=[], pms=[dict(sender_id=iago.id, count=2)], huddles=[]))
+
+        stream_message_ids = [
+            self.send_message("othello@zulip.com", "Verona", Recipient.STREAM, "hello", "Counted"),
+            self.send_message("othello@zulip.com", "Verona", Recipient.STREAM, "hello", "counted")]
+        # Hamlet's own message is already read.
+        self.send_message("hamlet@zulip.com", "Verona", Recipient.STREAM, "hello", "counted")
+        verona = get_stream("Verona", user_profile.realm)
+        self.assertEqual(get_unread_counts(user_profile)['streams'],
+                         [dict(stream_id=verona.id, topic='counted', count=2)])
+
+        result = self.client_post("/json/messages/flags",
+                                  {"messages": ujson.dumps(self.unread_msg_ids[:1] +
+                                                           stream_message_ids),
+                                   "op": "add",
+                                   "flag": "read"})
+        self.assert_json_success(result)
+        self.assertEqual(get_unread_counts(user_profile),
+                         dict(streams=[], pms=[dict(sender_id=iago.id, count=1)], huddles=[]))
+
+        # Marking them read again (e.g. from another client) only
+        # counts the messages that actually changed.
+        self.assertEqual(update_flags_returning_changed(
+            UserMessage.objects.filter(user_profile=user_profile,
+                                       message_id__in=stream_message_ids),
+            'add', UserMessage.flags.read), [])
+        result = self.client_post("/json/messages/flags",
+                                  {"messages": ujson.dumps(self.unread_msg_ids[:1]),
+                                   "op": "add",
+                                   "flag": "read"})
+        self.assert_json_success(result)
+        self.assertEqual(get_unread_counts(user_profile),
+                         dict(streams=[], pms=[dict(sender_id=iago.id, count=1)], huddles=[]))
+
+        result = self.client_post("/json/messages/flags",
+                                  {"messages": ujson.dumps(stream_message_ids[:1]),
+                                   "op": "remove",
+                                   "flag": "read"})
+        self.assert_json_success(result)
+        self.assertEqual(get_unread_counts(user_profile)['streams'],
+                         [dict(stream_id=verona.id, topic='counted', count=1)])
+
+        result = self.client_post("/json/messages/flags",
+                                  {"messages": ujson.dumps([]),
+                                   "op": "add",
+                                   "flag": "read",
+                                   "all": ujson.dumps(True)})
+        self.assert_json_success(result)
+        self.assertEqual(get_unread_counts(user_profile),
+                         dict(streams=[], pms=[], huddles=[]))
+        self.assertEqual(approximate_unread_count(user_profile), 0)
+
+        # Marking everything unread counts exactly the messages it changed.
+        result = self.client_post("/json/messages/flags",
+                                  {"messages": ujson.dumps([]),
+                                   "op": "remove",
+                                   "flag": "read",
+                                   "all": ujson.dumps(True)})
+        self.assert_json_success(result)
+        self.assertEqual(approximate_unread_count(user_profile),
+                         UserMessage.objects.filter(user_profile=user_profile).count())
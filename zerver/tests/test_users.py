@@ -5,11 +5,12 @@ from __future__ import print_function
 from typing import (Any, Dict, Iterable, List,
                     Optional, TypeVar, Text, Union)
 
+from django.db import transaction
 from django.http import HttpResponse
 from django.test import TestCase
 
 from zerver.lib.test_helpers import (
-    queries_captured, simulated_empty_cache,
+    cache_deletes_after_commit, queries_captured, simulated_empty_cache,
     tornado_redirected_to_list,
     most_recent_message, make_client, avatar_disk_path,
     get_test_image_file
@@ -25,6 +26,8 @@ from zerver.models import UserProfile, Recipient, \
     Message, get_context_for_message
 
 from zerver.lib.avatar import avatar_url
+from zerver.lib.cache import batched_cache_deletes, cache_delete, cache_get, cache_lock, \
+    cache_set, user_profile_by_email_cache_key
 from zerver.lib.email_mirror import create_missed_message_address
 from zerver.lib.actions import (
     get_emails_from_user_ids,
@@ -34,6 +37,7 @@ from zerver.lib.actions import (
 )
 
 from django.conf import settings
+import mock
 import os
 import sys
 import time
@@ -376,6 +380,91 @@ class GetProfileTest(ZulipTestCase):
         self.assert_length(cache_queries, 1)
         self.assertEqual(user_profile.email, 'hamlet@zulip.com')
 
+    def test_cache_stampede_protection(self):
+        # type: () -> None
+        email = 'hamlet@zulip.com'
+        user_profile = get_user_profile_by_email(email)
+        key = user_profile_by_email_cache_key(email)
+
+        # A value that's due to expire gets refreshed early.
+        cache_set(key, user_profile, metadata=(time.time(), 0.1))
+        with queries_captured() as queries:
+            get_user_profile_by_email(email)
+        self.assert_length(queries, 1)
+        self.assertEqual(len(cache_get(key)), 3)
+
+        # ... but not while someone else is refreshing it.
+        cache_set(key, user_profile, metadata=(time.time(), 0.1))
+        with cache_lock(key) as locked, queries_captured() as queries:
+            self.assertTrue(locked)
+            self.assertEqual(get_user_profile_by_email(email).id, user_profile.id)
+        self.assert_length(queries, 0)
+
+        # On a miss, we wait for whoever holds the lock to fill the cache.
+        cache_delete(key)
+        with cache_lock(key), queries_captured() as queries, \
+                mock.patch('zerver.lib.cache.time.sleep',
+                           side_effect=lambda secs: cache_set(key, user_profile)) as sleep:
+            self.assertEqual(get_user_profile_by_email(email).id, user_profile.id)
+        self.assert_length(queries, 0)
+        self.assertEqual(sleep.call_count, 1)
+
+        # Unless they take too long.
+        cache_delete(key)
+        with cache_lock(key), queries_captured() as queries, \
+                mock.patch('zerver.lib.cache.SINGLE_FLIGHT_WAIT_SECS', 0):
+            self.assertEqual(get_user_profile_by_email(email).id, user_profile.id)
+        self.assert_length(queries, 1)
+
+        # Tornado never waits for the lock holder.
+        cache_delete(key)
+        with cache_lock(key), queries_captured() as queries, \
+                self.settings(RUNNING_INSIDE_TORNADO=True), \
+                mock.patch('zerver.lib.cache.time.sleep') as sleep:
+            self.assertEqual(get_user_profile_by_email(email).id, user_profile.id)
+        self.assert_length(queries, 1)
+        self.assertFalse(sleep.called)
+
+    def test_batched_cache_deletes(self):
+        # type: () -> None
+        email = 'hamlet@zulip.com'
+        user_profile = get_user_profile_by_email(email)
+        key = user_profile_by_email_cache_key(email)
+        with mock.patch('zerver.lib.cache.statsd') as statsd:
+            with batched_cache_deletes():
+                user_profile.save(update_fields=['full_name'])
+                with batched_cache_deletes():
+                    user_profile.save(update_fields=['full_name'])
+                self.assertIsNotNone(cache_get(key))
+            self.assertIsNone(cache_get(key))
+
+        stats = {call[0][0]: call[0][1] for call in statsd.incr.call_args_list}
+        # The second save's deletes were all duplicates.
+        self.assertGreater(stats['cache.batched_deletes.requested'], 0)
+        self.assertEqual(stats['cache.batched_deletes.coalesced'] * 2,
+                         stats['cache.batched_deletes.requested'])
+
+    def test_cache_deletes_after_commit(self):
+        # type: () -> None
+        email = 'hamlet@zulip.com'
+        user_profile = get_user_profile_by_email(email)
+        key = user_profile_by_email_cache_key(email)
+
+        # Deletes made in a transaction that rolls back are discarded.
+        with cache_deletes_after_commit():
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    user_profile.save(update_fields=['full_name'])
+                    raise ValueError()
+        self.assertIsNotNone(cache_get(key))
+
+        with cache_deletes_after_commit():
+            with transaction.atomic():
+                user_profile.save(update_fields=['full_name'])
+                user_profile.save(update_fields=['full_name'])
+            self.assertIsNotNone(cache_get(key))
+        self.assertIsNone(cache_get(key))
+
     def test_get_user_profile(self):
         # type: () -> None
         self.login('hamlet@zulip.com')
@@ -11,6 +11,8 @@ import tornado.web
 def create_tornado_application():
     # type: () -> tornado.web.Application
     urls = (r"/notify_tornado",
+            r"/tornado_queue_stats",
+            r"/tornado_stats",
             r"/json/events",
             r"/api/v1/events",
             )
@@ -2,13 +2,12 @@
 # high-level documentation on how this system works.
 from __future__ import absolute_import
 from typing import cast, AbstractSet, Any, Callable, Dict, List, \
-    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Text, Union
+    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Text, Tuple, Union
 
 from django.utils.translation import ugettext as _
 from django.conf import settings
-from django.utils.timezone import now as timezone_now
 from collections import deque
-import datetime
+import heapq
 import os
 import time
 import socket
@@ -31,10 +30,26 @@ from zerver.middleware import async_request_restart
 from zerver.lib.narrow import build_narrow_filter
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.request import JsonableError
-from zerver.lib.timestamp import timestamp_to_datetime
 from zerver.tornado.descriptors import clear_descriptor_by_handler_id, set_descriptor_by_handler_id
+from zerver.tornado.id_ranges import add_ids_to_ranges, ids_to_ranges, \
+    ranges_to_ids, remove_ids_from_ranges
+from zerver.tornado.notification_batch import add_to_notification_batch, \
+    notification_batch_open
+from zerver.tornado import ioloop_logging
+from zerver.tornado.stats import fanout_stats, finish_fanout, ioloop_lag_stats, \
+    note_client_touched, percentiles, start_fanout, start_ioloop_lag_monitor
+from zerver.tornado.queue_snapshot import SnapshotRecord, SnapshotWriter, \
+    is_snapshot, read_snapshot
+from zerver.tornado.message_payload import MessagePayload, estimate_event_size, \
+    expand_event
+from zerver.tornado.presence import update_user_presence, user_is_idle, user_presences
+from zerver.tornado.sharding import event_needs_all_shards, get_current_shard, \
+    get_tornado_shard_count, get_tornado_uri, get_tornado_uri_for_user, \
+    notify_tornado_queue_name, partition_users_by_shard, queue_id_prefix, \
+    tornado_sharding_enabled, user_is_on_current_shard
 import copy
 import six
+from six.moves import range
 
 requests_client = requests.Session()
 for host in ['127.0.0.1', 'localhost']:
@@ -61,6 +76,14 @@ MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
 HEARTBEAT_MIN_FREQ_SECS = 45
 
 class ClientDescriptor(object):
+    # There is one of these per event queue, so we avoid the overhead
+    # of a per-instance __dict__.
+    __slots__ = ('user_profile_id', 'user_profile_email', 'realm_id',
+                 'current_handler_id', 'current_client_name', 'event_queue',
+                 'queue_timeout', 'event_types', 'last_connection_time',
+                 'apply_markdown', 'all_public_streams', 'client_type_name',
+                 '_timeout_handle', 'narrow', 'narrow_filter', 'gc_scheduled')
+
     def __init__(self, user_profile_id, user_profile_email, realm_id, event_queue,
                  event_types, client_type_name, apply_markdown=True,
                  all_public_streams=False, lifespan_secs=0, narrow=[]):
@@ -84,6 +107,8 @@ class ClientDescriptor(object):
         self._timeout_handle = None # type: Any # TODO: should be return type of ioloop.add_timeout
         self.narrow = narrow
         self.narrow_filter = build_narrow_filter(narrow)
+        # Whether this queue has an entry in gc_heap; see schedule_gc.
+        self.gc_scheduled = False
 
         # Clamp queue_timeout to between minimum and maximum timeouts
         self.queue_timeout = max(IDLE_EVENT_QUEUE_TIMEOUT_SECS, min(self.queue_timeout, MAX_QUEUE_TIMEOUT_SECS))
@@ -131,13 +156,14 @@ class ClientDescriptor(object):
         self.current_handler_id = None
         self._timeout_handle = None
 
-    def add_event(self, event):
-        # type: (Dict[str, Any]) -> None
+    def add_event(self, event, size=None):
+        # type: (Dict[str, Any], Optional[int]) -> None
         if self.current_handler_id is not None:
             handler = get_handler_by_id(self.current_handler_id)
             async_request_restart(handler._request)
 
-        self.event_queue.push(event)
+        self.event_queue.push(event, size)
+        note_client_touched()
         self.finish_current_handler()
 
     def finish_current_handler(self):
@@ -207,6 +233,12 @@ class ClientDescriptor(object):
             ioloop = tornado.ioloop.IOLoop.instance()
             ioloop.remove_timeout(self._timeout_handle)
             self._timeout_handle = None
+        schedule_gc(self)
+
+    def expiry_time(self):
+        # type: () -> float
+        """When this queue becomes idle, if no handler connects before then."""
+        return self.last_connection_time + self.queue_timeout
 
     def cleanup(self):
         # type: () -> None
@@ -230,9 +262,16 @@ def compute_full_event_type(event):
     return event["type"]
 
 class EventQueue(object):
+    __slots__ = ('queue', 'event_sizes', 'byte_size', 'next_event_id', 'id',
+                 'virtual_events')
+
     def __init__(self, id):
         # type: (str) -> None
         self.queue = deque() # type: deque[Dict[str, Any]]
+        # Estimated encoded size of each event in self.queue, and their
+        # total; used to enforce settings.EVENT_QUEUE_MAX_BYTES.
+        self.event_sizes = deque() # type: deque[int]
+        self.byte_size = 0 # type: int
         self.next_event_id = 0 # type: int
         self.id = id # type: str
         self.virtual_events = {} # type: Dict[str, Dict[str, Any]]
@@ -244,7 +283,7 @@ class EventQueue(object):
         # loading event queues that lack that key.
         return dict(id=self.id,
                     next_event_id=self.next_event_id,
-                    queue=list(self.queue),
+                    queue=[expand_event(event) for event in self.queue],
                     virtual_events=self.virtual_events)
 
     @classmethod
@@ -253,16 +292,27 @@ class EventQueue(object):
         ret = cls(d['id'])
         ret.next_event_id = d['next_event_id']
         ret.queue = deque(d['queue'])
+        ret.event_sizes = deque(estimate_event_size(event) for event in ret.queue)
+        ret.byte_size = sum(ret.event_sizes)
         ret.virtual_events = d.get("virtual_events", {})
+        for virtual_event in six.itervalues(ret.virtual_events):
+            if "messages" in virtual_event and virtual_event["type"] == "update_message_flags":
+                # Migration for queues saved before flags events were
+                # stored as id ranges
+                virtual_event["message_ranges"] = ids_to_ranges(virtual_event.pop("messages"))
         return ret
 
-    def push(self, event):
-        # type: (Dict[str, Any]) -> None
+    def push(self, event, size=None):
+        # type: (Dict[str, Any], Optional[int]) -> None
+        """`size` is estimate_event_size(event), if the caller already
+        knows it; an event fanned out to many queues is only measured
+        once (see process_event)."""
         event['id'] = self.next_event_id
         self.next_event_id += 1
         full_event_type = compute_full_event_type(event)
-        if (full_event_type in ["pointer", "restart"] or
-                full_event_type.startswith("flags/")):
+        if full_event_type.startswith("flags/"):
+            self.push_flags_event(full_event_type, event)
+        elif full_event_type in ["pointer", "restart"]:
             if full_event_type not in self.virtual_events:
                 self.virtual_events[full_event_type] = copy.deepcopy(event)
                 return
@@ -275,16 +325,65 @@ class EventQueue(object):
                 virtual_event["pointer"] = event["pointer"]
             elif full_event_type == "restart":
                 virtual_event["server_generation"] = event["server_generation"]
-            elif full_event_type.startswith("flags/"):
-                virtual_event["messages"] += event["messages"]
         else:
             self.queue.append(event)
+            if size is None:
+                size = estimate_event_size(event)
+            self.event_sizes.append(size)
+            self.byte_size += size
+            if 0 < settings.EVENT_QUEUE_MAX_BYTES < self.byte_size:
+                self.collapse()
+
+    def push_flags_event(self, full_event_type, event):
+        # type: (str, Dict[str, Any]) -> None
+        """Merges a flags event into the virtual event for its flag and
+        operation, which keeps its message ids as id ranges (see
+        zerver/tornado/id_ranges.py) until contents() is called."""
+        # Adding a flag and then removing it (or vice versa) leaves just
+        # the latter, so drop the ids from the opposite virtual event.
+        opposite_operation = "remove" if event["operation"] == "add" else "add"
+        opposite_type = "flags/%s/%s" % (opposite_operation, event["flag"])
+        opposite_event = self.virtual_events.get(opposite_type)
+        if opposite_event is not None:
+            opposite_event["message_ranges"] = remove_ids_from_ranges(
+                opposite_event["message_ranges"], event["messages"])
+            if not opposite_event["message_ranges"]:
+                del self.virtual_events[opposite_type]
+
+        virtual_event = self.virtual_events.get(full_event_type)
+        if virtual_event is None:
+            virtual_event = {key: value for (key, value) in event.items() if key != "messages"}
+            virtual_event["message_ranges"] = []
+            self.virtual_events[full_event_type] = virtual_event
+        virtual_event["id"] = event["id"]
+        if "timestamp" in event:
+            virtual_event["timestamp"] = event["timestamp"]
+        virtual_event["message_ranges"] = add_ids_to_ranges(virtual_event["message_ranges"],
+                                                            event["messages"])
+
+    def collapse(self):
+        # type: () -> None
+        """Replaces the whole queue with a single immediate restart event.
+
+        Used when a queue whose client isn't fetching events outgrows
+        its byte budget; the restart makes the client reload and
+        register a new queue, rather than us holding on to the backlog
+        until the queue is garbage-collected."""
+        logging.info("Event queue %s exceeded %s bytes; collapsing into a restart event" %
+                     (self.id, settings.EVENT_QUEUE_MAX_BYTES))
+        self.queue.clear()
+        self.event_sizes.clear()
+        self.byte_size = 0
+        self.virtual_events = {}
+        self.push(dict(type='restart', server_generation=settings.SERVER_GENERATION,
+                       immediate=True))
 
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
     # a real event before being given to users.
     def pop(self):
         # type: () -> Dict[str, Any]
+        self.byte_size -= self.event_sizes.popleft()
         return self.queue.popleft()
 
     def empty(self):
@@ -300,33 +399,47 @@ class EventQueue(object):
     def contents(self):
         # type: () -> List[Dict[str, Any]]
         contents = [] # type: List[Dict[str, Any]]
+        sizes = [] # type: List[int]
         virtual_id_map = {} # type: Dict[str, Dict[str, Any]]
         for event_type in self.virtual_events:
-            virtual_id_map[self.virtual_events[event_type]["id"]] = self.virtual_events[event_type]
+            virtual_event = self.virtual_events[event_type]
+            if "message_ranges" in virtual_event:
+                virtual_event["messages"] = ranges_to_ids(virtual_event.pop("message_ranges"))
+            virtual_id_map[virtual_event["id"]] = virtual_event
         virtual_ids = sorted(list(virtual_id_map.keys()))
 
         # Merge the virtual events into their final place in the queue
         index = 0
         length = len(virtual_ids)
-        for event in self.queue:
+        for event, size in zip(self.queue, self.event_sizes):
             while index < length and virtual_ids[index] < event["id"]:
                 contents.append(virtual_id_map[virtual_ids[index]])
+                sizes.append(estimate_event_size(contents[-1]))
                 index += 1
             contents.append(event)
+            sizes.append(size)
         while index < length:
             contents.append(virtual_id_map[virtual_ids[index]])
+            sizes.append(estimate_event_size(contents[-1]))
             index += 1
 
         self.virtual_events = {}
         self.queue = deque(contents)
+        self.event_sizes = deque(sizes)
+        self.byte_size = sum(sizes)
         return contents
 
 # maps queue ids to client descriptors
 clients = {} # type: Dict[str, ClientDescriptor]
 # maps user id to list of client descriptors
 user_clients = {} # type: Dict[int, List[ClientDescriptor]]
-# maps realm id to list of client descriptors with all_public_streams=True
+# maps realm id to list of client descriptors with all_public_streams=True,
+# or with a narrow that can't be indexed by stream
 realm_clients_all_streams = {} # type: Dict[int, List[ClientDescriptor]]
+# maps (realm id, lowercased stream name) to list of client descriptors
+# whose narrow is limited to that stream, so that messages to public
+# streams only visit the narrowed queues that can accept them
+realm_stream_clients = {} # type: Dict[Tuple[int, Text], List[ClientDescriptor]]
 
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
@@ -337,32 +450,85 @@ gc_hooks = [] # type: List[Callable[[int, ClientDescriptor, bool], None]]
 
 next_queue_id = 0
 
+# Heap of (expiry time, queue id) for event queues without a connected
+# handler, so that gc_event_queues only looks at queues that may have
+# expired.  Each queue has at most one entry (ClientDescriptor.gc_scheduled).
+# Entries are checked lazily: a queue that reconnected since its entry
+# was pushed is rescheduled when the entry comes due, rather than when
+# it reconnects.
+gc_heap = [] # type: List[Tuple[float, str]]
+
+# Queues indexed from the snapshot at startup that haven't been decoded
+# yet; see load_event_queues.  They're restored in the background, or
+# on demand as soon as anything looks up their queue id or user.
+pending_queues = {} # type: Dict[str, SnapshotRecord]
+pending_user_queues = {} # type: Dict[int, List[str]]
+# The restart event sent at startup, for delivery to pending queues
+# when they are restored.
+pending_restart_event = None # type: Optional[Dict[str, Any]]
+
+# Queues restored per IOLoop callback while restoring in the background.
+RESTORE_CHUNK_SIZE = 500
+# Queues written per IOLoop callback by periodic snapshots.
+SNAPSHOT_CHUNK_SIZE = 500
+
 def add_client_gc_hook(hook):
     # type: (Callable[[int, ClientDescriptor, bool], None]) -> None
     gc_hooks.append(hook)
 
 def get_client_descriptor(queue_id):
     # type: (str) -> ClientDescriptor
-    return clients.get(queue_id)
+    client = clients.get(queue_id)
+    if client is None and queue_id in pending_queues:
+        client = restore_pending_queue(queue_id)
+    return client
 
 def get_client_descriptors_for_user(user_profile_id):
     # type: (int) -> List[ClientDescriptor]
+    if user_profile_id in pending_user_queues:
+        for queue_id in list(pending_user_queues[user_profile_id]):
+            restore_pending_queue(queue_id)
     return user_clients.get(user_profile_id, [])
 
 def get_client_descriptors_for_realm_all_streams(realm_id):
     # type: (int) -> List[ClientDescriptor]
     return realm_clients_all_streams.get(realm_id, [])
 
+def get_client_descriptors_for_realm_stream(realm_id, stream_name):
+    # type: (int, Text) -> List[ClientDescriptor]
+    return realm_stream_clients.get((realm_id, stream_name.lower()), [])
+
+def narrow_stream_key(client):
+    # type: (ClientDescriptor) -> Optional[Tuple[int, Text]]
+    """The realm_stream_clients key for a client whose narrow only
+    accepts messages to one stream, or None."""
+    for element in client.narrow:
+        if element[0] == "stream":
+            return (client.realm_id, element[1].lower())
+    return None
+
 def add_to_client_dicts(client):
     # type: (ClientDescriptor) -> None
     user_clients.setdefault(client.user_profile_id, []).append(client)
     if client.all_public_streams or client.narrow != []:
-        realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
+        stream_key = narrow_stream_key(client)
+        if stream_key is not None:
+            realm_stream_clients.setdefault(stream_key, []).append(client)
+        else:
+            realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
+    schedule_gc(client)
+
+def schedule_gc(client):
+    # type: (ClientDescriptor) -> None
+    if not client.gc_scheduled:
+        heapq.heappush(gc_heap, (client.expiry_time(), client.event_queue.id))
+        client.gc_scheduled = True
 
 def allocate_client_descriptor(new_queue_data):
     # type: (MutableMapping[str, Any]) -> ClientDescriptor
     global next_queue_id
-    queue_id = str(settings.SERVER_GENERATION) + ':' + str(next_queue_id)
+    queue_id = (queue_id_prefix(get_current_shard()) +
+                str(settings.SERVER_GENERATION) + ':' + str(next_queue_id))
     next_queue_id += 1
     new_queue_data["event_queue"] = EventQueue(queue_id).to_dict()
     client = ClientDescriptor.from_dict(new_queue_data)
@@ -370,10 +536,47 @@ def allocate_client_descriptor(new_queue_data):
     add_to_client_dicts(client)
     return client
 
+def get_tornado_stats():
+    # type: () -> Dict[str, Any]
+    """Fan-out, queue depth and IOLoop metrics, for /tornado_stats."""
+    depths = [len(client.event_queue.queue) + len(client.event_queue.virtual_events)
+              for client in six.itervalues(clients)]
+    return dict(active_queues=len(clients),
+                active_users=len(user_clients),
+                presence_users=len(user_presences),
+                queue_depth=percentiles(depths),
+                fanout={event_type: stats.to_dict()
+                        for (event_type, stats) in six.iteritems(fanout_stats)},
+                ioloop=dict(lag=ioloop_lag_stats(),
+                            percent_busy=ioloop_logging.last_percent_busy))
+
+def get_event_queue_stats():
+    # type: () -> Dict[str, Any]
+    """Per-queue memory usage, for the tornado_queue_stats command."""
+    now = time.time()
+    queues = [] # type: List[Dict[str, Any]]
+    shared_payloads = {} # type: Dict[int, int]
+    for client in six.itervalues(clients):
+        event_queue = client.event_queue
+        for event in event_queue.queue:
+            message = event.get('message')
+            if isinstance(message, MessagePayload):
+                shared_payloads[id(message)] = len(message.encoded())
+        queues.append(dict(queue_id=event_queue.id,
+                           user_profile_id=client.user_profile_id,
+                           client_type_name=client.client_type_name,
+                           events=len(event_queue.queue) + len(event_queue.virtual_events),
+                           bytes=event_queue.byte_size,
+                           connected=client.current_handler_id is not None,
+                           idle_secs=int(now - client.last_connection_time)))
+    return dict(queues=queues,
+                shared_payload_bytes=sum(six.itervalues(shared_payloads)),
+                max_queue_bytes=settings.EVENT_QUEUE_MAX_BYTES)
+
 def do_gc_event_queues(to_remove, affected_users, affected_realms):
     # type: (AbstractSet[str], AbstractSet[int], AbstractSet[int]) -> None
     def filter_client_dict(client_dict, key):
-        # type: (MutableMapping[int, List[ClientDescriptor]], int) -> None
+        # type: (MutableMapping[Any, List[ClientDescriptor]], Any) -> None
         if key not in client_dict:
             return
 
@@ -390,8 +593,16 @@ def do_gc_event_queues(to_remove, affected_users, affected_realms):
         filter_client_dict(realm_clients_all_streams, realm_id)
 
     for id in to_remove:
+        stream_key = narrow_stream_key(clients[id])
+        if stream_key is not None:
+            filter_client_dict(realm_stream_clients, stream_key)
+
+    for id in to_remove:
+        user_profile_id = clients[id].user_profile_id
+        last_for_client = (user_profile_id not in user_clients and
+                           user_profile_id not in pending_user_queues)
         for cb in gc_hooks:
-            cb(clients[id].user_profile_id, clients[id], clients[id].user_profile_id not in user_clients)
+            cb(user_profile_id, clients[id], last_for_client)
         del clients[id]
 
 def gc_event_queues():
@@ -400,67 +611,185 @@ def gc_event_queues():
     to_remove = set() # type: Set[str]
     affected_users = set() # type: Set[int]
     affected_realms = set() # type: Set[int]
-    for (id, client) in six.iteritems(clients):
+    while gc_heap and gc_heap[0][0] <= start:
+        (expiry_time, id) = heapq.heappop(gc_heap)
+        client = clients.get(id)
+        if client is None:
+            # Already removed by cleanup()
+            continue
+        client.gc_scheduled = False
         if client.idle(start):
             to_remove.add(id)
             affected_users.add(client.user_profile_id)
             affected_realms.add(client.realm_id)
+        elif client.current_handler_id is None:
+            # Reconnected since this entry was pushed, but idle again
+            schedule_gc(client)
+        # Otherwise, disconnect_handler will reschedule it.
 
     # We don't need to call e.g. finish_current_handler on the clients
     # being removed because they are guaranteed to be idle and thus
     # not have a current handler.
     do_gc_event_queues(to_remove, affected_users, affected_realms)
 
+    pause = time.time() - start
     logging.info(('Tornado removed %d idle event queues owned by %d users in %.3fs.' +
                   '  Now %d active queues, %s')
-                 % (len(to_remove), len(affected_users), time.time() - start,
+                 % (len(to_remove), len(affected_users), pause,
                     len(clients), handler_stats_string()))
+    statsd.timing('tornado.gc_event_queues.pause', int(pause * 1000))
     statsd.gauge('tornado.active_queues', len(clients))
     statsd.gauge('tornado.active_users', len(user_clients))
-
-def dump_event_queues():
-    # type: () -> None
+    # Queue depth percentiles would cost a pass over every queue; they
+    # are computed when requested, by get_tornado_stats.
+
+def add_client_to_snapshot(writer, queue_id):
+    # type: (SnapshotWriter, str) -> None
+    client = clients.get(queue_id)
+    if client is not None:
+        writer.add(queue_id, client.user_profile_id,
+                   client.all_public_streams or client.narrow != [], client.to_dict())
+    elif queue_id in pending_queues:
+        # Never restored, so it can't have changed; copy it verbatim.
+        writer.add_record(pending_queues[queue_id])
+
+def dump_event_queues(filename=None):
+    # type: (Optional[str]) -> None
     start = time.time()
 
-    with open(settings.JSON_PERSISTENT_QUEUE_FILENAME, "w") as stored_queues:
-        ujson.dump([(qid, client.to_dict()) for (qid, client) in six.iteritems(clients)],
-                   stored_queues)
+    writer = SnapshotWriter(filename or settings.JSON_PERSISTENT_QUEUE_FILENAME)
+    for queue_id in list(clients.keys()) + list(pending_queues.keys()):
+        add_client_to_snapshot(writer, queue_id)
+    writer.commit()
 
     logging.info('Tornado dumped %d event queues in %.3fs'
-                 % (len(clients), time.time() - start))
+                 % (writer.count, time.time() - start))
 
-def load_event_queues():
+snapshot_in_progress = False
+
+def snapshot_event_queues():
     # type: () -> None
-    global clients
+    """Writes a snapshot a chunk of queues at a time, yielding to the
+    IOLoop in between, so that queues survive a crash without blocking
+    Tornado for a full dump.  Each queue is written as of the moment
+    its chunk is written."""
+    global snapshot_in_progress
+    if snapshot_in_progress:
+        return
+    snapshot_in_progress = True
     start = time.time()
+    queue_ids = list(clients.keys()) + list(pending_queues.keys())
+    writer = SnapshotWriter(settings.JSON_PERSISTENT_QUEUE_FILENAME)
+    ioloop = tornado.ioloop.IOLoop.instance()
 
-    # ujson chokes on bad input pretty easily.  We separate out the actual
-    # file reading from the loading so that we don't silently fail if we get
-    # bad input.
-    try:
-        with open(settings.JSON_PERSISTENT_QUEUE_FILENAME, "r") as stored_queues:
-            json_data = stored_queues.read()
+    def write_chunk(chunk_start):
+        # type: (int) -> None
+        global snapshot_in_progress
         try:
-            clients = dict((qid, ClientDescriptor.from_dict(client))
-                           for (qid, client) in ujson.loads(json_data))
+            for queue_id in queue_ids[chunk_start:chunk_start + SNAPSHOT_CHUNK_SIZE]:
+                add_client_to_snapshot(writer, queue_id)
+            if chunk_start + SNAPSHOT_CHUNK_SIZE < len(queue_ids):
+                ioloop.add_callback(write_chunk, chunk_start + SNAPSHOT_CHUNK_SIZE)
+                return
+            writer.commit()
+            logging.info('Tornado snapshotted %d event queues in %.3fs'
+                         % (writer.count, time.time() - start))
         except Exception:
-            logging.exception("Could not deserialize event queues")
-    except (IOError, EOFError):
-        pass
+            logging.exception("Could not snapshot event queues")
+            writer.abort()
+        snapshot_in_progress = False
+
+    write_chunk(0)
+
+def restore_pending_queue(queue_id):
+    # type: (str) -> Optional[ClientDescriptor]
+    record = pending_queues.pop(queue_id, None)
+    if record is None:
+        return None
+    user_queue_ids = pending_user_queues[record.user_profile_id]
+    user_queue_ids.remove(queue_id)
+    if len(user_queue_ids) == 0:
+        del pending_user_queues[record.user_profile_id]
 
-    for client in six.itervalues(clients):
-        # Put code for migrations due to event queue data format changes here
+    try:
+        client = ClientDescriptor.from_dict(record.load())
+    except Exception:
+        # A damaged queue only costs its own client a reload.
+        logging.exception("Could not restore event queue %s" % (queue_id,))
+        return None
 
-        add_to_client_dicts(client)
+    # Put code for migrations due to event queue data format changes here
 
-    logging.info('Tornado loaded %d event queues in %.3fs'
+    clients[queue_id] = client
+    add_to_client_dicts(client)
+    if pending_restart_event is not None and client.accepts_event(pending_restart_event):
+        client.add_event(dict(pending_restart_event))
+    return client
+
+def restore_pending_queues(limit=None):
+    # type: (Optional[int]) -> None
+    for queue_id in list(pending_queues.keys())[:limit]:
+        restore_pending_queue(queue_id)
+
+def restore_pending_queues_in_background(start):
+    # type: (float) -> None
+    global pending_restart_event
+    restore_pending_queues(RESTORE_CHUNK_SIZE)
+    if pending_queues:
+        tornado.ioloop.IOLoop.instance().add_callback(
+            restore_pending_queues_in_background, start)
+        return
+    pending_restart_event = None
+    logging.info('Tornado restored %d event queues in %.3fs'
                  % (len(clients), time.time() - start))
 
+def load_legacy_event_queues(data):
+    # type: (bytes) -> None
+    # Queues dumped as a single JSON document, before the snapshot format.
+    for (qid, client_dict) in ujson.loads(data):
+        client = ClientDescriptor.from_dict(client_dict)
+        clients[qid] = client
+        add_to_client_dicts(client)
+
+def load_event_queues(filename=None):
+    # type: (Optional[str]) -> None
+    start = time.time()
+
+    try:
+        with open(filename or settings.JSON_PERSISTENT_QUEUE_FILENAME, "rb") as stored_queues:
+            data = stored_queues.read()
+    except (IOError, EOFError):
+        return
+
+    try:
+        if not is_snapshot(data):
+            load_legacy_event_queues(data)
+        else:
+            for record in read_snapshot(data):
+                pending_queues[record.queue_id] = record
+                pending_user_queues.setdefault(record.user_profile_id, []).append(
+                    record.queue_id)
+                if record.realm_wide:
+                    # These receive events for users other than their
+                    # own, so can't be restored on demand.
+                    restore_pending_queue(record.queue_id)
+    except Exception:
+        logging.exception("Could not deserialize event queues")
+
+    logging.info('Tornado indexed %d event queues in %.3fs'
+                 % (len(clients) + len(pending_queues), time.time() - start))
+    if pending_queues:
+        tornado.ioloop.IOLoop.instance().add_callback(
+            restore_pending_queues_in_background, start)
+
 def send_restart_events(immediate=False):
     # type: (bool) -> None
+    global pending_restart_event
     event = dict(type='restart', server_generation=settings.SERVER_GENERATION) # type: Dict[str, Any]
     if immediate:
         event['immediate'] = True
+    if pending_queues:
+        pending_restart_event = event
     for client in six.itervalues(clients):
         if client.accepts_event(event):
             client.add_event(event.copy())
@@ -485,6 +814,14 @@ def setup_event_queue():
                                          EVENT_QUEUE_GC_FREQ_MSECS, ioloop)
     pc.start()
 
+    if not settings.TEST_SUITE:
+        start_ioloop_lag_monitor()
+
+    if settings.EVENT_QUEUE_SNAPSHOT_INTERVAL_SECS and not settings.TEST_SUITE:
+        snapshot_callback = tornado.ioloop.PeriodicCallback(
+            snapshot_event_queues, settings.EVENT_QUEUE_SNAPSHOT_INTERVAL_SECS * 1000, ioloop)
+        snapshot_callback.start()
+
     send_restart_events(immediate=settings.DEVELOPMENT)
 
 def fetch_events(query):
@@ -502,6 +839,8 @@ def fetch_events(query):
         was_connected = False
         orig_queue_id = queue_id
         extra_log_data = ""
+        if tornado_sharding_enabled() and not user_is_on_current_shard(user_profile_id):
+            raise JsonableError(_("This server does not handle event queues for this user"))
         if queue_id is None:
             if dont_block:
                 client = allocate_client_descriptor(new_queue_data)
@@ -563,7 +902,8 @@ def request_event_queue(user_profile, user_client, apply_markdown,
                         queue_lifespan_secs, event_types=None, all_public_streams=False,
                         narrow=[]):
     # type: (UserProfile, Client, bool, int, Optional[Iterable[str]], bool, Iterable[Sequence[Text]]) -> Optional[str]
-    if settings.TORNADO_SERVER:
+    tornado_uri = get_tornado_uri_for_user(user_profile.id)
+    if tornado_uri:
         req = {'dont_block': 'true',
                'apply_markdown': ujson.dumps(apply_markdown),
                'all_public_streams': ujson.dumps(all_public_streams),
@@ -575,7 +915,7 @@ def request_event_queue(user_profile, user_client, apply_markdown,
             req['event_types'] = ujson.dumps(event_types)
 
         try:
-            resp = requests_client.get(settings.TORNADO_SERVER + '/api/v1/events',
+            resp = requests_client.get(tornado_uri + '/api/v1/events',
                                        auth=requests.auth.HTTPBasicAuth(
                                            user_profile.email, user_profile.api_key),
                                        params=req)
@@ -585,7 +925,7 @@ def request_event_queue(user_profile, user_client, apply_markdown,
                           (settings.ERROR_FILE_LOG_PATH, "tornado.log"))
             raise requests.adapters.ConnectionError(
                 "Django cannot connect to Tornado server (%s); try restarting" %
-                (settings.TORNADO_SERVER))
+                (tornado_uri,))
 
         resp.raise_for_status()
 
@@ -595,8 +935,9 @@ def request_event_queue(user_profile, user_client, apply_markdown,
 
 def get_user_events(user_profile, queue_id, last_event_id):
     # type: (UserProfile, str, int) -> List[Dict]
-    if settings.TORNADO_SERVER:
-        resp = requests_client.get(settings.TORNADO_SERVER + '/api/v1/events',
+    tornado_uri = get_tornado_uri_for_user(user_profile.id)
+    if tornado_uri:
+        resp = requests_client.get(tornado_uri + '/api/v1/events',
                                    auth=requests.auth.HTTPBasicAuth(
                                        user_profile.email, user_profile.api_key),
                                    params={'queue_id': queue_id,
@@ -647,44 +988,22 @@ def missedmessage_hook(user_profile_id, queue, last_for_client):
         if notify_info.get('send_email', False):
             queue_json_publish("missedmessage_emails", notice, lambda notice: None)
 
-def receiver_is_idle(user_profile_id, realm_presences):
-    # type: (int, Optional[Dict[int, Dict[Text, Dict[str, Any]]]]) -> bool
+def receiver_is_idle(user_profile_id):
+    # type: (int) -> bool
     # If a user has no message-receiving event queues, they've got no open zulip
     # session so we notify them
     all_client_descriptors = get_client_descriptors_for_user(user_profile_id)
     message_event_queues = [client for client in all_client_descriptors if client.accepts_messages()]
-    off_zulip = len(message_event_queues) == 0
-
-    # It's possible a recipient is not in the realm of a sender. We don't have
-    # presence information in this case (and it's hard to get without an additional
-    # db query) so we simply don't try to guess if this cross-realm recipient
-    # has been idle for too long
-    if realm_presences is None or user_profile_id not in realm_presences:
-        return off_zulip
-
-    # We want to find the newest "active" presence entity and compare that to the
-    # activity expiry threshold.
-    user_presence = realm_presences[user_profile_id]
-    latest_active_timestamp = None
-    idle = False
-
-    for client, status in six.iteritems(user_presence):
-        if (latest_active_timestamp is None or status['timestamp'] > latest_active_timestamp) and \
-                status['status'] == 'active':
-            latest_active_timestamp = status['timestamp']
-
-    if latest_active_timestamp is None:
-        idle = True
-    else:
-        active_datetime = timestamp_to_datetime(latest_active_timestamp)
-        # 140 seconds is consistent with presence.js:OFFLINE_THRESHOLD_SECS
-        idle = timezone_now() - active_datetime > datetime.timedelta(seconds=140)
+    if len(message_event_queues) == 0:
+        return True
 
-    return off_zulip or idle
+    # Otherwise, they're idle if none of their clients has reported
+    # being active recently.  If they have no presence information at
+    # all, we don't try to guess.
+    return user_is_idle(user_profile_id) is True
 
 def process_message_event(event_template, users):
     # type: (Mapping[str, Any], Iterable[Mapping[str, Any]]) -> None
-    realm_presences = {int(k): v for k, v in event_template['presences'].items()} # type: Dict[int, Dict[Text, Dict[str, Any]]]
     sender_queue_id = event_template.get('sender_queue_id', None) # type: Optional[str]
     message_dict_markdown = event_template['message_dict_markdown'] # type: Dict[str, Any]
     message_dict_no_markdown = event_template['message_dict_no_markdown'] # type: Dict[str, Any]
@@ -700,7 +1019,10 @@ def process_message_event(event_template, users):
     extra_user_data = {} # type: Dict[int, Any]
 
     if 'stream_name' in event_template and not event_template.get("invite_only"):
-        for client in get_client_descriptors_for_realm_all_streams(event_template['realm_id']):
+        realm_id = event_template['realm_id'] # type: int
+        for client in (get_client_descriptors_for_realm_all_streams(realm_id) +
+                       get_client_descriptors_for_realm_stream(realm_id,
+                                                               event_template['stream_name'])):
             send_to_clients[client.event_queue.id] = {'client': client, 'flags': None}
             if sender_queue_id is not None and client.event_queue.id == sender_queue_id:
                 send_to_clients[client.event_queue.id]['is_sender'] = True
@@ -718,9 +1040,11 @@ def process_message_event(event_template, users):
         # or she was @-notified potentially notify more immediately
         received_pm = message_type == "private" and user_profile_id != sender_id
         mentioned = 'mentioned' in flags
-        idle = receiver_is_idle(user_profile_id, realm_presences)
+        if not (received_pm or mentioned):
+            continue
+        idle = receiver_is_idle(user_profile_id)
         always_push_notify = user_data.get('always_push_notify', False)
-        if (received_pm or mentioned) and (idle or always_push_notify):
+        if idle or always_push_notify:
             notice = build_offline_notification(user_profile_id, message_id)
             queue_json_publish("missedmessage_mobile_notifications", notice, lambda notice: None)
             notified = dict(push_notified=True) # type: Dict[str, bool]
@@ -733,6 +1057,13 @@ def process_message_event(event_template, users):
 
             extra_user_data[user_profile_id] = notified
 
+    # Every queue receiving the same variant of the message shares one
+    # MessagePayload, so the message is encoded at most once per variant.
+    payloads = {} # type: Dict[Tuple[bool, bool, Optional[bool]], MessagePayload]
+    # The envelopes around a payload only differ in a few small fields,
+    # so each variant's size is estimated once, for its first queue.
+    payload_sizes = {} # type: Dict[Tuple[bool, bool, Optional[bool]], int]
+
     for client_data in six.itervalues(send_to_clients):
         client = client_data['client']
         flags = client_data['flags']
@@ -745,19 +1076,26 @@ def process_message_event(event_template, users):
             # message data unnecessarily
             continue
 
-        if client.apply_markdown:
-            message_dict = message_dict_markdown
-        else:
-            message_dict = message_dict_no_markdown
-
         # Make sure Zephyr mirroring bots know whether stream is invite-only
-        if "mirror" in client.client_type_name and event_template.get("invite_only"):
-            message_dict = message_dict.copy()
-            message_dict["invite_only_stream"] = True
-
+        invite_only_stream = ("mirror" in client.client_type_name and
+                              bool(event_template.get("invite_only")))
+        is_mentioned = None # type: Optional[bool]
         if flags is not None:
-            message_dict['is_mentioned'] = 'mentioned' in flags
-        user_event = dict(type='message', message=message_dict, flags=flags) # type: Dict[str, Any]
+            is_mentioned = 'mentioned' in flags
+        payload_key = (client.apply_markdown, invite_only_stream, is_mentioned)
+        payload = payloads.get(payload_key)
+        if payload is None:
+            if client.apply_markdown:
+                message_dict = message_dict_markdown
+            else:
+                message_dict = message_dict_no_markdown
+            if invite_only_stream:
+                message_dict = message_dict.copy()
+                message_dict["invite_only_stream"] = True
+            payload = MessagePayload(message_dict, is_mentioned)
+            payloads[payload_key] = payload
+
+        user_event = dict(type='message', message=payload, flags=flags) # type: Dict[str, Any]
         if extra_data is not None:
             user_event.update(extra_data)
 
@@ -773,17 +1111,26 @@ def process_message_event(event_template, users):
         if ('mirror' in sending_client and
                 sending_client.lower() == client.client_type_name.lower()):
             continue
-        client.add_event(user_event)
+        if payload_key not in payload_sizes:
+            payload_sizes[payload_key] = estimate_event_size(user_event)
+        client.add_event(user_event, payload_sizes[payload_key])
 
 def process_event(event, users):
     # type: (Mapping[str, Any], Iterable[int]) -> None
+    # Measured once, when the first queue takes the event.
+    size = None # type: Optional[int]
     for user_profile_id in users:
         for client in get_client_descriptors_for_user(user_profile_id):
             if client.accepts_event(event):
-                client.add_event(dict(event))
+                if size is None:
+                    size = estimate_event_size(event)
+                client.add_event(dict(event), size)
 
 def process_userdata_event(event_template, users):
     # type: (Mapping[str, Any], Iterable[Mapping[str, Any]]) -> None
+    # The per-user data is small, so the template's size is a good
+    # enough estimate for every user's event.
+    size = None # type: Optional[int]
     for user_data in users:
         user_profile_id = user_data['id']
         user_event = dict(event_template) # shallow copy, but deep enough for our needs
@@ -793,42 +1140,78 @@ def process_userdata_event(event_template, users):
 
         for client in get_client_descriptors_for_user(user_profile_id):
             if client.accepts_event(user_event):
-                client.add_event(user_event)
+                if size is None:
+                    size = estimate_event_size(event_template)
+                client.add_event(user_event, size)
 
 def process_notification(notice):
     # type: (Mapping[str, Any]) -> None
+    if 'notices' in notice:
+        # A batch from zerver.tornado.notification_batch; dispatch it
+        # all from this one callback.
+        for batched_notice in notice['notices']:
+            process_notification(batched_notice)
+        return
+
     event = notice['event'] # type: Mapping[str, Any]
     users = notice['users'] # type: Union[Iterable[int], Iterable[Mapping[str, Any]]]
+    start = start_fanout()
     if event['type'] in ["update_message"]:
         process_userdata_event(event, cast(Iterable[Mapping[str, Any]], users))
     elif event['type'] == "message":
         process_message_event(event, cast(Iterable[Mapping[str, Any]], users))
+    elif event['type'] == "presence_refresh":
+        # Only for our presence table; clients get "presence" events.
+        update_user_presence(event['user_id'], event['presence'])
     else:
+        if event['type'] == "presence" and 'user_id' in event:
+            update_user_presence(event['user_id'], event['presence'])
         process_event(event, cast(Iterable[int], users))
+    finish_fanout(event['type'], start)
 
 # Runs in the Django process to send a notification to Tornado.
 #
 # We use JSON rather than bare form parameters, so that we can represent
 # different types and for compatibility with non-HTTP transports.
 
-def send_notification_http(data):
-    # type: (Mapping[str, Any]) -> None
-    if settings.TORNADO_SERVER and not settings.RUNNING_INSIDE_TORNADO:
-        requests_client.post(settings.TORNADO_SERVER + '/notify_tornado', data=dict(
+def send_notification_http(data, shard=0):
+    # type: (Mapping[str, Any], int) -> None
+    tornado_uri = get_tornado_uri(shard)
+    if tornado_uri and not settings.RUNNING_INSIDE_TORNADO:
+        requests_client.post(tornado_uri + '/notify_tornado', data=dict(
             data   = ujson.dumps(data),
             secret = settings.SHARED_SECRET))
     else:
         process_notification(data)
 
-def send_notification(data):
-    # type: (Mapping[str, Any]) -> None
-    queue_json_publish("notify_tornado", data, send_notification_http)
+def send_notification(data, shard=0):
+    # type: (Mapping[str, Any], int) -> None
+    queue_json_publish(notify_tornado_queue_name(shard), data,
+                       lambda data: send_notification_http(data, shard))
+
+def send_notice(notice, shard):
+    # type: (Mapping[str, Any], int) -> None
+    if notification_batch_open():
+        add_to_notification_batch(notice, shard)
+    else:
+        send_notification(notice, shard)
 
 def send_event(event, users):
     # type: (Mapping[str, Any], Union[Iterable[int], Iterable[Mapping[str, Any]]]) -> None
     """`users` is a list of user IDs, or in the case of `message` type
     events, a list of dicts describing the users and metadata about
     the user/message pair."""
-    queue_json_publish("notify_tornado",
-                       dict(event=event, users=users),
-                       send_notification_http)
+    if not tornado_sharding_enabled():
+        send_notice(dict(event=event, users=users), 0)
+        return
+
+    # Each shard only gets the users whose queues it owns; messages to
+    # public streams go to every shard, for the benefit of
+    # all_public_streams and narrowed queues.
+    users_by_shard = partition_users_by_shard(users)
+    if event_needs_all_shards(event):
+        shards = range(get_tornado_shard_count()) # type: Iterable[int]
+    else:
+        shards = sorted(users_by_shard.keys())
+    for shard in shards:
+        send_notice(dict(event=event, users=users_by_shard.get(shard, [])), shard)
@@ -17,9 +17,9 @@ from tornado.wsgi import WSGIContainer
 from six.moves import urllib
 
 from zerver.decorator import RespondAsynchronously
-from zerver.lib.response import json_response
 from zerver.middleware import async_request_stop, async_request_restart
 from zerver.tornado.descriptors import get_descriptor_by_handler_id
+from zerver.tornado.message_payload import json_events_response
 
 from typing import Any, Callable, Dict, List
 
@@ -306,9 +306,10 @@ class AsyncDjangoHandler(tornado.web.RequestHandler, base.BaseHandler):
         # e.g. our own logging code can run; but don't actually use
         # the headers from that since sending those to Tornado seems
         # tricky; instead just send the (already json-rendered)
-        # content on to Tornado
-        django_response = json_response(res_type=response['result'],
-                                        data=response, status=self.get_status())
+        # content on to Tornado.  Shared message payloads in `events`
+        # are spliced in already encoded, rather than re-encoded here.
+        django_response = json_events_response(res_type=response['result'],
+                                               data=response, status=self.get_status())
         django_response = self.apply_response_middleware(request, django_response,
                                                          request._resolver)
         # Pass through the content-type from Django, as json content should be
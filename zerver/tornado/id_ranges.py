@@ -0,0 +1,60 @@
+from __future__ import absolute_import
+
+from typing import Iterable, List
+
+# Sets of message ids stored as sorted, non-overlapping, non-adjacent
+# inclusive [start, end] ranges.  Flag changes usually cover runs of
+# consecutive message ids (e.g. marking a narrow as read), so this
+# keeps the virtual flags events in EventQueue bounded by the number of
+# distinct runs, however many times the ids are added or removed.
+#
+# Ranges are plain lists so that they can be persisted as JSON with the
+# rest of the queue.
+
+IdRanges = List[List[int]]
+
+def ids_to_ranges(ids):
+    # type: (Iterable[int]) -> IdRanges
+    ranges = [] # type: IdRanges
+    for id in sorted(set(ids)):
+        if ranges and ranges[-1][1] + 1 == id:
+            ranges[-1][1] = id
+        else:
+            ranges.append([id, id])
+    return ranges
+
+def ranges_to_ids(ranges):
+    # type: (IdRanges) -> List[int]
+    ids = [] # type: List[int]
+    for (start, end) in ranges:
+        ids.extend(range(start, end + 1))
+    return ids
+
+def add_ids_to_ranges(ranges, ids):
+    # type: (IdRanges, Iterable[int]) -> IdRanges
+    merged = [] # type: IdRanges
+    for (start, end) in sorted(ranges + ids_to_ranges(ids)):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+def remove_ids_from_ranges(ranges, ids):
+    # type: (IdRanges, Iterable[int]) -> IdRanges
+    result = [] # type: IdRanges
+    removed = ids_to_ranges(ids)
+    i = 0
+    for (start, end) in ranges:
+        # Skip removed ranges entirely before this one
+        while i < len(removed) and removed[i][1] < start:
+            i += 1
+        j = i
+        while j < len(removed) and removed[j][0] <= end:
+            if removed[j][0] > start:
+                result.append([start, removed[j][0] - 1])
+            start = max(start, removed[j][1] + 1)
+            j += 1
+        if start <= end:
+            result.append([start, end])
+    return result
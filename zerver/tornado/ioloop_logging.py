@@ -1,6 +1,6 @@
 from __future__ import absolute_import
 from __future__ import division
-from typing import Any, List, Tuple
+from typing import Any, List, Optional, Tuple
 
 import logging
 import time
@@ -31,6 +31,10 @@ except Exception:
         # type: () -> None
         IOLoop.configure(InstrumentedPollIOLoop)
 
+# The most recently computed percentage of time spent outside poll; see
+# zerver.tornado.stats.
+last_percent_busy = None # type: Optional[float]
+
 # A hack to keep track of how much time we spend working, versus sleeping in
 # the event loop.
 #
@@ -78,7 +82,9 @@ class InstrumentedPoll(object):
             total = t1 - self._times[0][0]
             in_poll = sum(b-a for a, b in self._times)
             if total > 0:
+                global last_percent_busy
                 percent_busy = 100 * (1 - in_poll / total)
+                last_percent_busy = percent_busy
                 if settings.PRODUCTION or percent_busy > 20:
                     logging.info('Tornado %5.1f%% busy over the past %4.1f seconds'
                                  % (percent_busy, total))
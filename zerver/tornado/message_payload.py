@@ -0,0 +1,98 @@
+from __future__ import absolute_import
+
+from django.http import HttpResponse
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Text
+import ujson
+
+# A message sent to a busy realm is delivered to thousands of event
+# queues.  Rather than giving each queue its own copy of the message
+# dict (and then JSON-encoding that copy again in every /events
+# response), process_message_event wraps the message in a
+# MessagePayload shared by every queue that gets the same variant of
+# the message.  The per-queue event is then just a small envelope
+# (type, id, flags, local_message_id, notification flags) around it,
+# and the payload is encoded at most once and spliced into each
+# response by encode_event.
+
+class MessagePayload(object):
+    __slots__ = ('message_dict', 'is_mentioned', '_encoded')
+
+    def __init__(self, message_dict, is_mentioned=None):
+        # type: (Mapping[str, Any], Optional[bool]) -> None
+        self.message_dict = message_dict
+        self.is_mentioned = is_mentioned
+        self._encoded = None # type: Optional[str]
+
+    def __getitem__(self, key):
+        # type: (str) -> Any
+        # Lets code that inspects queued events (narrow filters,
+        # missedmessage_hook, apply_events) treat us like the dict.
+        if key == 'is_mentioned' and self.is_mentioned is not None:
+            return self.is_mentioned
+        return self.message_dict[key]
+
+    def to_dict(self):
+        # type: () -> Dict[str, Any]
+        message_dict = dict(self.message_dict)
+        if self.is_mentioned is not None:
+            message_dict['is_mentioned'] = self.is_mentioned
+        return message_dict
+
+    def encoded(self):
+        # type: () -> str
+        if self._encoded is None:
+            self._encoded = ujson.dumps(self.to_dict())
+        return self._encoded
+
+def expand_event(event):
+    # type: (Dict[str, Any]) -> Dict[str, Any]
+    """Returns `event` with any shared message payload replaced by a
+    plain message dict, for code that needs real dicts (e.g. when
+    persisting queues across restarts)."""
+    message = event.get('message')
+    if not isinstance(message, MessagePayload):
+        return event
+    expanded = dict(event)
+    expanded['message'] = message.to_dict()
+    return expanded
+
+def encode_event(event):
+    # type: (Mapping[str, Any]) -> str
+    message = event.get('message')
+    if not isinstance(message, MessagePayload):
+        return ujson.dumps(event)
+    envelope = {key: value for key, value in event.items() if key != 'message'}
+    # The envelope always has at least `type` and `id`, so it is
+    # never encoded as the empty object.
+    return ujson.dumps(envelope)[:-1] + ',"message":' + message.encoded() + '}'
+
+def estimate_event_size(event):
+    # type: (Mapping[str, Any]) -> int
+    """The length of encode_event(event), without building the string.
+
+    A shared payload is counted in full for every queue holding it,
+    which overestimates the memory a queue pins, but is what it costs
+    to deliver."""
+    message = event.get('message')
+    if not isinstance(message, MessagePayload):
+        return len(ujson.dumps(event))
+    envelope = {key: value for key, value in event.items() if key != 'message'}
+    return len(ujson.dumps(envelope)) + len(',"message":') + len(message.encoded())
+
+def encode_events(events):
+    # type: (Iterable[Mapping[str, Any]]) -> str
+    return '[' + ','.join(encode_event(event) for event in events) + ']'
+
+def json_events_response(res_type="success", msg="", data=None, status=200):
+    # type: (Text, Text, Optional[Dict[str, Any]], int) -> HttpResponse
+    """Like zerver.lib.response.json_response, but `data['events']` may
+    contain events with shared message payloads."""
+    content = {"result": res_type, "msg": msg}
+    if data is not None:
+        content.update(data)
+    events = content.pop('events', None) # type: Optional[List[Dict[str, Any]]]
+    encoded = ujson.dumps(content)
+    if events is not None:
+        encoded = encoded[:-1] + ',"events":' + encode_events(events) + '}'
+    return HttpResponse(content=encoded + "\n",
+                        content_type='application/json', status=status)
@@ -0,0 +1,71 @@
+from __future__ import absolute_import
+
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Mapping
+
+import copy
+import threading
+
+# Bulk actions (subscribing many users, renaming a stream, changing a
+# realm-wide setting) call send_event many times.  Sending each event
+# to Tornado separately costs a round trip (an internal HTTP request,
+# or a RabbitMQ message) per event.  While a batch is open, send_event
+# instead buffers its notifications here, and they are sent to each
+# Tornado shard as a single {"notices": [...]} notification when the
+# outermost batch finishes; process_notification dispatches the whole
+# batch in one go.
+#
+# BatchTornadoNotifications opens a batch for each Django request, so
+# its events are sent once the response is ready.  Since Zulip runs
+# in autocommit mode, that is after the request's changes are
+# committed.  Code that uses transaction.atomic() directly should open
+# its batch outside the atomic block, so that events are not sent
+# before the changes they describe are committed.
+
+batch_state = threading.local()
+
+def notification_batch_open():
+    # type: () -> bool
+    return getattr(batch_state, 'depth', 0) > 0
+
+def start_notification_batch():
+    # type: () -> None
+    if not notification_batch_open():
+        batch_state.depth = 0
+        batch_state.notices = {}
+    batch_state.depth += 1
+
+def add_to_notification_batch(notice, shard):
+    # type: (Mapping[str, Any], int) -> None
+    # Copy now, since callers may reuse or mutate `notice` after
+    # send_event returns.
+    batch_state.notices.setdefault(shard, []).append(copy.deepcopy(notice))
+
+def finish_notification_batch():
+    # type: () -> None
+    batch_state.depth -= 1
+    if batch_state.depth == 0:
+        flush_notification_batch()
+
+def flush_notification_batch():
+    # type: () -> None
+    from zerver.tornado.event_queue import send_notification
+
+    notices_by_shard = batch_state.notices # type: Dict[int, List[Mapping[str, Any]]]
+    batch_state.depth = 0
+    batch_state.notices = {}
+    for shard in sorted(notices_by_shard.keys()):
+        notices = notices_by_shard[shard]
+        if len(notices) == 1:
+            send_notification(notices[0], shard)
+        else:
+            send_notification(dict(notices=notices), shard)
+
+@contextmanager
+def batched_notifications():
+    # type: () -> Iterator[None]
+    start_notification_batch()
+    try:
+        yield
+    finally:
+        finish_notification_batch()
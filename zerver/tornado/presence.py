@@ -0,0 +1,65 @@
+from __future__ import absolute_import
+
+from typing import Any, Dict, Mapping, Optional, Text, Tuple
+
+from zerver.tornado.sharding import user_is_on_current_shard
+
+import six
+import time
+
+# Tornado's own table of user presence, used by receiver_is_idle to
+# decide whether the recipients of a message should get missed message
+# notifications.  It is fed by the notifications Django already sends:
+#
+# * "presence" events, sent to the whole realm when a user comes
+#   online (see send_presence_changed), and
+# * "presence_refresh" notices, sent only to the user's own shard when
+#   the presence worker records a change of a user's status, and at
+#   most every PRESENCE_REFRESH_INTERVAL_SECS (see zerver/lib/actions.py)
+#   while the user keeps pinging as active.  These update the table and are never delivered
+#   to event queues.
+#
+# The table is never filled from the database, since that would block
+# the IOLoop: a user whose active timestamp has gone stale is idle, and
+# a user we have heard nothing about since Tornado started (at most
+# PRESENCE_REFRESH_INTERVAL_SECS plus one ping for active users) isn't
+# guessed about.
+#
+# A shard only keeps the presence of the users whose queues it owns,
+# since those are the only recipients it checks.
+
+# Consistent with presence.js:OFFLINE_THRESHOLD_SECS
+OFFLINE_THRESHOLD_SECS = 140
+
+# user_profile_id -> client name -> (is_active, timestamp)
+user_presences = {} # type: Dict[int, Dict[Text, Tuple[bool, int]]]
+
+def update_user_presence(user_profile_id, presence):
+    # type: (int, Mapping[Text, Mapping[str, Any]]) -> None
+    """`presence` maps client names to UserPresence.to_dict() dicts, as
+    in presence events."""
+    if not user_is_on_current_shard(user_profile_id):
+        return
+    clients = user_presences.setdefault(user_profile_id, {})
+    for client_name, info in six.iteritems(presence):
+        clients[client_name] = (info['status'] == 'active', info['timestamp'])
+
+def clients_are_idle(clients, now):
+    # type: (Dict[Text, Tuple[bool, int]], float) -> bool
+    active_timestamps = [timestamp for (active, timestamp) in clients.values() if active]
+    if not active_timestamps:
+        return True
+    return now - max(active_timestamps) > OFFLINE_THRESHOLD_SECS
+
+def user_is_idle(user_profile_id, now=None):
+    # type: (int, Optional[float]) -> Optional[bool]
+    """Whether the user has no client that reported being active in the
+    last OFFLINE_THRESHOLD_SECS, or None if they have no presence data
+    at all."""
+    if now is None:
+        now = time.time()
+
+    clients = user_presences.get(user_profile_id)
+    if not clients:
+        return None
+    return clients_are_idle(clients, now)
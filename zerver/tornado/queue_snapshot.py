@@ -0,0 +1,136 @@
+from __future__ import absolute_import
+
+from typing import Any, Dict, Iterator
+
+import logging
+import os
+import struct
+import tempfile
+import ujson
+import zlib
+
+# Tornado persists its event queues across restarts in a snapshot file
+# (settings.JSON_PERSISTENT_QUEUE_FILENAME).  The format is a file
+# header followed by one length-prefixed record per queue:
+#
+#   file header:  8-byte magic, 4-byte version
+#   record:       4-byte key length, 4-byte body length,
+#                 4-byte CRC32 of key + body, key, body
+#
+# The key is a small JSON list [queue_id, user_profile_id, realm_wide]
+# and the body is the JSON of ClientDescriptor.to_dict().  Keeping the
+# key separate lets load_event_queues index the whole file without
+# parsing any queue bodies, and restore queues incrementally (see
+# zerver/tornado/event_queue.py).  The CRC means a damaged record only
+# loses that one queue.
+#
+# Snapshots are written to a temporary file that is renamed into place
+# once complete, so a crash while writing leaves the previous snapshot
+# intact.
+
+SNAPSHOT_MAGIC = b'ZulipEQ\n'
+SNAPSHOT_VERSION = 1
+
+FILE_HEADER = struct.Struct('>8sI')
+RECORD_HEADER = struct.Struct('>III')
+
+class SnapshotFormatError(Exception):
+    pass
+
+class SnapshotRecord(object):
+    """A queue that has been indexed but not decoded yet."""
+    __slots__ = ('queue_id', 'user_profile_id', 'realm_wide', 'raw', 'body_start', 'crc')
+
+    def __init__(self, queue_id, user_profile_id, realm_wide, raw, body_start, crc):
+        # type: (str, int, bool, bytes, int, int) -> None
+        self.queue_id = queue_id
+        self.user_profile_id = user_profile_id
+        self.realm_wide = realm_wide
+        # The whole encoded record, header included, so that queues
+        # that were never restored can be written back out unchanged.
+        self.raw = raw
+        self.body_start = body_start
+        self.crc = crc
+
+    def load(self):
+        # type: () -> Dict[str, Any]
+        payload = self.raw[RECORD_HEADER.size:]
+        if zlib.crc32(payload) & 0xffffffff != self.crc:
+            raise SnapshotFormatError("Checksum mismatch for event queue %s" % (self.queue_id,))
+        return ujson.loads(self.raw[self.body_start:].decode('utf-8'))
+
+def encode_record(queue_id, user_profile_id, realm_wide, client_dict):
+    # type: (str, int, bool, Dict[str, Any]) -> bytes
+    key = ujson.dumps([queue_id, user_profile_id, realm_wide]).encode('utf-8')
+    body = ujson.dumps(client_dict).encode('utf-8')
+    crc = zlib.crc32(key + body) & 0xffffffff
+    return RECORD_HEADER.pack(len(key), len(body), crc) + key + body
+
+def is_snapshot(data):
+    # type: (bytes) -> bool
+    return data[:len(SNAPSHOT_MAGIC)] == SNAPSHOT_MAGIC
+
+def read_snapshot(data):
+    # type: (bytes) -> Iterator[SnapshotRecord]
+    """Indexes the records in `data`, skipping records whose key can't
+    be parsed.  Stops at the first truncated record, since the length
+    fields after it can't be trusted."""
+    magic, version = FILE_HEADER.unpack_from(data, 0)
+    if version != SNAPSHOT_VERSION:
+        raise SnapshotFormatError("Unsupported event queue snapshot version %s" % (version,))
+
+    offset = FILE_HEADER.size
+    while offset < len(data):
+        if offset + RECORD_HEADER.size > len(data):
+            logging.error("Event queue snapshot is truncated at byte %d" % (offset,))
+            return
+        key_length, body_length, crc = RECORD_HEADER.unpack_from(data, offset)
+        body_start = offset + RECORD_HEADER.size + key_length
+        end = body_start + body_length
+        if end > len(data):
+            logging.error("Event queue snapshot is truncated at byte %d" % (offset,))
+            return
+        try:
+            queue_id, user_profile_id, realm_wide = ujson.loads(
+                data[offset + RECORD_HEADER.size:body_start].decode('utf-8'))
+        except Exception:
+            logging.exception("Skipping unreadable event queue record at byte %d" % (offset,))
+        else:
+            yield SnapshotRecord(str(queue_id), user_profile_id, realm_wide,
+                                 data[offset:end], body_start - offset, crc)
+        offset = end
+
+class SnapshotWriter(object):
+    """Streams records to a temporary file; commit() atomically replaces
+    `filename` with it."""
+
+    def __init__(self, filename):
+        # type: (str) -> None
+        self.filename = filename
+        # A unique name, since a periodic snapshot may still be in
+        # progress when Tornado dumps its queues on shutdown.
+        fd, self.tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+                                                 prefix=os.path.basename(filename) + '.')
+        self.count = 0
+        self.file = os.fdopen(fd, 'wb')
+        self.file.write(FILE_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION))
+
+    def add(self, queue_id, user_profile_id, realm_wide, client_dict):
+        # type: (str, int, bool, Dict[str, Any]) -> None
+        self.file.write(encode_record(queue_id, user_profile_id, realm_wide, client_dict))
+        self.count += 1
+
+    def add_record(self, record):
+        # type: (SnapshotRecord) -> None
+        self.file.write(record.raw)
+        self.count += 1
+
+    def commit(self):
+        # type: () -> None
+        self.file.close()
+        os.rename(self.tmp_filename, self.filename)
+
+    def abort(self):
+        # type: () -> None
+        self.file.close()
+        os.unlink(self.tmp_filename)
@@ -0,0 +1,101 @@
+from __future__ import absolute_import
+
+from django.conf import settings
+
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Text, Union
+
+# Zulip can run several Tornado processes ("shards"), each of which
+# owns the event queues of a partition of the users, so that
+# long-polling isn't limited to a single core.  A user's queues always
+# live on the shard user_profile_id modulo the number of shards.
+#
+# Sharding is enabled by listing one port per shard in
+# settings.TORNADO_SHARD_PORTS (in production, `tornado_ports` in the
+# [application_server] section of /etc/zulip/zulip.conf, which puppet
+# also uses to configure supervisor and nginx); with the default empty
+# list, everything goes to the single Tornado server at
+# settings.TORNADO_SERVER.
+#
+# Event queue ids allocated by a shard are prefixed with the shard
+# number (see allocate_client_descriptor), which lets nginx route a
+# client's /json/events and /api/v1/events requests to the shard that
+# owns the queue by their queue_id parameter.
+
+UserList = Union[Iterable[int], Iterable[Mapping[str, Any]]]
+
+def tornado_sharding_enabled():
+    # type: () -> bool
+    return len(settings.TORNADO_SHARD_PORTS) > 1
+
+def get_tornado_shard_count():
+    # type: () -> int
+    return max(1, len(settings.TORNADO_SHARD_PORTS))
+
+def get_user_shard(user_profile_id):
+    # type: (int) -> int
+    return user_profile_id % get_tornado_shard_count()
+
+def get_current_shard():
+    # type: () -> int
+    """The shard served by this Tornado process; see runtornado."""
+    return settings.TORNADO_SHARD
+
+def user_is_on_current_shard(user_profile_id):
+    # type: (int) -> bool
+    return get_user_shard(user_profile_id) == get_current_shard()
+
+def get_tornado_uri(shard):
+    # type: (int) -> Optional[str]
+    if settings.TORNADO_SERVER is None or not tornado_sharding_enabled():
+        return settings.TORNADO_SERVER
+    return 'http://%s:%d' % (settings.TORNADO_SHARD_HOST,
+                             settings.TORNADO_SHARD_PORTS[shard])
+
+def get_tornado_uri_for_user(user_profile_id):
+    # type: (int) -> Optional[str]
+    return get_tornado_uri(get_user_shard(user_profile_id))
+
+def notify_tornado_queue_name(shard):
+    # type: (int) -> str
+    if not tornado_sharding_enabled():
+        return 'notify_tornado'
+    return 'notify_tornado_shard_%d' % (shard,)
+
+def tornado_return_queue_name(shard):
+    # type: (int) -> str
+    if not tornado_sharding_enabled():
+        return 'tornado_return'
+    return 'tornado_return_shard_%d' % (shard,)
+
+def queue_id_prefix(shard):
+    # type: (int) -> str
+    if not tornado_sharding_enabled():
+        return ''
+    return '%d:' % (shard,)
+
+def get_shard_for_queue_id(queue_id):
+    # type: (Text) -> int
+    if not tornado_sharding_enabled():
+        return 0
+    return int(queue_id.split(':', 1)[0])
+
+def partition_users_by_shard(users):
+    # type: (UserList) -> Dict[int, List[Any]]
+    """Splits the `users` argument of send_event (user ids, or user
+    dicts for message events) by the shard that owns each user."""
+    users_by_shard = {} # type: Dict[int, List[Any]]
+    for user in users:
+        if isinstance(user, Mapping):
+            user_profile_id = user['id']
+        else:
+            user_profile_id = user
+        users_by_shard.setdefault(get_user_shard(user_profile_id), []).append(user)
+    return users_by_shard
+
+def event_needs_all_shards(event):
+    # type: (Mapping[str, Any]) -> bool
+    """Messages to public streams must reach every shard, since any
+    shard may own an all_public_streams or narrowed queue for the
+    realm (see get_client_descriptors_for_realm_all_streams)."""
+    return (event['type'] == 'message' and 'stream_name' in event and
+            not event.get('invite_only'))
@@ -30,6 +30,7 @@ from zerver.middleware import record_request_start_data, record_request_stop_dat
 from zerver.lib.redis_utils import get_redis_client
 from zerver.lib.sessions import get_session_user
 from zerver.tornado.event_queue import get_client_descriptor
+from zerver.tornado.sharding import tornado_return_queue_name
 
 logger = logging.getLogger('zulip.socket')
 
@@ -223,7 +224,8 @@ class SocketConnection(sockjs.tornado.SockJSConnection):
                                 req_id=msg['req_id'],
                                 server_meta=dict(user_id=self.session.user_profile.id,
                                                  client_id=self.client_id,
-                                                 return_queue="tornado_return",
+                                                 return_queue=tornado_return_queue_name(
+                                                     settings.TORNADO_SHARD),
                                                  log_data=log_data,
                                                  request_environ=dict(REMOTE_ADDR=self.session.conn_info.ip))),
                            fake_message_sender)
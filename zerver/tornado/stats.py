@@ -0,0 +1,124 @@
+from __future__ import absolute_import
+from __future__ import division
+
+from collections import deque
+from typing import Any, Dict, Sequence
+
+from zerver.lib.utils import statsd
+
+import time
+import tornado.ioloop
+
+# Metrics on how the Tornado process spends its single core:
+#
+# * per event type, how long process_notification takes to deliver an
+#   event to every queue (its "fan-out") and how many queues it touches
+# * how deep event queues are (see get_tornado_stats in event_queue.py)
+# * IOLoop lag: how late a timer scheduled every second actually runs,
+#   which is how long anything else waiting on the IOLoop was delayed
+#
+# These are reported to statsd as they happen, and are served as JSON
+# by the internal /tornado_stats endpoint.
+
+# Upper bounds of the buckets of the clients-touched histograms.
+CLIENTS_TOUCHED_BUCKETS = [0, 1, 10, 100, 1000, 10000]
+
+IOLOOP_LAG_INTERVAL_SECS = 1.0
+# Number of IOLoop lag samples kept for the JSON endpoint.
+IOLOOP_LAG_SAMPLES = 300
+
+class FanoutStats(object):
+    __slots__ = ('count', 'total_secs', 'max_secs', 'clients_touched', 'histogram')
+
+    def __init__(self):
+        # type: () -> None
+        self.count = 0
+        self.total_secs = 0.0
+        self.max_secs = 0.0
+        self.clients_touched = 0
+        # One more bucket than CLIENTS_TOUCHED_BUCKETS, for everything larger.
+        self.histogram = [0] * (len(CLIENTS_TOUCHED_BUCKETS) + 1)
+
+    def record(self, secs, clients_touched):
+        # type: (float, int) -> None
+        self.count += 1
+        self.total_secs += secs
+        self.max_secs = max(self.max_secs, secs)
+        self.clients_touched += clients_touched
+        for i, bound in enumerate(CLIENTS_TOUCHED_BUCKETS):
+            if clients_touched <= bound:
+                self.histogram[i] += 1
+                break
+        else:
+            self.histogram[-1] += 1
+
+    def to_dict(self):
+        # type: () -> Dict[str, Any]
+        labels = ['<=%d' % (bound,) for bound in CLIENTS_TOUCHED_BUCKETS]
+        labels.append('>%d' % (CLIENTS_TOUCHED_BUCKETS[-1],))
+        return dict(count=self.count,
+                    total_secs=self.total_secs,
+                    mean_secs=self.total_secs / self.count if self.count else 0.0,
+                    max_secs=self.max_secs,
+                    clients_touched=self.clients_touched,
+                    clients_touched_histogram=dict(zip(labels, self.histogram)))
+
+fanout_stats = {} # type: Dict[str, FanoutStats]
+# Number of add_event calls since the current notification started.
+fanout_clients_touched = 0
+ioloop_lag_samples = deque(maxlen=IOLOOP_LAG_SAMPLES) # type: deque[float]
+
+def note_client_touched():
+    # type: () -> None
+    global fanout_clients_touched
+    fanout_clients_touched += 1
+
+def start_fanout():
+    # type: () -> float
+    global fanout_clients_touched
+    fanout_clients_touched = 0
+    return time.time()
+
+def finish_fanout(event_type, start):
+    # type: (str, float) -> None
+    secs = time.time() - start
+    fanout_stats.setdefault(event_type, FanoutStats()).record(secs, fanout_clients_touched)
+    statsd.timing('tornado.fanout.%s' % (event_type,), int(secs * 1000))
+    statsd.timing('tornado.fanout_clients.%s' % (event_type,), fanout_clients_touched)
+
+def percentiles(values):
+    # type: (Sequence[int]) -> Dict[str, int]
+    values = sorted(values)
+    if not values:
+        return dict(p50=0, p90=0, p99=0, max=0)
+
+    def percentile(p):
+        # type: (float) -> int
+        return values[min(len(values) - 1, int(len(values) * p))]
+    return dict(p50=percentile(0.5), p90=percentile(0.9), p99=percentile(0.99),
+                max=values[-1])
+
+def start_ioloop_lag_monitor():
+    # type: () -> None
+    ioloop = tornado.ioloop.IOLoop.instance()
+
+    def check_lag(expected):
+        # type: (float) -> None
+        now = time.time()
+        lag = max(0.0, now - expected)
+        ioloop_lag_samples.append(lag)
+        statsd.timing('tornado.ioloop_lag', int(lag * 1000))
+        ioloop.add_timeout(now + IOLOOP_LAG_INTERVAL_SECS,
+                           lambda: check_lag(now + IOLOOP_LAG_INTERVAL_SECS))
+
+    first = time.time() + IOLOOP_LAG_INTERVAL_SECS
+    ioloop.add_timeout(first, lambda: check_lag(first))
+
+def ioloop_lag_stats():
+    # type: () -> Dict[str, float]
+    samples = list(ioloop_lag_samples)
+    if not samples:
+        return dict(last_secs=0.0, mean_secs=0.0, max_secs=0.0)
+    return dict(last_secs=samples[-1],
+                mean_secs=sum(samples) / len(samples),
+                max_secs=max(samples))
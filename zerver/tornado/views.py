@@ -11,8 +11,9 @@ from zerver.decorator import asynchronous, \
 
 from zerver.lib.response import json_success, json_error
 from zerver.lib.validator import check_bool, check_list, check_string
+from zerver.tornado.message_payload import json_events_response
 from zerver.tornado.event_queue import get_client_descriptor, \
-    process_notification, fetch_events
+    get_event_queue_stats, get_tornado_stats, process_notification, fetch_events
 from django.core.handlers.base import BaseHandler
 
 from typing import Union, Optional, Iterable, Sequence, List, Text
@@ -25,6 +26,16 @@ def notify(request):
     process_notification(ujson.loads(request.POST['data']))
     return json_success()
 
+@internal_notify_view(True)
+def queue_stats(request):
+    # type: (HttpRequest) -> HttpResponse
+    return json_success(get_event_queue_stats())
+
+@internal_notify_view(True)
+def tornado_stats(request):
+    # type: (HttpRequest) -> HttpResponse
+    return json_success(get_tornado_stats())
+
 @has_request_variables
 def cleanup_event_queue(request, user_profile, queue_id=REQ()):
     # type: (HttpRequest, UserProfile, Text) -> HttpResponse
@@ -88,4 +99,4 @@ def get_events_backend(request, user_profile, handler,
         return RespondAsynchronously
     if result["type"] == "error":
         return json_error(result["message"])
-    return json_success(result["response"])
+    return json_events_response(data=result["response"])
@@ -3,6 +3,7 @@ from typing import Any, List, Dict, Optional, Text
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.db.models import Sum
 from django.http import HttpResponseRedirect, HttpResponse, HttpRequest
 from django.shortcuts import redirect, render
 from django.utils import translation
@@ -14,7 +15,7 @@ from zerver.forms import ToSForm
 from zerver.lib.realm_icon import realm_icon_url
 from zerver.models import Message, UserProfile, Stream, Subscription, Huddle, \
     Recipient, Realm, UserMessage, DefaultStream, RealmEmoji, RealmDomain, \
-    RealmFilter, PreregistrationUser, UserActivity, \
+    RealmFilter, PreregistrationUser, UserActivity, UnreadMessageCount, \
     UserPresence, get_recipient, name_changes_disabled, email_to_username, \
     list_of_domains_for_realm
 from zerver.lib.events import do_events_register
@@ -26,6 +27,7 @@ from zerver.lib.i18n import get_language_list, get_language_name, \
 from zerver.lib.push_notifications import num_push_devices_for_user
 from zerver.lib.streams import access_stream_by_name
 from zerver.lib.utils import statsd, get_subdomain
+from zerver.tornado.sharding import tornado_sharding_enabled
 from zproject.backends import password_auth_enabled
 
 import calendar
@@ -69,11 +71,9 @@ def approximate_unread_count(user_profile):
     #       It was attempted in the past, but the original attempt
     #       was broken.  When we re-architect muting, we may
     #       want to to revisit this (see git issue #1019).
-    return UserMessage.objects.filter(
-        user_profile=user_profile, message_id__gt=user_profile.pointer).exclude(
-        message__recipient__type=Recipient.STREAM,
-        message__recipient__id__in=not_in_home_view_recipients).exclude(
-        flags=UserMessage.flags.read).count()
+    return UnreadMessageCount.objects.filter(user_profile=user_profile).exclude(
+        recipient__id__in=not_in_home_view_recipients).aggregate(
+        total=Sum('count'))['total'] or 0
 
 def sent_time_in_epoch_seconds(user_message):
     # type: (UserMessage) -> Optional[float]
@@ -204,7 +204,9 @@ def home_real(request):
         maxfilesize           = settings.MAX_FILE_UPLOAD_SIZE,
         max_avatar_file_size  = settings.MAX_AVATAR_FILE_SIZE,
         server_generation     = settings.SERVER_GENERATION,
-        use_websockets        = settings.USE_WEBSOCKETS,
+        # sockjs connections can't be routed to the shard that owns
+        # the user's event queue, so sharded installs use plain HTTP.
+        use_websockets        = settings.USE_WEBSOCKETS and not tornado_sharding_enabled(),
         save_stacktraces      = settings.SAVE_FRONTEND_STACKTRACES,
         server_inline_image_preview = settings.INLINE_IMAGE_PREVIEW,
         server_inline_url_embed_preview = settings.INLINE_URL_EMBED_PREVIEW,
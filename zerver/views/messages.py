@@ -9,7 +9,7 @@ from django.db import connection
 from django.db.models import Q
 from django.http import HttpRequest, HttpResponse
 from typing import Dict, List, Set, Text
-from typing import Any, AnyStr, Callable, Iterable, Optional, Tuple, Union
+from typing import Any, AnyStr, Callable, Iterable, Optional, Sequence, Tuple, Union
 from zerver.lib.str_utils import force_bytes, force_text
 from zerver.lib.html_diff import highlight_html_differences
 
@@ -24,9 +24,15 @@ from zerver.lib.actions import recipient_for_emails, do_update_message_flags, \
     extract_recipients, truncate_body, render_incoming_message
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.cache import (
+    cache_get,
+    cache_set,
     generic_bulk_cached_fetch,
+    message_window_cache_key,
+    search_generation_cache_key,
+    search_results_cache_key,
     to_dict_cache_key_id,
 )
+from zerver.lib.local_cache import get_message_dict_local_cache
 from zerver.lib.message import (
     access_message,
     MessageDict,
@@ -37,7 +43,7 @@ from zerver.lib.message import (
 from zerver.lib.response import json_success, json_error
 from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
 from zerver.lib.timestamp import datetime_to_timestamp
-from zerver.lib.utils import statsd
+from zerver.lib.utils import generate_random_token, statsd
 from zerver.lib.validator import \
     check_list, check_int, check_dict, check_string, check_bool
 from zerver.models import Message, UserProfile, Stream, Subscription, \
@@ -51,6 +57,8 @@ from sqlalchemy import func
 from sqlalchemy.sql import select, join, column, literal_column, literal, and_, \
     or_, not_, union_all, alias, Selectable, Select, ColumnElement, table
 
+import base64
+import hashlib
 import re
 import ujson
 import datetime
@@ -60,6 +68,20 @@ import six
 
 LARGER_THAN_MAX_MESSAGE_ID = 10000000000000000
 
+MAX_MESSAGE_PAGE_SIZE = 1000
+# get_message_page_backend fetches the ids of this many pages at once,
+# and caches them briefly for the following page requests.
+MESSAGE_WINDOW_PAGES = 10
+MESSAGE_WINDOW_CACHE_TIMEOUT_SECS = 5 * 60
+# Narrows using these operators aren't windowed: search results carry
+# per-request highlighting, and the others depend on flags or muting
+# settings that change much more often than the messages themselves.
+UNWINDOWED_NARROW_OPERATORS = frozenset(['search', 'is', 'in'])
+# get_messages_backend caches the ids of this many of the newest
+# messages matching a search (see get_search_result_ids).
+SEARCH_RESULT_CACHE_SIZE = 1000
+SEARCH_RESULT_CACHE_TIMEOUT_SECS = 10 * 60
+
 class BadNarrowOperator(JsonableError):
     def __init__(self, desc, status_code=400):
         # type: (str, int) -> None
@@ -75,10 +97,13 @@ ConditionTransform = Any # TODO: should be Callable[[ColumnElement], ColumnEleme
 
 # When you add a new operator to this, also update zerver/lib/narrow.py
 class NarrowBuilder(object):
-    def __init__(self, user_profile, msg_id_column):
-        # type: (UserProfile, str) -> None
+    def __init__(self, user_profile, msg_id_column, search_fields=True):
+        # type: (UserProfile, str, bool) -> None
         self.user_profile = user_profile
         self.msg_id_column = msg_id_column
+        # Whether search terms add the match position columns used for
+        # highlighting (see get_search_fields).
+        self.search_fields = search_fields
 
     def add_term(self, query, term):
         # type: (Query, Dict[str, Any]) -> Query
@@ -325,10 +350,11 @@ class NarrowBuilder(object):
         match_positions_character = func.pgroonga.match_positions_character
         query_extract_keywords = func.pgroonga.query_extract_keywords
         keywords = query_extract_keywords(operand)
-        query = query.column(match_positions_character(column("rendered_content"),
-                                                       keywords).label("content_matches"))
-        query = query.column(match_positions_character(column("subject"),
-                                                       keywords).label("subject_matches"))
+        if self.search_fields:
+            query = query.column(match_positions_character(column("rendered_content"),
+                                                           keywords).label("content_matches"))
+            query = query.column(match_positions_character(column("subject"),
+                                                           keywords).label("subject_matches"))
         condition = column("search_pgroonga").op("@@")(operand)
         return query.where(maybe_negate(condition))
 
@@ -336,13 +362,14 @@ class NarrowBuilder(object):
         # type: (Query, str, ConditionTransform) -> Query
         tsquery = func.plainto_tsquery(literal("zulip.english_us_search"), literal(operand))
         ts_locs_array = func.ts_match_locs_array
-        query = query.column(ts_locs_array(literal("zulip.english_us_search"),
-                                           column("rendered_content"),
-                                           tsquery).label("content_matches"))
-        # We HTML-escape the subject in Postgres to avoid doing a server round-trip
-        query = query.column(ts_locs_array(literal("zulip.english_us_search"),
-                                           func.escape_html(column("subject")),
-                                           tsquery).label("subject_matches"))
+        if self.search_fields:
+            query = query.column(ts_locs_array(literal("zulip.english_us_search"),
+                                               column("rendered_content"),
+                                               tsquery).label("content_matches"))
+            # We HTML-escape the subject in Postgres to avoid doing a server round-trip
+            query = query.column(ts_locs_array(literal("zulip.english_us_search"),
+                                               func.escape_html(column("subject")),
+                                               tsquery).label("subject_matches"))
 
         # Do quoted string matching.  We really want phrase
         # search here so we can ignore punctuation and do
@@ -536,16 +563,27 @@ def exclude_muting_conditions(user_profile, narrow):
 
     return conditions
 
-@has_request_variables
-def get_messages_backend(request, user_profile,
-                         anchor = REQ(converter=int),
-                         num_before = REQ(converter=to_non_negative_int),
-                         num_after = REQ(converter=to_non_negative_int),
-                         narrow = REQ('narrow', converter=narrow_parameter, default=None),
-                         use_first_unread_anchor = REQ(default=False, converter=ujson.loads),
-                         apply_markdown=REQ(default=True,
-                                            converter=ujson.loads)):
-    # type: (HttpRequest, UserProfile, int, int, int, Optional[List[Dict[str, Any]]], bool, bool) -> HttpResponse
+def log_narrow(request, narrow):
+    # type: (HttpRequest, List[Dict[str, Any]]) -> None
+    # Add some metadata to our logging data for narrows
+    verbose_operators = []
+    for term in narrow:
+        if term['operator'] == "is":
+            verbose_operators.append("is:" + term['operand'])
+        else:
+            verbose_operators.append(term['operator'])
+    request._log_data['extra'] = "[%s]" % (",".join(verbose_operators),)
+
+def narrow_message_query(user_profile, narrow, use_first_unread_anchor=False, search_fields=True):
+    # type: (UserProfile, Optional[List[Dict[str, Any]]], bool, bool) -> Tuple[Query, ColumnElement, bool, bool]
+    """Returns the query for the messages matching `narrow`, its message
+    id column, whether it includes messages the user never received
+    (include_history), and whether it is a search.
+
+    Each row starts with the message id, followed by the UserMessage
+    flags unless include_history; if search_fields, search queries end
+    with the subject, rendered content and match positions (see
+    get_search_fields)."""
     include_history = ok_to_include_history(narrow, user_profile.realm)
 
     if include_history and not use_first_unread_anchor:
@@ -565,28 +603,18 @@ def get_messages_backend(request, user_profile,
                             literal_column("zerver_message.id")))
         inner_msg_id_col = column("message_id")
 
-    num_extra_messages = 1
     is_search = False
 
     if narrow is not None:
-        # Add some metadata to our logging data for narrows
-        verbose_operators = []
-        for term in narrow:
-            if term['operator'] == "is":
-                verbose_operators.append("is:" + term['operand'])
-            else:
-                verbose_operators.append(term['operator'])
-        request._log_data['extra'] = "[%s]" % (",".join(verbose_operators),)
-
         # Build the query for the narrow
-        num_extra_messages = 0
-        builder = NarrowBuilder(user_profile, inner_msg_id_col)
+        builder = NarrowBuilder(user_profile, inner_msg_id_col, search_fields)
         search_term = None # type: Optional[Dict[str, Any]]
         for term in narrow:
             if term['operator'] == 'search':
                 if not is_search:
-                    search_term = term
-                    query = query.column(column("subject")).column(column("rendered_content"))
+                    search_term = dict(term)
+                    if search_fields:
+                        query = query.column(column("subject")).column(column("rendered_content"))
                     is_search = True
                 else:
                     # Join the search operators if there are multiple of them
@@ -596,10 +624,188 @@ def get_messages_backend(request, user_profile,
         if is_search:
             query = builder.add_term(query, search_term)
 
+    return (query, inner_msg_id_col, include_history, is_search)
+
+def search_fields_for_row(row):
+    # type: (Sequence[Any]) -> Dict[str, Text]
+    (subject, rendered_content, content_matches, subject_matches) = tuple(row)[-4:]
+    return get_search_fields(rendered_content, subject, content_matches, subject_matches)
+
+def fetch_message_list(message_ids, user_message_flags, search_fields, apply_markdown):
+    # type: (List[int], Dict[int, List[str]], Dict[int, Dict[str, Text]], bool) -> List[Dict[str, Any]]
+    cache_transformer = lambda row: MessageDict.build_dict_from_raw_db_row(row, apply_markdown)
+    id_fetcher = lambda row: row['id']
+
+    message_dicts = generic_bulk_cached_fetch(lambda message_id: to_dict_cache_key_id(message_id, apply_markdown),
+                                              Message.get_raw_db_rows,
+                                              message_ids,
+                                              id_fetcher=id_fetcher,
+                                              cache_transformer=cache_transformer,
+                                              extractor=extract_message_dict,
+                                              setter=stringify_message_dict,
+                                              local_cache=get_message_dict_local_cache())
+
+    message_list = []
+    for message_id in message_ids:
+        if message_id not in message_dicts:
+            # Deleted since its id was fetched
+            continue
+        msg_dict = message_dicts[message_id]
+        msg_dict.update({"flags": user_message_flags[message_id]})
+        msg_dict.update(search_fields.get(message_id, {}))
+        message_list.append(msg_dict)
+    return message_list
+
+def normalize_search_operand(operand):
+    # type: (Text) -> Text
+    if settings.USING_PGROONGA:
+        # pgroonga's query syntax is case- and space-sensitive (e.g. OR).
+        return operand
+    # With tsearch, words outside quotes are matched case-insensitively
+    # regardless of spacing; quoted phrases are matched as given (see
+    # _by_search_tsearch).
+    words = [] # type: List[Text]
+    for word in re.findall('"[^"]+"|\S+', operand):
+        if word[0] == '"' and word[-1] == '"':
+            words.append(word)
+        else:
+            words.append(word.lower())
+    return ' '.join(words)
+
+def normalize_search_narrow(narrow):
+    # type: (List[Dict[str, Any]]) -> List[Dict[str, Any]]
+    """Combines the search operands as narrow_message_query does, and
+    normalizes the order of the terms and, where the search backend
+    ignores them, the case and spacing of the search words, so that
+    equivalent searches share their cached results."""
+    search_term = None # type: Optional[Dict[str, Any]]
+    terms = [] # type: List[Dict[str, Any]]
+    for term in narrow:
+        if term['operator'] != 'search':
+            terms.append(dict(term))
+        elif search_term is None:
+            search_term = dict(term)
+        else:
+            search_term['operand'] += ' ' + term['operand']
+    terms.sort(key=lambda term: ujson.dumps(term, sort_keys=True))
+    if search_term is not None:
+        search_term['operand'] = normalize_search_operand(search_term['operand'])
+        terms.append(search_term)
+    return terms
+
+def user_has_unindexed_messages(user_profile):
+    # type: (UserProfile) -> bool
+    # The full-text search index is updated in the background (see
+    # puppet/zulip/files/postgresql/process_fts_updates); messages are
+    # logged in fts_update_log until then.
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT 1 FROM fts_update_log
+        INNER JOIN zerver_usermessage ON fts_update_log.message_id = zerver_usermessage.message_id
+        WHERE zerver_usermessage.user_profile_id = %s
+        LIMIT 1
+    """, [user_profile.id])
+    result = cursor.fetchall()
+    cursor.close()
+    return len(result) > 0
+
+def get_search_generation(realm_id):
+    # type: (int) -> Text
+    key = search_generation_cache_key(realm_id)
+    cached = cache_get(key)
+    if cached is not None:
+        return cached[0]
+    generation = generate_random_token(16)
+    cache_set(key, generation)
+    return generation
+
+def get_search_result_ids(user_profile, narrow):
+    # type: (UserProfile, List[Dict[str, Any]]) -> Optional[Tuple[List[int], bool]]
+    """Returns the ids of the SEARCH_RESULT_CACHE_SIZE newest messages the
+    user received that match the search `narrow`, newest first, and
+    whether those are all the matching messages.
+
+    The ids are cached per user and normalized search.  Cached results
+    are discarded once the user receives a new message, or a message in
+    the realm is edited (do_update_message resets the realm's search
+    generation).  Results can only be cached once all of the user's
+    messages have been indexed, so that they don't miss messages that
+    were sent just before the search; until then, this returns None and
+    the caller should query the messages it needs directly."""
+    key = search_results_cache_key(user_profile.id, narrow_hash(normalize_search_narrow(narrow)))
+    latest_id = UserMessage.objects.filter(user_profile=user_profile) \
+                                   .order_by('-message_id') \
+                                   .values_list('message_id', flat=True).first()
+    generation = get_search_generation(user_profile.realm_id)
+
+    cached = cache_get(key)
+    if cached is not None:
+        results = cached[0]
+        if results['latest_id'] == latest_id and results['generation'] == generation:
+            statsd.incr('search_results.hit')
+            return (results['ids'], results['complete'])
+    statsd.incr('search_results.miss')
+
+    if user_has_unindexed_messages(user_profile):
+        return None
+    # Only the ids are cached, so skip computing the highlighting for
+    # every matching message; the caller gets it for the page it shows.
+    (query, inner_msg_id_col, include_history, is_search) = narrow_message_query(
+        user_profile, narrow, search_fields=False)
+    query = query.order_by(inner_msg_id_col.desc()).limit(SEARCH_RESULT_CACHE_SIZE + 1) \
+                 .prefix_with("/* get_search_result_ids */")
+    rows = list(get_sqlalchemy_connection().execute(query).fetchall())
+    message_ids = [row[0] for row in rows[:SEARCH_RESULT_CACHE_SIZE]]
+    complete = len(rows) <= SEARCH_RESULT_CACHE_SIZE
+    cache_set(key, (dict(latest_id=latest_id, generation=generation,
+                         ids=message_ids, complete=complete),),
+              timeout=SEARCH_RESULT_CACHE_TIMEOUT_SECS)
+    return (message_ids, complete)
+
+def select_anchored_ids(message_ids, complete, anchor, num_before, num_after):
+    # type: (List[int], bool, int, int, int) -> Optional[List[int]]
+    """Given the newest matching message ids (newest first, and all of
+    them if `complete`), returns the ids a get_messages_backend request
+    would fetch, or None if they can't be determined from message_ids."""
+    if num_before == 0 and num_after == 0:
+        return None
+    ascending_ids = message_ids[::-1]
+    oldest_id = ascending_ids[0] if ascending_ids else None
+
+    result = [] # type: List[int]
+    if num_before != 0:
+        before_anchor = anchor - 1 if num_after != 0 else anchor
+        before_ids = [message_id for message_id in ascending_ids if message_id <= before_anchor]
+        if len(before_ids) < num_before and not complete:
+            return None
+        result += before_ids[-num_before:]
+    if num_after != 0 and anchor != LARGER_THAN_MAX_MESSAGE_ID:
+        # We have every matching message that is newer than oldest_id.
+        if not complete and (oldest_id is None or anchor < oldest_id):
+            return None
+        result += [message_id for message_id in ascending_ids if message_id >= anchor][:num_after]
+    return result
+
+@has_request_variables
+def get_messages_backend(request, user_profile,
+                         anchor = REQ(converter=int),
+                         num_before = REQ(converter=to_non_negative_int),
+                         num_after = REQ(converter=to_non_negative_int),
+                         narrow = REQ('narrow', converter=narrow_parameter, default=None),
+                         use_first_unread_anchor = REQ(default=False, converter=ujson.loads),
+                         apply_markdown=REQ(default=True,
+                                            converter=ujson.loads)):
+    # type: (HttpRequest, UserProfile, int, int, int, Optional[List[Dict[str, Any]]], bool, bool) -> HttpResponse
+    if narrow is not None:
+        log_narrow(request, narrow)
+    (query, inner_msg_id_col, include_history, is_search) = narrow_message_query(
+        user_profile, narrow, use_first_unread_anchor)
+
     # We add 1 to the number of messages requested if no narrow was
     # specified to ensure that the resulting list always contains the
     # anchor message.  If a narrow was specified, the anchor message
     # might not match the narrow anyway.
+    num_extra_messages = 1 if narrow is None else 0
     if num_after != 0:
         num_after += num_extra_messages
     else:
@@ -637,33 +843,50 @@ def get_messages_backend(request, user_profile,
         else:
             anchor = LARGER_THAN_MAX_MESSAGE_ID
 
+    search_result_ids = None # type: Optional[List[int]]
+    if (is_search and not include_history and not use_first_unread_anchor and
+            not any(term['operator'] in ('is', 'in') for term in narrow)):
+        # Finding the messages that match a search is expensive, so we
+        # look them up in the user's cached search results, and only
+        # query the matching messages we return (for highlighting).
+        # Searches within flags or muting settings aren't cached, as
+        # those change too often.
+        search_results = get_search_result_ids(user_profile, narrow)
+        if search_results is not None:
+            search_result_ids = select_anchored_ids(search_results[0], search_results[1],
+                                                    anchor, num_before, num_after)
+
     before_query = None
     after_query = None
-    if num_before != 0:
-        before_anchor = anchor
+    if search_result_ids is not None:
+        # (An empty IN () isn't valid SQL, and -1 is never a message id.)
+        query = query.where(inner_msg_id_col.in_(search_result_ids or [-1]))
+    else:
+        if num_before != 0:
+            before_anchor = anchor
+            if num_after != 0:
+                # Don't include the anchor in both the before query and the after query
+                before_anchor = anchor - 1
+            before_query = query.where(inner_msg_id_col <= before_anchor) \
+                                .order_by(inner_msg_id_col.desc()).limit(num_before)
         if num_after != 0:
-            # Don't include the anchor in both the before query and the after query
-            before_anchor = anchor - 1
-        before_query = query.where(inner_msg_id_col <= before_anchor) \
-                            .order_by(inner_msg_id_col.desc()).limit(num_before)
-    if num_after != 0:
-        after_query = query.where(inner_msg_id_col >= anchor) \
-                           .order_by(inner_msg_id_col.asc()).limit(num_after)
+            after_query = query.where(inner_msg_id_col >= anchor) \
+                               .order_by(inner_msg_id_col.asc()).limit(num_after)
 
-    if anchor == LARGER_THAN_MAX_MESSAGE_ID:
-        # There's no need for an after_query if we're targeting just the target message.
-        after_query = None
+        if anchor == LARGER_THAN_MAX_MESSAGE_ID:
+            # There's no need for an after_query if we're targeting just the target message.
+            after_query = None
 
-    if before_query is not None:
-        if after_query is not None:
-            query = union_all(before_query.self_group(), after_query.self_group())
+        if before_query is not None:
+            if after_query is not None:
+                query = union_all(before_query.self_group(), after_query.self_group())
+            else:
+                query = before_query
+        elif after_query is not None:
+            query = after_query
         else:
-            query = before_query
-    elif after_query is not None:
-        query = after_query
-    else:
-        # This can happen when a narrow is specified.
-        query = query.where(inner_msg_id_col == anchor)
+            # This can happen when a narrow is specified.
+            query = query.where(inner_msg_id_col == anchor)
 
     main_query = alias(query)
     query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
@@ -693,9 +916,7 @@ def get_messages_backend(request, user_profile,
             if user_message_flags.get(message_id) is None:
                 user_message_flags[message_id] = ["read", "historical"]
             if is_search:
-                (_, subject, rendered_content, content_matches, subject_matches) = row
-                search_fields[message_id] = get_search_fields(rendered_content, subject,
-                                                              content_matches, subject_matches)
+                search_fields[message_id] = search_fields_for_row(row)
     else:
         for row in query_result:
             message_id = row[0]
@@ -705,27 +926,10 @@ def get_messages_backend(request, user_profile,
             message_ids.append(message_id)
 
             if is_search:
-                (_, _, subject, rendered_content, content_matches, subject_matches) = row
-                search_fields[message_id] = get_search_fields(rendered_content, subject,
-                                                              content_matches, subject_matches)
+                search_fields[message_id] = search_fields_for_row(row)
 
-    cache_transformer = lambda row: MessageDict.build_dict_from_raw_db_row(row, apply_markdown)
-    id_fetcher = lambda row: row['id']
-
-    message_dicts = generic_bulk_cached_fetch(lambda message_id: to_dict_cache_key_id(message_id, apply_markdown),
-                                              Message.get_raw_db_rows,
-                                              message_ids,
-                                              id_fetcher=id_fetcher,
-                                              cache_transformer=cache_transformer,
-                                              extractor=extract_message_dict,
-                                              setter=stringify_message_dict)
-
-    message_list = []
-    for message_id in message_ids:
-        msg_dict = message_dicts[message_id]
-        msg_dict.update({"flags": user_message_flags[message_id]})
-        msg_dict.update(search_fields.get(message_id, {}))
-        message_list.append(msg_dict)
+    message_list = fetch_message_list(message_ids, user_message_flags, search_fields,
+                                      apply_markdown)
 
     statsd.incr('loaded_old_messages', len(message_list))
     ret = {'messages': message_list,
@@ -733,6 +937,148 @@ def get_messages_backend(request, user_profile,
            "msg": ""}
     return json_success(ret)
 
+def narrow_hash(narrow):
+    # type: (Optional[List[Dict[str, Any]]]) -> Text
+    return force_text(hashlib.sha1(force_bytes(ujson.dumps(narrow or [], sort_keys=True))).hexdigest())
+
+def encode_continuation_token(narrow_hash, last_id, direction):
+    # type: (Text, int, Text) -> Text
+    return force_text(base64.urlsafe_b64encode(force_bytes(
+        ujson.dumps([narrow_hash, last_id, direction]))))
+
+def decode_continuation_token(token, expected_narrow_hash):
+    # type: (Text, Text) -> Tuple[int, Text]
+    """Returns the last message id and direction of the page that
+    `token` continues.  Tokens only say where to continue from; the
+    narrow is re-checked for every page, so they grant no access."""
+    try:
+        (token_narrow_hash, last_id, direction) = ujson.loads(
+            base64.urlsafe_b64decode(force_bytes(token)))
+    except Exception:
+        raise JsonableError(_("Invalid continuation token"))
+    if (token_narrow_hash != expected_narrow_hash or
+            not isinstance(last_id, six.integer_types) or
+            direction not in ('older', 'newer')):
+        raise JsonableError(_("Invalid continuation token"))
+    return (last_id, direction)
+
+def query_message_page_rows(user_profile, narrow, direction, after_id, limit):
+    # type: (UserProfile, Optional[List[Dict[str, Any]]], Text, int, int) -> List[Any]
+    """The rows of up to `limit` messages matching `narrow` that come
+    strictly after `after_id` in `direction`, in that order."""
+    (query, inner_msg_id_col, include_history, is_search) = narrow_message_query(user_profile, narrow)
+    if direction == 'older':
+        query = query.where(inner_msg_id_col < after_id).order_by(inner_msg_id_col.desc())
+    else:
+        query = query.where(inner_msg_id_col > after_id).order_by(inner_msg_id_col.asc())
+    query = query.limit(limit).prefix_with("/* get_message_page */")
+    return list(get_sqlalchemy_connection().execute(query).fetchall())
+
+def get_message_page_ids(user_profile, narrow, direction, after_id, num, use_window):
+    # type: (UserProfile, Optional[List[Dict[str, Any]]], Text, int, int, bool) -> Tuple[List[int], bool, Dict[int, Dict[str, Text]]]
+    """Returns the ids of the next `num` messages matching `narrow` after
+    `after_id` in `direction`, whether there may be more, and search
+    highlighting if the narrow is a search.
+
+    Rather than querying for just one page, we fetch the ids of the next
+    MESSAGE_WINDOW_PAGES pages and cache that window, so that the next
+    pages (and scrolling back over them) are served from the cache.  A
+    window is only reused when continuing from a token (use_window), so
+    a request for the latest messages always sees new messages."""
+    windowed = not any(term['operator'] in UNWINDOWED_NARROW_OPERATORS
+                       for term in (narrow or []))
+    key = message_window_cache_key(user_profile.id, narrow_hash(narrow), direction)
+
+    if windowed and use_window:
+        cached = cache_get(key)
+        if cached is not None:
+            window = cached[0]
+            window_ids = window['ids']
+            if after_id == window['after_id']:
+                remaining = window_ids
+            elif after_id in window_ids:
+                remaining = window_ids[window_ids.index(after_id) + 1:]
+            else:
+                remaining = None
+            # New messages can arrive after a window of newer messages
+            # was fetched, so only an older window can be complete.
+            complete = window['complete'] and direction == 'older'
+            if remaining is not None and (len(remaining) >= num or complete):
+                statsd.incr('message_window.hit')
+                return (remaining[:num], len(remaining) > num or not complete, {})
+        statsd.incr('message_window.miss')
+
+    limit = num * MESSAGE_WINDOW_PAGES if windowed else num + 1
+    rows = query_message_page_rows(user_profile, narrow, direction, after_id, limit)
+    message_ids = [row[0] for row in rows]
+    search_fields = {} # type: Dict[int, Dict[str, Text]]
+    if not windowed:
+        if any(term['operator'] == 'search' for term in (narrow or [])):
+            search_fields = dict((row[0], search_fields_for_row(row)) for row in rows[:num])
+    else:
+        cache_set(key, (dict(after_id=after_id, ids=message_ids,
+                             complete=len(message_ids) < limit),),
+                  timeout=MESSAGE_WINDOW_CACHE_TIMEOUT_SECS)
+    return (message_ids[:num], len(message_ids) > num, search_fields)
+
+@has_request_variables
+def get_message_page_backend(request, user_profile,
+                             narrow = REQ('narrow', converter=narrow_parameter, default=None),
+                             num = REQ(converter=to_non_negative_int, default=100),
+                             anchor = REQ(converter=int, default=None),
+                             direction = REQ(default='older'),
+                             continuation = REQ(default=None),
+                             apply_markdown = REQ(default=True, converter=ujson.loads)):
+    # type: (HttpRequest, UserProfile, Optional[List[Dict[str, Any]]], int, Optional[int], Text, Optional[Text], bool) -> HttpResponse
+    """Keyset-paginated message history: returns `num` messages matching
+    the narrow, older or newer than `anchor` (inclusive; by default the
+    newest or oldest message), and a `continuation` token for fetching
+    the next page, or None if there are no more messages."""
+    if num == 0 or num > MAX_MESSAGE_PAGE_SIZE:
+        raise JsonableError(_("num must be between 1 and %d") % (MAX_MESSAGE_PAGE_SIZE,))
+    if narrow is not None:
+        log_narrow(request, narrow)
+
+    this_narrow_hash = narrow_hash(narrow)
+    if continuation is not None:
+        (after_id, direction) = decode_continuation_token(continuation, this_narrow_hash)
+    elif direction == 'older':
+        after_id = LARGER_THAN_MAX_MESSAGE_ID if anchor is None else anchor + 1
+    elif direction == 'newer':
+        after_id = -1 if anchor is None else anchor - 1
+    else:
+        raise JsonableError(_("Invalid direction"))
+
+    (message_ids, has_more, search_fields) = get_message_page_ids(
+        user_profile, narrow, direction, after_id, num, use_window=continuation is not None)
+
+    # Flags change far more often than which messages match a narrow,
+    # so they are always fetched fresh rather than cached with the ids.
+    user_message_flags = dict((user_message.message_id, user_message.flags_list()) for user_message in
+                              UserMessage.objects.filter(user_profile=user_profile,
+                                                         message__id__in=message_ids))
+    last_id = message_ids[-1] if message_ids else None
+    include_history = ok_to_include_history(narrow, user_profile.realm)
+    if include_history:
+        for message_id in message_ids:
+            if message_id not in user_message_flags:
+                user_message_flags[message_id] = ["read", "historical"]
+    else:
+        # A cached window may still list a message the user has lost
+        # access to since.
+        message_ids = [message_id for message_id in message_ids
+                       if message_id in user_message_flags]
+
+    token = None # type: Optional[Text]
+    if has_more and last_id is not None:
+        token = encode_continuation_token(this_narrow_hash, last_id, direction)
+
+    message_list = fetch_message_list(sorted(message_ids), user_message_flags, search_fields,
+                                      apply_markdown)
+    statsd.incr('loaded_old_messages', len(message_list))
+    return json_success({'messages': message_list,
+                         'continuation': token})
+
 @has_request_variables
 def update_message_flags(request, user_profile,
                          messages=REQ(validator=check_list(check_int)),
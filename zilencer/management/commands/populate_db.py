@@ -6,11 +6,11 @@ from django.core.management.base import BaseCommand, CommandParser
 from django.utils.timezone import now as timezone_now
 
 from zerver.models import Message, UserProfile, Stream, Recipient, UserPresence, \
-    Subscription, get_huddle, Realm, UserMessage, RealmDomain, \
-    clear_database, get_client, get_user_profile_by_id, \
+    Subscription, get_huddle, Realm, UserMessage, UnreadMessageCount, RealmDomain, \
+    StreamTopic, clear_database, get_client, get_user_profile_by_id, \
     email_to_username
 from zerver.lib.actions import STREAM_ASSIGNMENT_COLORS, do_send_messages, \
-    do_change_is_admin
+    do_change_is_admin, do_set_muted_topics
 from django.conf import settings
 from zerver.lib.bulk_create import bulk_create_clients, \
     bulk_create_streams, bulk_create_users, bulk_create_huddles
@@ -62,6 +62,18 @@ class Command(BaseCommand):
                             default=0,
                             help='The number of extra bots to create')
 
+        parser.add_argument('--extra-streams',
+                            dest='extra_streams',
+                            type=int,
+                            default=0,
+                            help='The number of extra public streams to create')
+
+        parser.add_argument('--muted-topics',
+                            dest='muted_topics',
+                            type=int,
+                            default=0,
+                            help='The number of topics each user mutes')
+
         parser.add_argument('--huddles',
                             dest='num_huddles',
                             type=int,
@@ -160,6 +172,11 @@ class Command(BaseCommand):
                 "Venice": {"description": "A northeastern Italian city", "invite_only": False},
                 "Rome": {"description": "Yet another Italian city", "invite_only": False}
             } # type: Dict[Text, Dict[Text, Any]]
+            for i in range(options["extra_streams"]):
+                extra_stream_name = 'Extra Stream %d' % (i,)
+                stream_list.append(extra_stream_name)
+                stream_dict[extra_stream_name] = {"description": "An extra stream",
+                                                  "invite_only": False}
 
             bulk_create_streams(zulip_realm, stream_dict)
             recipient_streams = [Stream.objects.get(name=name, realm=zulip_realm).id
@@ -221,6 +238,9 @@ class Command(BaseCommand):
         for job in jobs:
             send_messages(job)
 
+        if options["muted_topics"]:
+            mute_topics(user_profiles, options["muted_topics"])
+
         if options["delete"]:
             # Create the "website" and "API" clients; if we don't, the
             # default values in zerver/decorators.py will not work
@@ -320,6 +340,7 @@ class Command(BaseCommand):
 
             # Mark all messages as read
             UserMessage.objects.all().update(flags=UserMessage.flags.read)
+            UnreadMessageCount.objects.all().delete()
 
             self.stdout.write("Successfully populated test database.\n")
 
@@ -413,6 +434,21 @@ def send_messages(data):
         num_messages += 1
     return tot_messages
 
+def mute_topics(user_profiles, num_muted_topics):
+    # type: (Iterable[UserProfile], int) -> None
+    """Has each user mute (up to) num_muted_topics random topics of the
+    streams they are subscribed to."""
+    for user_profile in user_profiles:
+        subscribed_recipient_ids = Subscription.objects.filter(
+            user_profile=user_profile, active=True,
+            recipient__type=Recipient.STREAM).values_list('recipient_id', flat=True)
+        topics = list(StreamTopic.objects.filter(recipient_id__in=subscribed_recipient_ids)
+                      .values_list('recipient__type_id', 'topic_name'))
+        muted_topics = []
+        for (stream_id, topic_name) in random.sample(topics, min(num_muted_topics, len(topics))):
+            muted_topics.append([Stream.objects.get(id=stream_id).name, topic_name])
+        do_set_muted_topics(user_profile, muted_topics)
+
 def create_simple_community_realm():
     # type: () -> None
     simple_realm = Realm.objects.create(
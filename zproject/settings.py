@@ -34,6 +34,13 @@ config_file.read("/etc/zulip/zulip.conf")
 PRODUCTION = config_file.has_option('machine', 'deploy_type')
 DEVELOPMENT = not PRODUCTION
 
+if config_file.has_option('application_server', 'tornado_ports'):
+    TORNADO_SHARD_PORTS_FROM_CONFIG = [
+        int(port) for port in
+        config_file.get('application_server', 'tornado_ports').split(',')]
+else:
+    TORNADO_SHARD_PORTS_FROM_CONFIG = []
+
 secrets_file = six.moves.configparser.RawConfigParser()
 if PRODUCTION:
     secrets_file.read("/etc/zulip/zulip-secrets.conf")
@@ -214,6 +221,25 @@ DEFAULT_SETTINGS = {'TWITTER_CONSUMER_KEY': '',
                     'PASSWORD_MIN_ZXCVBN_QUALITY': 0.5,
                     'OFFLINE_THRESHOLD_SECS': 5 * 60,
                     'PUSH_NOTIFICATION_BOUNCER_URL': None,
+                    'BUGDOWN_RENDER_POOL_SIZE': 0,
+                    # One port per Tornado shard; see zerver/tornado/sharding.py.
+                    # Production installs configure these in zulip.conf, so that
+                    # puppet's nginx and supervisor configuration agrees.
+                    'TORNADO_SHARD_PORTS': TORNADO_SHARD_PORTS_FROM_CONFIG,
+                    'TORNADO_SHARD_HOST': '127.0.0.1',
+                    # Event queues whose pending events exceed this many
+                    # bytes are replaced with a restart event; 0 disables.
+                    'EVENT_QUEUE_MAX_BYTES': 4 * 1024 * 1024,
+                    # How often Tornado snapshots its event queues to
+                    # JSON_PERSISTENT_QUEUE_FILENAME; 0 disables this.
+                    'EVENT_QUEUE_SNAPSHOT_INTERVAL_SECS': 300,
+                    # Size of each process's in-memory cache of message
+                    # dicts (see zerver/lib/local_cache.py); 0 disables it.
+                    'MESSAGE_DICT_LOCAL_CACHE_SIZE': 10000,
+                    'MESSAGE_DICT_LOCAL_CACHE_TIMEOUT_SECS': 60,
+                    # Defer cache deletes made in a transaction until it
+                    # commits (see zerver/lib/cache.py).
+                    'CACHE_DELETES_AFTER_COMMIT': True,
                     }
 
 for setting_name, setting_val in six.iteritems(DEFAULT_SETTINGS):
@@ -329,6 +355,7 @@ MIDDLEWARE_CLASSES = (
     'zerver.middleware.JsonErrorHandler',
     'zerver.middleware.RateLimitMiddleware',
     'zerver.middleware.FlushDisplayRecipientCache',
+    'zerver.middleware.BatchTornadoNotifications',
     'django.middleware.common.CommonMiddleware',
     'zerver.middleware.SessionHostDomainMiddleware',
     'django.middleware.locale.LocaleMiddleware',
@@ -372,6 +399,9 @@ ZILENCER_ENABLED = 'zilencer' in INSTALLED_APPS
 # We override the port number when running frontend tests.
 TORNADO_SERVER = 'http://127.0.0.1:9993'
 RUNNING_INSIDE_TORNADO = False
+# Set by runtornado to the shard this process serves when
+# TORNADO_SHARD_PORTS is configured.
+TORNADO_SHARD = 0
 AUTORELOAD = DEBUG
 
 ########################################################################
@@ -80,6 +80,13 @@ AUTH_LDAP_ALWAYS_UPDATE_USER = False
 
 TEST_SUITE = True
 RATE_LIMITING = False
+
+# Tests that use the local message dict cache enable it explicitly.
+MESSAGE_DICT_LOCAL_CACHE_SIZE = 0
+# Each test runs in a transaction that is never committed, so cache
+# deletes can't wait for the commit; see
+# zerver.lib.test_helpers.cache_deletes_after_commit.
+CACHE_DELETES_AFTER_COMMIT = False
 # Don't use rabbitmq from the test suite -- the user_profile_ids for
 # any generated queue elements won't match those being used by the
 # real app.
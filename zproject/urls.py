@@ -242,6 +242,8 @@ v1_api_and_json_patterns = [
     url(r'^messages/(?P<message_id>[0-9]+)$', rest_dispatch,
         {'GET': 'zerver.views.messages.json_fetch_raw_message',
          'PATCH': 'zerver.views.messages.update_message_backend'}),
+    url(r'^messages/page$', rest_dispatch,
+        {'GET': 'zerver.views.messages.get_message_page_backend'}),
     url(r'^messages/render$', rest_dispatch,
         {'POST': 'zerver.views.messages.render_message_backend'}),
     url(r'^messages/flags$', rest_dispatch,
@@ -436,6 +438,10 @@ for app_name in settings.EXTRA_INSTALLED_APPS:
 urls += [
     # Used internally for communication between Django and Tornado processes
     url(r'^notify_tornado$', zerver.tornado.views.notify, name='zerver.tornado.views.notify'),
+    url(r'^tornado_queue_stats$', zerver.tornado.views.queue_stats,
+        name='zerver.tornado.views.queue_stats'),
+    url(r'^tornado_stats$', zerver.tornado.views.tornado_stats,
+        name='zerver.tornado.views.tornado_stats'),
 ]
 
 # Python Social Auth